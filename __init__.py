@@ -1,7 +1,19 @@
-from marl_comm import ma_policy
+from typing import TYPE_CHECKING
+
+from marl_comm.utils.lazy import lazy_attributes
+
+if TYPE_CHECKING:
+    from marl_comm import data, env, games, ma_policy
 
 __version__ = "0.1"
 
 __all__ = [
+    "data",
+    "env",
+    "games",
     "ma_policy",
 ]
+
+__getattr__, __dir__ = lazy_attributes(
+    __name__, {name: f"{__name__}.{name}"
+               for name in __all__})
@@ -1,4 +1,17 @@
-from marl_comm.data.ma_buffer.base import MAReplayBuffer
-from marl_comm.data.ma_collector import MACollector
+from typing import TYPE_CHECKING
 
-__all__ = ["MAReplayBuffer", "MACollector"]
+from marl_comm.utils.lazy import lazy_attributes
+
+if TYPE_CHECKING:
+    from marl_comm.data.ma_buffer.base import MAReplayBuffer
+    from marl_comm.data.ma_collector import MACollector
+    from marl_comm.data.recorder import FrameRecorder
+
+__all__ = ["MAReplayBuffer", "MACollector", "FrameRecorder"]
+
+__getattr__, __dir__ = lazy_attributes(
+    __name__, {
+        "MAReplayBuffer": "marl_comm.data.ma_buffer.base",
+        "MACollector": "marl_comm.data.ma_collector",
+        "FrameRecorder": "marl_comm.data.recorder",
+    })
@@ -1,3 +1,11 @@
-from marl_comm.data.ma_buffer.base import MAReplayBuffer
+from typing import TYPE_CHECKING
+
+from marl_comm.utils.lazy import lazy_attributes
+
+if TYPE_CHECKING:
+    from marl_comm.data.ma_buffer.base import MAReplayBuffer
 
 __all__ = ["MAReplayBuffer"]
+
+__getattr__, __dir__ = lazy_attributes(
+    __name__, {"MAReplayBuffer": "marl_comm.data.ma_buffer.base"})
@@ -1,8 +1,9 @@
-from typing import Any, List, Optional, Tuple, Type, Union
+from typing import Any, List, Optional, Set, Tuple, Type, Union
 
 import numpy as np
 from tianshou.data import (Batch, ReplayBuffer, ReplayBufferManager,
                            VectorReplayBuffer)
+from tianshou.data.batch import _alloc_by_keys_diff, _create_value
 
 
 class MAReplayBuffer(ReplayBufferManager):
@@ -15,6 +16,10 @@ class MAReplayBuffer(ReplayBufferManager):
                  **kwargs: Any) -> None:
         """MultiAgent ReplayBuffer.
 
+        The agents' buffers share one contiguous storage, agent i's data is
+        at [offset[i], offset[i] + size). Indexing this buffer with
+        :meth:`stacked_indices` gathers all agents' data at once.
+
         :param int size: the size for each agent's buffer.
         :param int agent_num:
         """
@@ -38,10 +43,34 @@ class MAReplayBuffer(ReplayBufferManager):
         self.ma_env_num = ma_env_num or 1
         self.ma_buffer_num = len(self.buffers)
         self.agents = agents
-
-    def _set_batch_for_children(self) -> None:
+        # whether the agents' buffers store their data in the shared storage,
+        # reset when a batch with new keys is added
+        self._bound = False
+        self._bound_keys: Set[str] = set()
+        # the nested keys of the last added batch, by its layout
+        self._layout: Optional[tuple] = None
+        self._layout_keys: Set[str] = set()
+
+    def _bind_children(self) -> None:
+        """Move the agents' data into the shared storage.
+
+        The agents' buffers allocate their storage on their first `add`, and
+        again when new keys show up, the data is then copied once into the
+        shared storage and the buffers are rebound to slices of it.
+        """
         for buf in self.buffers:
-            buf._set_batch_for_children()
+            if buf._meta.is_empty():
+                continue
+            if self._meta.is_empty():
+                self._meta = _create_value(buf._meta,
+                                           self.maxsize,
+                                           stack=False)
+            else:
+                _alloc_by_keys_diff(self._meta, buf._meta, self.maxsize, False)
+        for offset, buf in zip(self._offset, self.buffers):
+            if not buf._meta.is_empty():
+                self._meta[offset:offset + buf.maxsize] = buf._meta
+        self._set_batch_for_children()
 
     def get_agent_buffer(
             self, agent_id: int) -> Union[ReplayBuffer, ReplayBufferManager]:
@@ -54,6 +83,12 @@ class MAReplayBuffer(ReplayBufferManager):
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
         buffer_ids = np.asarray(buffer_ids)
         idxs = np.arange(len(buffer_ids))
+        layout = _layout(batch)
+        if layout != self._layout:
+            self._layout, self._layout_keys = layout, _keys(batch)
+            if not self._layout_keys <= self._bound_keys:
+                # allocated by the agents' buffers outside of the shared storage
+                self._bound = False
 
         ptrs = np.empty_like(buffer_ids)
         ep_rews = np.empty_like(buffer_ids)
@@ -77,8 +112,43 @@ class MAReplayBuffer(ReplayBufferManager):
             ep_lens[_idxs] = _ep_lens
             ep_idxs[_idxs] = _ep_idxs
 
+        if not self._bound:
+            self._bind_children()
+            self._bound_keys |= self._layout_keys
+            self._bound = True
+
         return ptrs, ep_rews, ep_lens, ep_idxs
 
+    def stacked_indices(self, indices: np.ndarray) -> np.ndarray:
+        """Map indices of the agents' buffers to the agent-stacked indices of
+        this buffer, [agent_0's indices, agent_1's indices, ...]."""
+        return (self._offset[:, None] + np.asarray(indices)[None]).reshape(-1)
+
+    def agent_of(self, index: Union[int, np.ndarray]) -> np.ndarray:
+        """The agent that the stacked index belongs to."""
+        return np.searchsorted(self._offset, index, side="right") - 1
+
+    def prev(self, index: Union[int, np.ndarray]) -> np.ndarray:
+        return self._agent_wise(index, "prev")
+
+    def next(self, index: Union[int, np.ndarray]) -> np.ndarray:
+        return self._agent_wise(index, "next")
+
+    def _agent_wise(self, index: Union[int, np.ndarray],
+                    fn: str) -> np.ndarray:
+        """Apply prev/next of each agent's buffer to the stacked indices, so
+        that episodes never cross the agents' or the envs' boundaries."""
+        indices = np.asarray(index)
+        flat = indices.reshape(-1)
+        result = np.empty_like(flat)
+        agent_ids = self.agent_of(flat)
+        for agent_i in np.unique(agent_ids):
+            mask = agent_ids == agent_i
+            offset = self._offset[agent_i]
+            result[mask] = getattr(self.buffers[agent_i],
+                                   fn)(flat[mask] - offset) + offset
+        return result.reshape(indices.shape)
+
     def sample_indices(self, batch_size: int) -> np.ndarray:
         return self.buffers[0].sample_indices(batch_size)
 
@@ -88,3 +158,21 @@ class MAReplayBuffer(ReplayBufferManager):
         for agent_i, agent in enumerate(self.agents):
             sample[agent] = self.buffers[agent_i][indices]
         return sample, indices
+
+
+def _layout(batch: Batch) -> tuple:
+    """The top-level keys of a batch with the keys of its sub-batches, which
+    is cheap to compare on every `add` while the nested keys are not."""
+    return tuple(
+        (key, tuple(value.keys()) if isinstance(value, Batch) else None)
+        for key, value in batch.items())
+
+
+def _keys(batch: Batch) -> set:
+    """The nested keys of a batch, e.g. {"obs", "obs.obs", "act"}."""
+    keys = set()
+    for key, value in batch.items():
+        keys.add(key)
+        if isinstance(value, Batch):
+            keys |= {key + "." + k for k in _keys(value)}
+    return keys
@@ -1,6 +1,6 @@
 import time
 from pprint import pprint
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import gym
 import numpy as np
@@ -10,12 +10,8 @@ from tianshou.data.batch import _alloc_by_keys_diff
 from tianshou.env import BaseVectorEnv, DummyVectorEnv
 from tianshou.policy import BasePolicy
 
-import sys, os
-
-current_dir = os.path.dirname(os.path.abspath(__file__))
-root = os.path.dirname(os.path.dirname(current_dir))
-sys.path.append(root)
 from marl_comm.data.ma_buffer import MAReplayBuffer
+from marl_comm.data.recorder import FrameRecorder
 from marl_comm.env import get_MA_VectorEnv
 
 
@@ -27,7 +23,17 @@ class MACollector(Collector):
         buffer: Optional[MAReplayBuffer] = None,
         preprocess_fn: Optional[Callable[..., Batch]] = None,
         exploration_noise: bool = False,
+        joint_step: bool = False,
     ) -> None:
+        """
+        :param bool joint_step: choose the actions of all agents from their obs
+            at the start of a round and step all turns with one joint_step of
+            the env, i.e. one message per worker instead of one per turn, see
+            _joint_step. Meant for simultaneous-move games such as the dilemma
+            games, whose obs do not change within a round. The obs stored with
+            an action is the obs it was chosen on, and an episode must end
+            with a round, defaults to False
+        """
         if hasattr(env, "num_agents"):
             agents = env.agents
         else:
@@ -45,15 +51,24 @@ class MACollector(Collector):
             env = get_MA_VectorEnv(DummyVectorEnv, [lambda: env])
 
         self.maenv_num = env.env_num
+        # the envs return the reset obs at the end of an episode
+        self._autoreset = getattr(env, "autoreset", False)
+        # the gym_reset_kwargs set in the envs for their autoreset
+        self._reset_kwargs: Dict[str, Any] = {}
+        self.joint_step = joint_step
+        if joint_step:
+            assert hasattr(env, "joint_step"), "joint_step needs an MA vector env"
 
         super().__init__(policy, env, buffer, preprocess_fn, exploration_noise)
 
-    def reset_env(self) -> None:
+    def reset_env(self, gym_reset_kwargs: Optional[Dict[str, Any]] = None) -> None:
         """Reset all of the environments.
         obs is inited in the following format:
         [{'agent_id': 'agent_id_for_agent0', 'obs': obs0}, {'agent_id': 'agent_id_for_agent1', 'obs': empty_array}, ...]
         """
-        local_obs = self.env.reset()
+        local_obs = _reset_obs(self.env.reset(**(gym_reset_kwargs or {})))
+        # the obs of all agents per env, fetched when needed by _joint_step
+        self._joint_obs: List[Optional[List[Dict]]] = [None] * self.maenv_num
 
         self._ready_env_ids = np.array(
             [
@@ -88,6 +103,99 @@ class MACollector(Collector):
             )
         self.data.obs = obs
 
+    def _choose_act(
+        self, ready_env_ids: np.ndarray, random: bool, no_grad: bool
+    ) -> None:
+        """Choose the actions of self.data, the data of ready_env_ids."""
+        # restore the state: if the last state is None, it won't store
+        last_state = self.data.policy.pop("hidden_state", None)
+        if random:
+            try:
+                act_sample = [
+                    self._action_space[i % self.maenv_num].sample()
+                    for i in ready_env_ids
+                ]
+            except TypeError:  # envpool's action space is not for per-env
+                act_sample = [self._action_space.sample() for _ in ready_env_ids]
+            act_sample = self.policy.map_action_inverse(act_sample)  # type: ignore
+            self.data.update(act=act_sample)
+        else:
+            if no_grad:
+                with torch.no_grad():  # faster than retain_grad version
+                    # self.data.obs will be used by agent to get result
+                    result = self.policy(self.data, last_state)
+            else:
+                result = self.policy(self.data, last_state)
+            # update state / act / policy into self.data
+            policy = result.get("policy", Batch())
+            assert isinstance(policy, Batch)
+            state = result.get("state", None)
+            if state is not None:
+                policy.hidden_state = state  # save state into buffer
+            act = to_numpy(result.act)
+            if self.exploration_noise:
+                act = self.policy.exploration_noise(act, self.data)
+            self.data.update(policy=policy, act=act)
+
+    def _joint_step(
+        self,
+        whole_data: Batch,
+        ready_env_ids: np.ndarray,
+        random: bool,
+        no_grad: bool,
+    ) -> List[Tuple[Batch, Tuple]]:
+        """Choose the actions of all agents from their obs at the start of the
+        round, then step all turns of the envs with a single joint_step.
+
+        :return List[Tuple[Batch, Tuple]]: per turn, the data with the chosen
+            act and policy, and the returns of step for that turn
+        """
+        env_ids = ready_env_ids % self.maenv_num
+        if not np.array_equal(env_ids, ready_env_ids):
+            raise ValueError(
+                "joint_step needs every round to start with the first agent, "
+                "collect with joint_step=False for this env."
+            )
+        unknown = [i for i in env_ids if self._joint_obs[i] is None]
+        if unknown:  # at the start of an episode
+            for i, joint_obs in zip(
+                unknown, self.env.get_env_attr("joint_obs", unknown)
+            ):
+                self._joint_obs[i] = joint_obs
+        turn_data = []
+        for agent_i in range(self.agent_num):
+            agent_env_ids = agent_i * self.maenv_num + env_ids
+            self.data = whole_data[agent_env_ids]
+            obs = np.array([self._joint_obs[i][agent_i] for i in env_ids], dtype=object)
+            if self.preprocess_fn:
+                obs = self.preprocess_fn(obs=obs, env_id=agent_env_ids).get("obs", obs)
+            self.data.obs = obs
+            self._choose_act(agent_env_ids, random, no_grad)
+            turn_data.append(self.data)
+        actions = np.stack([self.policy.map_action(d.act) for d in turn_data], 1)
+        obs, rew, *flags, info = self.env.joint_step(actions, env_ids)  # type: ignore
+        turns_stepped = [i["turns"] for i in info]
+        if min(turns_stepped) < self.agent_num:
+            raise ValueError(
+                f"An episode ended after {min(turns_stepped)} of the "
+                f"{self.agent_num} turns of a round, but joint_step needs the "
+                "episodes to end with a round. Collect with joint_step=False "
+                "for this env."
+            )
+        turns = []
+        for turn, data in enumerate(turn_data):
+            turn_info = np.array([i["turn_infos"][turn] for i in info], dtype=object)
+            for i, env_info in zip(env_ids, turn_info):
+                env_info["env_id"] = env_info["env_id"] * self.maenv_num + i
+            result = (obs[:, turn], rew[:, turn], *[f[:, turn] for f in flags])
+            turns.append((data, (*result, turn_info)))
+        done = np.logical_or.reduce([f[:, -1] for f in flags])
+        for i, env_done, env_info in zip(env_ids, done, info):
+            # to be reset by collect, unless reset in the env already
+            reset = env_done and not self._autoreset
+            self._joint_obs[i] = None if reset else env_info["joint_obs"]
+        return turns
+
     def collect(
         self,
         n_step: Optional[int] = None,
@@ -95,6 +203,8 @@ class MACollector(Collector):
         random: bool = False,
         render: Optional[float] = None,
         no_grad: bool = True,
+        gym_reset_kwargs: Optional[Dict[str, Any]] = None,
+        recorder: Optional[FrameRecorder] = None,
     ) -> Dict[str, Any]:
         # collect at least n_step or n_episode
         if n_step is not None:
@@ -111,7 +221,14 @@ class MACollector(Collector):
                 "in AsyncCollector.collect()."
             )
 
+        if self._autoreset and (gym_reset_kwargs or {}) != self._reset_kwargs:
+            # the envs are reset in the workers, which need the kwargs
+            self._reset_kwargs = dict(gym_reset_kwargs or {})
+            self.env.set_env_attr("reset_kwargs", self._reset_kwargs)
+
         ready_env_ids = self._ready_env_ids
+        # the frames dropped by the recorder in this call
+        dropped = 0 if recorder is None else recorder.dropped
 
         start_time = time.time()
 
@@ -130,48 +247,34 @@ class MACollector(Collector):
             # pprint(self.data)
 
             assert len(whole_data) == self.env_num  # major difference
-            # restore the state: if the last state is None, it won't store
+            if self.joint_step:
+                turns = self._joint_step(whole_data, ready_env_ids, random, no_grad)
             for agent_i in range(self.agent_num):
                 self.data = whole_data[ready_env_ids]
-                last_state = self.data.policy.pop("hidden_state", None)
-                # get the next action
-                if random:
-                    try:
-                        act_sample = [
-                            self._action_space[i % self.maenv_num].sample()
-                            for i in ready_env_ids
-                        ]
-                    except TypeError:  # envpool's action space is not for per-env
-                        act_sample = [
-                            self._action_space.sample() for _ in ready_env_ids
-                        ]
-                    act_sample = self.policy.map_action_inverse(
-                        act_sample
-                    )  # type: ignore
-                    self.data.update(act=act_sample)
+                if self.joint_step:
+                    # chosen at the start of the round, and stored with the
+                    # obs they were chosen on
+                    data, result = turns[agent_i]
+                    self.data.update(obs=data.obs, act=data.act, policy=data.policy)
+                    whole_data.obs[ready_env_ids] = data.obs
                 else:
-                    if no_grad:
-                        with torch.no_grad():  # faster than retain_grad version
-                            # self.data.obs will be used by agent to get result
-                            result = self.policy(self.data, last_state)
-                    else:
-                        result = self.policy(self.data, last_state)
-                    # update state / act / policy into self.data
-                    policy = result.get("policy", Batch())
-                    assert isinstance(policy, Batch)
-                    state = result.get("state", None)
-                    if state is not None:
-                        policy.hidden_state = state  # save state into buffer
-                    act = to_numpy(result.act)
-                    if self.exploration_noise:
-                        act = self.policy.exploration_noise(act, self.data)
-                    self.data.update(policy=policy, act=act)
-
-                # get bounded and remapped actions first (not saved into buffer)
-                action_remap = self.policy.map_action(self.data.act)
-                # step in env
-                result = self.env.step(action_remap, ready_env_ids)  # type: ignore
-                obs_next, rew, done, info = result
+                    self._choose_act(ready_env_ids, random, no_grad)
+                    # get bounded and remapped actions first (not saved into buffer)
+                    action_remap = self.policy.map_action(self.data.act)
+                    # step in env
+                    result = self.env.step(action_remap, ready_env_ids)  # type: ignore
+                if len(result) == 5:
+                    obs_next, rew, terminated, truncated, info = result
+                    done = np.logical_or(terminated, truncated)
+                else:  # the old step API, which cannot tell truncation
+                    obs_next, rew, done, info = result
+                    terminated, truncated = done, np.zeros_like(done)
+                # the first rewards of an episode may be ints, which would give
+                # the buffer an int dtype
+                rew = np.asarray(rew, dtype=float)
+                if self._autoreset:
+                    # not to be stored in the buffer
+                    reset_obs = [i.pop("reset_obs", None) for i in info]
 
                 _rew = np.take_along_axis(
                     rew, np.expand_dims(ready_env_ids, -1) // self.maenv_num, -1
@@ -179,7 +282,14 @@ class MACollector(Collector):
 
                 rew = np.array(rew).transpose(1, 0).reshape(-1)
 
-                self.data.update(obs_next=obs_next, done=done, info=info, rew=_rew)
+                self.data.update(
+                    obs_next=obs_next,
+                    done=done,
+                    terminated=terminated,
+                    truncated=truncated,
+                    info=info,
+                    rew=_rew,
+                )
 
                 if self.preprocess_fn:
                     self.data.update(
@@ -193,7 +303,11 @@ class MACollector(Collector):
                     )
                     rew = self.preprocess_fn(rew=rew, env_id=ready_env_ids)
 
-                if render:
+                if recorder is not None:
+                    # written in the background, hence no sleep
+                    if recorder.due():
+                        recorder.record(self.env.render())
+                elif render:
                     self.env.render()
                     if render > 0 and not np.isclose(render, 0):
                         time.sleep(render)
@@ -203,11 +317,13 @@ class MACollector(Collector):
                     whole_data.policy[ready_env_ids] = self.data.policy
                     whole_data.obs_next[ready_env_ids] = self.data.obs_next
                     whole_data.done[ready_env_ids] = self.data.done
+                    whole_data.terminated[ready_env_ids] = self.data.terminated
+                    whole_data.truncated[ready_env_ids] = self.data.truncated
                     whole_data.info[ready_env_ids] = self.data.info
 
                     whole_data.rew = rew
 
-                except ValueError:
+                except (ValueError, AttributeError):  # new keys
                     _alloc_by_keys_diff(whole_data, self.data, self.env_num, False)
                     whole_data[ready_env_ids] = self.data  # lots of overhead
 
@@ -238,7 +354,16 @@ class MACollector(Collector):
                     episode_start_indices.append(ep_idx)
                     # now we copy obs_next to obs, but since there might be
                     # finished episodes, we have to reset finished envs first.
-                    obs_reset = self.env.reset(env_ind_global)
+                    if self._autoreset:
+                        obs_reset = [reset_obs[i] for i in env_ind_local]
+                        try:
+                            obs_reset = np.stack(obs_reset)
+                        except ValueError:  # different len(obs)
+                            obs_reset = np.array(obs_reset, dtype=object)
+                    else:
+                        obs_reset = _reset_obs(
+                            self.env.reset(env_ind_global, **(gym_reset_kwargs or {}))
+                        )
                     if self.preprocess_fn:
                         obs_reset = self.preprocess_fn(
                             obs=obs_reset, env_id=env_ind_global
@@ -297,7 +422,7 @@ class MACollector(Collector):
             rews, lens, idxs = np.array([]), np.array([], int), np.array([], int)
             rew_mean = rew_std = len_mean = len_std = 0
 
-        return {
+        stats = {
             "n/ep": episode_count,
             "n/st": step_count,
             "rews": rews,
@@ -308,3 +433,13 @@ class MACollector(Collector):
             "rew_std": rew_std,
             "len_std": len_std,
         }
+        if recorder is not None:
+            stats["n/dropped"] = recorder.dropped - dropped
+        return stats
+
+
+def _reset_obs(ret: Any) -> Any:
+    """The obs returned by reset, which may return (obs, info)."""
+    if isinstance(ret, tuple) and len(ret) == 2:
+        return ret[0]
+    return ret
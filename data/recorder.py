@@ -0,0 +1,155 @@
+import os
+import queue
+import threading
+import warnings
+from typing import Any, List, Optional
+
+import numpy as np
+
+_STOP = object()
+
+
+class FrameRecorder:
+    """Write rendered frames to disk from a background thread.
+
+    :meth:`record` only puts the frames into a bounded queue, and a writer
+    thread saves them, so recording costs the collection loop no more than
+    the call to render. When the writer falls behind and the queue is full,
+    the new frames are dropped (counted in ``dropped``) unless ``block`` is
+    set, so that the collection speed never depends on the disk. The first
+    dropped frame raises a warning.
+
+    Rendering itself runs in the collection loop, so ``every`` limits it to
+    one step out of ``every``: the caller asks :meth:`due` before rendering.
+
+    With ``fmt="npz"`` the frames are saved in chunks of ``chunk_size`` steps
+    as ``frames_<chunk>.npz``, each holding a ``frames`` array of shape
+    ``(steps, envs, *frame_shape)``. With ``fmt="png"`` every frame is saved
+    as ``frame_<step>_<env>.png``, which requires Pillow.
+
+    :param str path: the directory to write the frames to
+    :param str fmt: "npz" or "png", defaults to "npz"
+    :param int max_queue: the maximum number of steps waiting to be written,
+        defaults to 64
+    :param int chunk_size: the number of steps per npz file, defaults to 256
+    :param bool block: whether to wait for the writer instead of dropping
+        frames when the queue is full, defaults to False
+    :param int every: record the frames of one step out of every, defaults
+        to 1
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fmt: str = "npz",
+        max_queue: int = 64,
+        chunk_size: int = 256,
+        block: bool = False,
+        every: int = 1,
+    ) -> None:
+        assert fmt in ["npz", "png"], f"Unknown frame format {fmt}."
+        assert max_queue > 0 and chunk_size > 0 and every > 0
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.block = block
+        self.every = every
+        self.steps = 0
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self._queue: queue.Queue = queue.Queue(max_queue)
+        self._chunk: List[np.ndarray] = []
+        self._chunk_id = 0
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self.is_closed = False
+
+    def due(self) -> bool:
+        """Count a step, and tell whether its frames are to be rendered and
+        recorded, i.e. for one step out of ``every``."""
+        self.steps += 1
+        return (self.steps - 1) % self.every == 0
+
+    def record(self, frames: Any) -> bool:
+        """Queue the frames of one step, i.e. the return of ``env.render()``.
+
+        The envs that do not render a frame (None) are skipped.
+
+        :return: whether the frames have been queued
+        """
+        assert not self.is_closed, "The recorder has been closed."
+        if self._error is not None:
+            raise self._error
+        if not isinstance(frames, (list, tuple)):
+            frames = [frames]
+        frames = [np.asarray(f) for f in frames if f is not None]
+        if len(frames) == 0:
+            return False
+        try:
+            self._queue.put(frames, block=self.block)
+        except queue.Full:
+            if self.dropped == 0:
+                warnings.warn(
+                    f"The frame writer of {self.path} falls behind, frames are "
+                    "dropped. Record fewer frames with every, or set block."
+                )
+            self.dropped += 1
+            return False
+        self.recorded += 1
+        return True
+
+    def close(self) -> None:
+        """Write the queued frames and stop the writer thread."""
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self) -> "FrameRecorder":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def _run(self) -> None:
+        stopped = False
+        try:
+            while True:
+                frames = self._queue.get()
+                if frames is _STOP:
+                    stopped = True
+                    break
+                self._write(frames)
+            self._flush()
+        except BaseException as e:  # raised in the collection thread
+            self._error = e
+            # keep draining so that a blocking record never hangs
+            while not stopped and self._queue.get() is not _STOP:
+                pass
+
+    def _write(self, frames: List[np.ndarray]) -> None:
+        if self.fmt == "png":
+            from PIL import Image
+
+            for env_i, frame in enumerate(frames):
+                name = f"frame_{self.written:06d}_{env_i}.png"
+                Image.fromarray(frame).save(os.path.join(self.path, name))
+        else:
+            self._chunk.append(np.stack(frames))
+            if len(self._chunk) == self.chunk_size:
+                self._flush()
+        self.written += 1
+
+    def _flush(self) -> None:
+        if len(self._chunk) == 0:
+            return
+        name = f"frames_{self._chunk_id:04d}.npz"
+        np.savez_compressed(os.path.join(self.path, name), frames=np.stack(self._chunk))
+        self._chunk = []
+        self._chunk_id += 1
@@ -1,4 +1,21 @@
-from marl_comm.env.ma_env import (MAEnvWrapper, get_MA_VectorEnv,
-                                  get_MA_VectorEnv_cls)
+from typing import TYPE_CHECKING
 
-__all__ = ["MAEnvWrapper", "get_MA_VectorEnv_cls", "get_MA_VectorEnv"]
+from marl_comm.utils.lazy import lazy_attributes
+
+if TYPE_CHECKING:
+    from marl_comm.env.batched_venv import BatchedSubprocVectorEnv
+    from marl_comm.env.ma_env import (MAEnvWrapper, get_MA_VectorEnv,
+                                      get_MA_VectorEnv_cls)
+
+__all__ = [
+    "MAEnvWrapper", "get_MA_VectorEnv_cls", "get_MA_VectorEnv",
+    "BatchedSubprocVectorEnv"
+]
+
+__getattr__, __dir__ = lazy_attributes(
+    __name__, {
+        "MAEnvWrapper": "marl_comm.env.ma_env",
+        "get_MA_VectorEnv_cls": "marl_comm.env.ma_env",
+        "get_MA_VectorEnv": "marl_comm.env.ma_env",
+        "BatchedSubprocVectorEnv": "marl_comm.env.batched_venv",
+    })
@@ -0,0 +1,273 @@
+import multiprocessing
+import time
+from collections import defaultdict
+from multiprocessing.connection import Connection, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+import gym
+import numpy as np
+from tianshou.env import BaseVectorEnv
+from tianshou.env.utils import CloudpickleWrapper
+
+from marl_comm.utils.latency import LatencyHistogram
+
+
+def _batched_worker(
+    parent: Connection, p: Connection, env_fn_wrappers: List[CloudpickleWrapper]
+) -> None:
+    """Host a slice of envs and run the commands on all of them.
+
+    Every command carries the local indices of the envs to run it on, and
+    the results of the whole slice are sent back as a single message.
+    """
+    parent.close()
+    envs = [fn.data() for fn in env_fn_wrappers]
+    try:
+        while True:
+            try:
+                cmd, indices, data = p.recv()
+            except EOFError:  # the pipe has been closed
+                p.close()
+                break
+            if cmd == "step":
+                p.send([envs[i].step(a) for i, a in zip(indices, data)])
+            elif cmd == "reset":
+                p.send([envs[i].reset(**data) for i in indices])
+            elif cmd == "getattr":
+                p.send([getattr(envs[i], data, None) for i in indices])
+            elif cmd == "setattr":
+                p.send([setattr(envs[i], *kv) for i, kv in zip(indices, data)])
+            elif cmd == "seed":
+                p.send([_seed(envs[i], s) for i, s in zip(indices, data)])
+            elif cmd == "render":
+                p.send([envs[i].render(**data) for i in indices])
+            elif cmd == "close":
+                p.send([env.close() for env in envs])
+                p.close()
+                break
+            else:
+                p.close()
+                raise NotImplementedError
+    except KeyboardInterrupt:
+        p.close()
+
+
+def _seed(env: gym.Env, seed: Optional[int]) -> Optional[List[int]]:
+    if hasattr(env, "seed"):
+        return env.seed(seed)
+    env.reset(seed=seed)
+    return [seed]
+
+
+class BatchedSubprocVectorEnv(BaseVectorEnv):
+    """Vectorized env where each subprocess hosts a slice of the envs.
+
+    :class:`~tianshou.env.SubprocVectorEnv` runs one env per process, so for
+    cheap envs like the dilemma games the IPC costs far more than the step.
+    Here a worker steps all the envs of its slice in a loop, and each call
+    costs one round trip per worker instead of one per env. The layout and the
+    returns are the same as :class:`~tianshou.env.SubprocVectorEnv`, so it can
+    be used as ``get_MA_VectorEnv(BatchedSubprocVectorEnv, env_fns,
+    envs_per_worker=64)``.
+
+    :param List[Callable[[], gym.Env]] env_fns: the env constructors
+    :param int envs_per_worker: the number of envs hosted by each subprocess,
+        defaults to 1
+    :param Optional[str] context: the multiprocessing start method, defaults to
+        the platform default
+
+    With ``record_latency`` set, each call records the round trip of every
+    worker, from the send of the command to the receipt of its results, in
+    ``worker_latency[w][cmd]``.
+    """
+
+    record_latency = False
+
+    def __init__(
+        self,
+        env_fns: List[Callable[[], gym.Env]],
+        envs_per_worker: int = 1,
+        context: Optional[str] = None,
+    ) -> None:
+        # no EnvWorker per env, hence no call to BaseVectorEnv.__init__
+        assert envs_per_worker >= 1
+        self._env_fns = env_fns
+        self.env_num = len(env_fns)
+        self.envs_per_worker = envs_per_worker
+        self.wait_num = self.env_num
+        self.timeout = None
+        self.is_async = False
+        self.waiting_conn: List[Connection] = []
+        self.waiting_id: List[int] = []
+        self.ready_id = list(range(self.env_num))
+
+        ctx = multiprocessing.get_context(context)
+        self.parent_remotes: List[Connection] = []
+        self.processes = []
+        for start in range(0, self.env_num, envs_per_worker):
+            parent_remote, child_remote = ctx.Pipe()
+            fns = [
+                CloudpickleWrapper(fn)
+                for fn in env_fns[start : start + envs_per_worker]
+            ]
+            process = ctx.Process(
+                target=_batched_worker,
+                args=(parent_remote, child_remote, fns),
+                daemon=True,
+            )
+            process.start()
+            child_remote.close()
+            self.parent_remotes.append(parent_remote)
+            self.processes.append(process)
+        self.worker_num = len(self.processes)
+        self.worker_latency: List[Dict[str, LatencyHistogram]] = [
+            defaultdict(LatencyHistogram) for _ in range(self.worker_num)
+        ]
+        self.is_closed = False
+
+    def _call(
+        self,
+        cmd: str,
+        id: Union[List[int], np.ndarray],
+        data: Optional[List[Any]] = None,
+        common: Any = None,
+    ) -> List[Any]:
+        """Run a command on the given envs with one message per worker.
+
+        :param str cmd: the command
+        :param id: the envs to run the command on
+        :param data: the per-env arguments, in the order of id
+        :param common: the argument shared by all envs
+        :return: the per-env results, in the order of id
+        """
+        id = np.asarray(id, dtype=int)
+        workers = id // self.envs_per_worker
+        # the positions in id of the envs hosted by each worker
+        slices: Dict[int, np.ndarray] = {}
+        sent: Dict[int, float] = {}
+        for w in np.unique(workers):
+            positions = np.nonzero(workers == w)[0]
+            slices[w] = positions
+            indices = (id[positions] % self.envs_per_worker).tolist()
+            payload = common if data is None else [data[i] for i in positions]
+            sent[w] = time.perf_counter()
+            self.parent_remotes[w].send((cmd, indices, payload))
+        results: List[Any] = [None] * len(id)
+        if not self.record_latency:
+            for w, positions in slices.items():
+                for i, result in zip(positions, self.parent_remotes[w].recv()):
+                    results[i] = result
+            return results
+        # receive in order of arrival, so that a straggler does not add its
+        # delay to the round trips of the workers after it
+        pending = {self.parent_remotes[w]: w for w in slices}
+        while pending:
+            for remote in wait(list(pending)):
+                w = pending.pop(remote)
+                for i, result in zip(slices[w], remote.recv()):
+                    results[i] = result
+                self.worker_latency[w][cmd].record(time.perf_counter() - sent[w])
+        return results
+
+    def get_env_attr(
+        self,
+        key: str,
+        id: Optional[Union[int, List[int], np.ndarray]] = None,
+    ) -> List[Any]:
+        self._assert_is_not_closed()
+        return self._call("getattr", self._wrap_id(id), common=key)
+
+    def set_env_attr(
+        self,
+        key: str,
+        value: Any,
+        id: Optional[Union[int, List[int], np.ndarray]] = None,
+    ) -> None:
+        self.set_env_attrs(key, [value] * len(self._wrap_id(id)), id)
+
+    def set_env_attrs(
+        self,
+        key: str,
+        values: List[Any],
+        id: Optional[Union[int, List[int], np.ndarray]] = None,
+    ) -> None:
+        """Set an attribute to a different value in each env, with one
+        message per worker.
+
+        :param str key: the attribute
+        :param List[Any] values: the value of each env, in the order of id
+        :param id: the envs, defaults to all envs
+        """
+        self._assert_is_not_closed()
+        id = self._wrap_id(id)
+        assert len(values) == len(id)
+        self._call("setattr", id, data=[(key, value) for value in values])
+
+    def reset(
+        self,
+        id: Optional[Union[int, List[int], np.ndarray]] = None,
+        **kwargs: Any,
+    ) -> Union[np.ndarray, Tuple[np.ndarray, List[dict]]]:
+        self._assert_is_not_closed()
+        ret_list = self._call("reset", self._wrap_id(id), common=kwargs)
+        reset_returns_info = (
+            isinstance(ret_list[0], (tuple, list))
+            and len(ret_list[0]) == 2
+            and isinstance(ret_list[0][1], dict)
+        )
+        if reset_returns_info:
+            return _stack([r[0] for r in ret_list]), [r[1] for r in ret_list]
+        return _stack(ret_list)
+
+    def step(
+        self,
+        action: np.ndarray,
+        id: Optional[Union[int, List[int], np.ndarray]] = None,
+    ) -> Tuple[np.ndarray, ...]:
+        self._assert_is_not_closed()
+        id = self._wrap_id(id)
+        assert len(action) == len(id)
+        result = self._call("step", id, data=list(action))
+        for j, env_return in zip(id, result):
+            env_return[-1]["env_id"] = j
+        return_lists = tuple(zip(*result))
+        return (_stack(return_lists[0]), *map(np.stack, return_lists[1:]))
+
+    def seed(
+        self,
+        seed: Optional[Union[int, List[int]]] = None,
+    ) -> List[Optional[List[int]]]:
+        self._assert_is_not_closed()
+        seed_list: Union[List[None], List[int]]
+        if seed is None:
+            seed_list = [seed] * self.env_num
+        elif isinstance(seed, int):
+            seed_list = [seed + i for i in range(self.env_num)]
+        else:
+            seed_list = seed
+        return self._call("seed", list(range(self.env_num)), data=seed_list)
+
+    def render(self, **kwargs: Any) -> List[Any]:
+        self._assert_is_not_closed()
+        return self._call("render", list(range(self.env_num)), common=kwargs)
+
+    def close(self) -> None:
+        if self.is_closed:
+            return
+        for remote in self.parent_remotes:
+            remote.send(("close", None, None))
+        for remote in self.parent_remotes:
+            try:
+                remote.recv()
+            except (BrokenPipeError, EOFError):
+                pass
+        for process in self.processes:
+            process.join()
+        self.is_closed = True
+
+
+def _stack(obs_list: List[Any]) -> np.ndarray:
+    try:
+        return np.stack(obs_list)
+    except ValueError:  # different len(obs)
+        return np.array(obs_list, dtype=object)
@@ -1,31 +1,194 @@
-from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
+import copy
+import json
+import time
+from collections import defaultdict
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Type, Union
 
 import gym
 import numpy as np
+from pettingzoo.utils.env import AECEnv
 from tianshou.env import BaseVectorEnv, PettingZooEnv
+from tianshou.env.worker import EnvWorker
+
+from marl_comm.utils.latency import LatencyHistogram
+
+
+class JointAction:
+    """The actions of all agents, in turn order, for one joint step of an env,
+    see ma_venv_joint_step."""
+
+    def __init__(self, actions: Sequence[Any]) -> None:
+        self.actions = list(actions)
 
 
 class MAEnvWrapper(PettingZooEnv):
     """wrap pettingzoo env to act as dummy env"""
 
+    # reset at the end of an episode in step, see get_MA_VectorEnv
+    autoreset = False
+    # the kwargs of the reset of autoreset, see MACollector.collect
+    reset_kwargs: Dict[str, Any] = {}
+    # applied to the agent obs before it is returned, see get_MA_VectorEnv
+    obs_preprocess_fn: Optional[Callable[[Any], Any]] = None
+    # record the latencies of step per agent and of reset, see get_MA_VectorEnv
+    record_latency = False
+
+    def __init__(self, env: AECEnv) -> None:
+        super().__init__(env)
+        # e.g. {"step/player_0": LatencyHistogram, "reset": LatencyHistogram}
+        self.latency: Dict[str, LatencyHistogram] = {}
+
     def step(self, action: Any) -> Tuple[Dict, List[int], bool, Dict]:
         """
         :param Any action:
         :return Tuple[Dict, List[int], bool, Dict]
 
-        Append env_id to the returned info.
+        Append env_id to the returned info. With autoreset, the env is reset
+        when the episode ends, and the first obs of the next episode is
+        appended to the returned info as reset_obs.
+
+        A JointAction steps the turns of all agents at once, see _joint_step.
         """
+        if isinstance(action, JointAction):
+            return self._joint_step(action.actions)
+        if not self.record_latency:
+            return self._step(action)
+        key = "step/" + self.env.agent_selection
+        start = time.perf_counter()
+        ret = self._step(action)
+        self._record(key, time.perf_counter() - start)
+        return ret
+
+    def _step(self, action: Any) -> Tuple[Dict, List[int], bool, Dict]:
         x = super().step(action)
         if len(x) == 4:
-            obs, rew, done, info = super().step(action)
+            obs, rew, done, info = x
+            obs = self._preprocess(obs)
             info["env_id"] = self.agent_idx[obs["agent_id"]]
+            if self.autoreset and done:
+                info["reset_obs"] = self._reset_obs()
             return obs, rew, done, info
 
         elif len(x) == 5:
-            obs, rew, term, trunc, info = super().step(action)
+            obs, rew, term, trunc, info = x
+            obs = self._preprocess(obs)
             info["env_id"] = self.agent_idx[obs["agent_id"]]
+            if self.autoreset and (term or trunc):
+                info["reset_obs"] = self._reset_obs()
             return obs, rew, term, trunc, info
 
+    def _joint_step(self, actions: List[Any]) -> Tuple:
+        """Step the turns of all agents in a row, so that a worker advances one
+        full joint step per IPC exchange.
+
+        :param List[Any] actions: the actions of all agents in turn order
+        :return Tuple: the per-turn (obs, rew, done, info) or (obs, rew, term,
+            trunc, info) of step stacked over the turns, except for a single
+            info with the number of turns stepped in "turns", the per-turn
+            infos in "turn_infos" and the obs of every agent after the joint
+            step in "joint_obs". When the episode ends before the last turn,
+            the remaining actions are dropped and the last turn is repeated
+            with zero rewards.
+        """
+        assert len(actions) == self.num_agents
+        turns: List[List[Any]] = []
+        for action in actions:
+            obs, rew, *flags, info = self.step(action)
+            # the rewards list is reused by step
+            turns.append([obs, list(rew), *flags, info])
+            if any(flags):
+                break
+        infos = [turn.pop() for turn in turns]
+        num_turns = len(turns)
+        last = turns[-1]
+        turns += [[last[0], [0] * len(last[1]), *last[2:]]] * (
+            self.num_agents - num_turns
+        )
+        info = {
+            "turns": num_turns,
+            "turn_infos": infos,
+            "joint_obs": self.joint_obs,
+        }
+        if "reset_obs" in infos[-1]:
+            info["reset_obs"] = infos[-1]["reset_obs"]
+        return (*map(list, zip(*turns)), info)
+
+    @property
+    def joint_obs(self) -> List[Dict]:
+        """The obs of every agent in the format of step."""
+        return [self._agent_obs(agent) for agent in self.agents]
+
+    def _agent_obs(self, agent: str) -> Dict:
+        """The obs of an agent in the format of step."""
+        observation = self.env.observe(agent)
+        if isinstance(observation, dict) and "action_mask" in observation:
+            obs = {
+                "agent_id": agent,
+                "obs": observation["observation"],
+                "mask": [obm == 1 for obm in observation["action_mask"]],
+            }
+        elif isinstance(self.action_space, gym.spaces.Discrete):
+            obs = {
+                "agent_id": agent,
+                "obs": observation,
+                "mask": [True] * self.env.action_space(agent).n,
+            }
+        else:
+            obs = {"agent_id": agent, "obs": observation}
+        return self._preprocess(obs)
+
+    def reset(self, *args: Any, **kwargs: Any) -> Union[Dict, Tuple[Dict, Dict]]:
+        start = time.perf_counter()
+        ret = super().reset(*args, **kwargs)
+        if self.record_latency:
+            self._record("reset", time.perf_counter() - start)
+        # reset may return (obs, info)
+        if isinstance(ret, tuple):
+            return (self._preprocess(ret[0]), *ret[1:])
+        return self._preprocess(ret)
+
+    def _record(self, key: str, seconds: float) -> None:
+        if key not in self.latency:
+            self.latency[key] = LatencyHistogram()
+        self.latency[key].record(seconds)
+
+    def _preprocess(self, obs: Dict) -> Dict:
+        if self.obs_preprocess_fn is None:
+            return obs
+        obs = dict(obs)
+        obs["obs"] = self.obs_preprocess_fn(obs["obs"])
+        return obs
+
+    def _reset_obs(self) -> Dict:
+        obs = self.reset(**self.reset_kwargs)
+        # reset may return (obs, info)
+        return obs[0] if isinstance(obs, tuple) else obs
+
+    def snapshot(self) -> Any:
+        """Take a copy of the env state, to be restored with restore.
+
+        The env may implement a compact snapshot and restore itself, as
+        dilemma_pettingzoo.raw_env does, otherwise the whole env is deep
+        copied, which is much slower.
+        """
+        raw_env = self.env.unwrapped
+        if hasattr(raw_env, "snapshot") and hasattr(raw_env, "restore"):
+            return raw_env.snapshot()
+        return copy.deepcopy(self.env)
+
+    def restore(self, snapshot: Any) -> None:
+        """Restore a state taken with snapshot, which can be restored any
+        number of times, e.g. to branch an episode."""
+        raw_env = self.env.unwrapped
+        if hasattr(raw_env, "snapshot") and hasattr(raw_env, "restore"):
+            raw_env.restore(snapshot)
+        else:
+            self.env = copy.deepcopy(snapshot)
+
+    # snapshot and restore as an attribute, see ma_venv_snapshot
+    env_state = property(snapshot, restore)
+
     def __len__(self) -> int:
         return self.num_agents
 
@@ -40,6 +203,9 @@ def ma_venv_init(
     self: BaseVectorEnv,
     p_cls: Type[BaseVectorEnv],
     env_fns: List[Callable[[], gym.Env]],
+    autoreset: bool = False,
+    obs_preprocess_fn: Optional[Callable[[Any], Any]] = None,
+    record_latency: bool = False,
     **kwargs: Any
 ) -> None:
     """add agents relevant attrs
@@ -47,10 +213,31 @@ def ma_venv_init(
     :param BaseVectorEnv self
     :param Type[BaseVectorEnv] p_cls
     :param List[Callable[[], gym.Env]] env_fns
+    :param bool autoreset: reset the envs in the workers at the end of an
+        episode, and return the first obs of the next episode as
+        info["reset_obs"] of the last step, defaults to False
+    :param Optional[Callable[[Any], Any]] obs_preprocess_fn: transform the obs
+        of the agents, e.g. frame scaling, inside the workers before it is
+        sent to the main process, defaults to None
+    :param bool record_latency: record the latencies of step per agent and of
+        reset in each env, see ma_venv_latency_stats, and the round trips of
+        the commands to each worker, see ma_venv_worker_latency_stats,
+        defaults to False
     """
+    if obs_preprocess_fn is not None:
+        # shipped to the workers along with the env constructors
+        env_fns = [
+            partial(_make_preprocessed_env, fn, obs_preprocess_fn) for fn in env_fns
+        ]
     p_cls.__init__(self, env_fns, **kwargs)
 
     self.p_cls = p_cls
+    self.autoreset = autoreset
+    if autoreset:
+        self.set_env_attr("autoreset", True)
+    if record_latency:
+        self.set_env_attr("record_latency", True)
+        _record_worker_latency(self)
 
     agents = self.get_env_attr("agents", [0])[0]
     agent_idx = self.get_env_attr("agent_idx", [0])[0]
@@ -60,6 +247,138 @@ def ma_venv_init(
     self.agent_num = len(agent_idx)
 
 
+def _make_preprocessed_env(
+    env_fn: Callable[[], gym.Env], obs_preprocess_fn: Callable[[Any], Any]
+) -> gym.Env:
+    env = env_fn()
+    env.obs_preprocess_fn = obs_preprocess_fn
+    return env
+
+
+def ma_venv_latency_stats(
+    self: BaseVectorEnv,
+    id: Optional[Union[int, List[int], np.ndarray]] = None,
+) -> List[Dict[str, LatencyHistogram]]:
+    """Query the latencies recorded with record_latency.
+
+    :param BaseVectorEnv self
+    :param Optional[Union[int, List[int], np.ndarray]] id: the envs, defaults
+        to all envs
+    :return List[Dict[str, LatencyHistogram]]: per env, the histograms of
+        "step/<agent_id>" and of "reset", e.g. stats[i]["step/player_0"].mean
+        points out the straggler envs and agent turns
+    """
+    return self.get_env_attr("latency", id)
+
+
+def _record_worker_latency(self: BaseVectorEnv) -> None:
+    if hasattr(self, "worker_latency"):  # e.g. BatchedSubprocVectorEnv
+        self.record_latency = True
+        return
+    self.worker_latency = [defaultdict(LatencyHistogram) for _ in self.workers]
+    for worker, latency in zip(self.workers, self.worker_latency):
+        _time_worker(worker, latency)
+
+
+def _time_worker(worker: EnvWorker, latency: Dict[str, LatencyHistogram]) -> None:
+    """Wrap the send and recv of a tianshou worker to record the round trip of
+    each command into latency["step"] or latency["reset"].
+
+    The sync vector envs receive from the workers in turn, so a round trip
+    also holds the wait on the workers received before.
+    """
+    send, recv = worker.send, worker.recv
+    sent: List[Tuple[str, float]] = []
+
+    def timed_send(action: Optional[np.ndarray], **kwargs: Any) -> None:
+        sent.append(("reset" if action is None else "step", time.perf_counter()))
+        send(action, **kwargs)
+
+    def timed_recv() -> Any:
+        result = recv()
+        cmd, start = sent.pop(0)
+        latency[cmd].record(time.perf_counter() - start)
+        return result
+
+    worker.send, worker.recv = timed_send, timed_recv
+
+
+def ma_venv_worker_latency_stats(
+    self: BaseVectorEnv,
+) -> List[Dict[str, LatencyHistogram]]:
+    """Query the round trips recorded with record_latency, from sending a
+    command to a worker to receiving its results, i.e. the step or reset of
+    its envs plus the pipe transfer and the wait of the main process.
+
+    :param BaseVectorEnv self
+    :return List[Dict[str, LatencyHistogram]]: per worker, the histograms of
+        "step" and of "reset"; the round trip minus the in-env latencies of
+        latency_stats is the IPC overhead
+    """
+    return [dict(latency) for latency in getattr(self, "worker_latency", [])]
+
+
+def ma_venv_dump_latency(self: BaseVectorEnv, path: str) -> None:
+    """Dump the latencies recorded with record_latency to a JSON file.
+
+    :param BaseVectorEnv self
+    :param str path
+    """
+    stats = {
+        name: [
+            {key: hist.to_dict() for key, hist in latency.items()}
+            for latency in latencies
+        ]
+        for name, latencies in [
+            ("envs", ma_venv_latency_stats(self)),
+            ("workers", ma_venv_worker_latency_stats(self)),
+        ]
+    }
+    with open(path, "w") as f:
+        json.dump(stats, f, indent=2)
+
+
+def ma_venv_snapshot(
+    self: BaseVectorEnv,
+    id: Optional[Union[int, List[int], np.ndarray]] = None,
+) -> List[Any]:
+    """Take a copy of the state of the envs, see MAEnvWrapper.snapshot.
+
+    :param BaseVectorEnv self
+    :param Optional[Union[int, List[int], np.ndarray]] id: the envs, defaults
+        to all envs
+    :return List[Any]: the snapshot of each env
+    """
+    if id is not None:
+        id = np.array([id] if np.isscalar(id) else id) % self.env_num
+    return self.get_env_attr("env_state", id)
+
+
+def ma_venv_restore(
+    self: BaseVectorEnv,
+    snapshots: List[Any],
+    id: Optional[Union[int, List[int], np.ndarray]] = None,
+) -> None:
+    """Restore the state of the envs, see MAEnvWrapper.restore.
+
+    :param BaseVectorEnv self
+    :param List[Any] snapshots: the snapshot of each env, in the order of id,
+        the same snapshot can be restored in several envs to branch it
+    :param Optional[Union[int, List[int], np.ndarray]] id: the envs, defaults
+        to all envs
+    """
+    if id is None:
+        id = np.arange(self.env_num)
+    id = np.array([id] if np.isscalar(id) else id) % self.env_num
+    assert len(snapshots) == len(id)
+    if hasattr(self, "set_env_attrs"):  # e.g. BatchedSubprocVectorEnv
+        self.set_env_attrs("env_state", snapshots, id)
+        return
+    # the tianshou workers host a single env, hence one message per worker
+    for snapshot, env_id in zip(snapshots, id):
+        self.set_env_attr("env_state", snapshot, [env_id])
+
+
 def ma_venv_len(self: BaseVectorEnv) -> int:
     """
     :param BaseVectorEnv self
@@ -109,6 +428,37 @@ def ma_venv_step(
         return obs_stack, rew_stack, term_stack, trunc_stack, info_stack
 
 
+def ma_venv_joint_step(
+    self: BaseVectorEnv,
+    actions: np.ndarray,
+    id: Optional[Union[int, List[int], np.ndarray]] = None,
+) -> Tuple[np.ndarray, ...]:
+    """Step the turns of all agents of each env with a single message to the
+    env worker, instead of one step call per agent turn.
+
+    Meant for callers which choose the actions of all agents upfront, e.g. for
+    simultaneous-move games such as the dilemma games, whose agents observe
+    the last joint action, given by info["joint_obs"] of the previous call.
+
+    :param BaseVectorEnv self:
+    :param np.ndarray actions: the actions with shape [len(id), agent_num], in
+        turn order
+    :param Optional[Union[int, List[int], np.ndarray]] id: , defaults to None
+    :return Tuple[np.ndarray, ...]: the returns of step per turn, with the
+        shape [len(id), agent_num] for obs and the flags and [len(id),
+        agent_num, agent_num] for rew, see MAEnvWrapper._joint_step for info,
+        in which env_id is the global id of the next agent to act
+    """
+    if id is not None:
+        id = np.array([id] if np.isscalar(id) else id) % self.env_num
+    x = self.p_cls.step(self, [JointAction(a) for a in actions], id)
+    for info in x[-1]:
+        # the agent index of the next agent to act, set by MAEnvWrapper.step
+        next_agent = info["turn_infos"][-1]["env_id"]
+        info["env_id"] = next_agent * self.env_num + info["env_id"]
+    return x
+
+
 def get_MA_VectorEnv_cls(p_cls: Type[BaseVectorEnv]) -> Type[BaseVectorEnv]:
     """
     Get the class of Multi-Agent VectorEnv.
@@ -121,7 +471,17 @@ def get_MA_VectorEnv_cls(p_cls: Type[BaseVectorEnv]) -> Type[BaseVectorEnv]:
 
     name = "MA" + p_cls.__name__
 
-    attr_dict = {"__init__": init_func, "__len__": ma_venv_len, "step": ma_venv_step}
+    attr_dict = {
+        "__init__": init_func,
+        "__len__": ma_venv_len,
+        "step": ma_venv_step,
+        "joint_step": ma_venv_joint_step,
+        "latency_stats": ma_venv_latency_stats,
+        "worker_latency_stats": ma_venv_worker_latency_stats,
+        "dump_latency": ma_venv_dump_latency,
+        "snapshot": ma_venv_snapshot,
+        "restore": ma_venv_restore,
+    }
 
     return type(name, (p_cls,), attr_dict)
 
@@ -0,0 +1,21 @@
+from typing import TYPE_CHECKING
+
+from marl_comm.utils.lazy import lazy_attributes
+
+if TYPE_CHECKING:
+    from marl_comm.games.dilemma_vector import DilemmaVectorEnv
+    from marl_comm.games.matrix_eval import MatrixGameEvaluator
+    from marl_comm.games.simple_dilemma_games import (MatrixGame,
+                                                      get_game_class)
+
+__all__ = [
+    "DilemmaVectorEnv", "MatrixGame", "MatrixGameEvaluator", "get_game_class"
+]
+
+__getattr__, __dir__ = lazy_attributes(
+    __name__, {
+        "DilemmaVectorEnv": "marl_comm.games.dilemma_vector",
+        "MatrixGame": "marl_comm.games.simple_dilemma_games",
+        "MatrixGameEvaluator": "marl_comm.games.matrix_eval",
+        "get_game_class": "marl_comm.games.simple_dilemma_games",
+    })
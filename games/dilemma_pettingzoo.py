@@ -9,10 +9,8 @@ from gymnasium.spaces import Discrete
 from pettingzoo import AECEnv
 from pettingzoo.utils import agent_selector, wrappers
 from pettingzoo.utils.conversions import parallel_wrapper_fn
-import sys
 
-print("sys.path: ", sys.path)
-from .simple_dilemma_games import get_game_class
+from .simple_dilemma_games import MatrixGame, get_game_class
 
 
 def env(**kwargs):
@@ -37,17 +35,33 @@ class raw_env(AECEnv):
         "is_parallelizable": True,
     }
 
-    def __init__(self, game="pd", num_actions=2, max_cycles=10000, render_mode=None):
+    def __init__(
+        self,
+        game="pd",
+        num_actions=None,
+        max_cycles=10000,
+        render_mode=None,
+        num_players=None,
+    ):
         self.max_cycles = max_cycles
         self.render_mode = "human"
 
-        self.game = get_game_class(game)()
-        self.name = f"simple_{game}_v0"
+        # a game name, or a MatrixGame for a custom payoff tensor
+        if isinstance(game, MatrixGame):
+            self.game = game
+            self.name = f"simple_{type(game).__name__.lower()}_v0"
+        else:
+            game_cls = get_game_class(game)
+            self.game = game_cls() if num_players is None else game_cls(num_players)
+            self.name = f"simple_{game}_v0"
+        if num_actions is None:
+            num_actions = self.game.num_actions
+        assert num_actions == self.game.num_actions
         self._moves = self.game.moves
         # none is last possible action, to satisfy discrete action space
         self._none = self.game.NONE
 
-        self.agents = ["player_" + str(r) for r in range(2)]
+        self.agents = ["player_" + str(r) for r in range(self.game.num_players)]
         self.possible_agents = self.agents[:]
         self.agent_name_mapping = dict(zip(self.agents, list(range(self.num_agents))))
         self.action_spaces = {agent: Discrete(num_actions) for agent in self.agents}
@@ -87,6 +101,51 @@ class raw_env(AECEnv):
 
         self.num_moves = 0
 
+    def snapshot(self):
+        """A compact copy of the game state, to be restored with restore.
+
+        The state is held in a few small tuples, which is much cheaper than
+        copying the env, e.g. to branch a game many times.
+        """
+        return (
+            self._agent_selector._current_agent,
+            self.num_moves,
+            tuple(self.state.values()),
+            tuple(tuple(self.observations[agent]) for agent in self.agents),
+            tuple(self.rewards.values()),
+            tuple(self._cumulative_rewards.values()),
+            tuple(self.terminations.values()),
+            tuple(self.truncations.values()),
+        )
+
+    def restore(self, snapshot):
+        """Restore a game state taken with snapshot, which can be restored any
+        number of times."""
+        (
+            current_agent,
+            self.num_moves,
+            state,
+            observations,
+            rewards,
+            cumulative_rewards,
+            terminations,
+            truncations,
+        ) = snapshot
+        self.agents = self.possible_agents[:]
+        self._agent_selector._current_agent = current_agent
+        self._agent_selector.selected_agent = self.agents[current_agent - 1]
+        self.agent_selection = self._agent_selector.selected_agent
+        self.state = dict(zip(self.agents, state))
+        self.observations = {
+            agent: list(obs) for agent, obs in zip(self.agents, observations)
+        }
+        self.rewards = dict(zip(self.agents, rewards))
+        self._cumulative_rewards = dict(zip(self.agents, cumulative_rewards))
+        self.terminations = dict(zip(self.agents, terminations))
+        self.truncations = dict(zip(self.agents, truncations))
+        self.dones = self.terminations
+        self.infos = {agent: {} for agent in self.agents}
+
     def render(self):
         """
         Renders the environment. In human mode, it can print to terminal, open
@@ -98,10 +157,10 @@ class raw_env(AECEnv):
             )
             return
 
-        if len(self.agents) == 2:
-            string = "Current state: Agent1: {} , Agent2: {}".format(
-                self._moves[self.state[self.agents[0]]],
-                self._moves[self.state[self.agents[1]]],
+        if len(self.agents) == self.num_agents:
+            string = "Current state: " + " , ".join(
+                "Agent{}: {}".format(i + 1, self._moves[self.state[agent]])
+                for i, agent in enumerate(self.agents)
             )
         else:
             string = "Game over"
@@ -132,12 +191,9 @@ class raw_env(AECEnv):
         # collect reward if it is the last agent to act
 
         if self._agent_selector.is_last():
-            (
-                self.rewards[self.agents[0]],
-                self.rewards[self.agents[1]],
-            ) = self.game.payoff[
-                (self.state[self.agents[0]], self.state[self.agents[1]])
-            ]
+            rewards = self.game.get_rewards(list(self.state.values()))
+            for agent_i, reward in zip(self.agents, rewards.tolist()):
+                self.rewards[agent_i] = reward
 
             self.num_moves += 1
             self.truncations = {
@@ -150,7 +206,10 @@ class raw_env(AECEnv):
                     self.state.values()
                 )  # TODO: consider switching the board
         else:
-            self.state[self.agents[1 - self.agent_name_mapping[agent]]] = self._none
+            if self._agent_selector.is_first():
+                # the others have not acted yet in the new round
+                for agent_i in self.agents[1:]:
+                    self.state[agent_i] = self._none
             self._clear_rewards()
 
         self._cumulative_rewards[self.agent_selection] = 0
@@ -0,0 +1,226 @@
+from typing import Any, List, Optional, Tuple, Union
+
+import numpy as np
+from gymnasium.spaces import Discrete
+from tianshou.data import Batch
+from tianshou.env import BaseVectorEnv
+
+from .simple_dilemma_games import MatrixGame, get_game_class
+
+
+class DilemmaVectorEnv(BaseVectorEnv):
+    """N matrix games stepped at once with numpy.
+
+    A drop-in replacement for
+    ``get_MA_VectorEnv(DummyVectorEnv, [lambda: MAEnvWrapper(dilemma_pettingzoo.env()) ...])``:
+    every game follows the turns of ``dilemma_pettingzoo.raw_env``, but the
+    games are held as arrays and stepped with a single lookup into the payoff
+    tensor instead
+    of one AEC env per worker. It implements the multi-agent vector env
+    interface used by :class:`~marl_comm.data.MACollector`, with the layout
+    [(agent0, env0), (agent0, env1), ..., (agent1, env0), ...], i.e. the
+    global id of a game is agent_index * env_num + env_index.
+    """
+
+    def __init__(
+        self,
+        env_num: int,
+        game: Union[str, MatrixGame] = "pd",
+        num_actions: Optional[int] = None,
+        max_cycles: int = 10000,
+        render_mode: Optional[str] = None,
+        num_players: Optional[int] = None,
+    ) -> None:
+        # no workers, hence no call to BaseVectorEnv.__init__
+        self.env_num = env_num
+        self.max_cycles = max_cycles
+        self.render_mode = render_mode
+        self.is_async = False
+        self.is_closed = False
+
+        if isinstance(game, MatrixGame):
+            self.game = game
+            self.name = f"simple_{type(game).__name__.lower()}_v0"
+        else:
+            game_cls = get_game_class(game)
+            self.game = game_cls() if num_players is None else game_cls(num_players)
+            self.name = f"simple_{game}_v0"
+        if num_actions is None:
+            num_actions = self.game.num_actions
+        assert num_actions == self.game.num_actions
+        self._moves = self.game.moves
+        self._none = self.game.NONE
+        self.num_actions = num_actions
+        # payoff_tensor[a_0, ..., a_{N-1}] = (r_0, ..., r_{N-1})
+        self.payoff_tensor = self.game.payoff_tensor
+
+        self.agents = ["player_" + str(r) for r in range(self.game.num_players)]
+        self.possible_agents = self.agents[:]
+        self.agent_idx = {agent: i for i, agent in enumerate(self.agents)}
+        self.agent_num = self.num_agents = len(self.agents)
+        self._agent_ids = np.array(self.agents, dtype=object)
+        self._action_space = Discrete(num_actions)
+        # the same spaces as raw_env
+        self._observation_space = {"observation": Discrete(num_actions)}
+
+        # the agent to act, the actions of the current round, the actions of
+        # the last round (which is what both agents observe) and the rounds
+        self.selection = np.zeros(env_num, dtype=np.int64)
+        self.actions = np.full((env_num, self.agent_num), self._none, dtype=np.int64)
+        self.observations = np.full(
+            (env_num, self.agent_num), self._none, dtype=np.int64
+        )
+        self.num_moves = np.zeros(env_num, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return self.agent_num * self.env_num
+
+    def _env_ids(
+        self, id: Optional[Union[int, List[int], np.ndarray]] = None
+    ) -> np.ndarray:
+        """Map the global ids of the MA layout to the game indices."""
+        if id is None:
+            return np.arange(self.env_num)
+        return np.atleast_1d(np.asarray(id)) % self.env_num
+
+    def get_env_attr(
+        self, key: str, id: Optional[Union[int, List[int], np.ndarray]] = None
+    ) -> List[Any]:
+        env_ids = self._env_ids(id)
+        if key == "action_space":
+            return [self._action_space] * len(env_ids)
+        if key == "observation_space":
+            return [self._observation_space] * len(env_ids)
+        if key in ["metadata", "reward_range", "spec"]:
+            return [None] * len(env_ids)
+        value = self.__dict__[key]
+        if isinstance(value, np.ndarray) and len(value) == self.env_num:
+            return list(value[env_ids])
+        return [value] * len(env_ids)
+
+    def set_env_attr(
+        self,
+        key: str,
+        value: Any,
+        id: Optional[Union[int, List[int], np.ndarray]] = None,
+    ) -> None:
+        current = self.__dict__.get(key)
+        if isinstance(current, np.ndarray) and len(current) == self.env_num:
+            current[self._env_ids(id)] = value
+        else:
+            setattr(self, key, value)
+
+    def _obs(self, env_ids: np.ndarray) -> Batch:
+        return Batch(
+            agent_id=self._agent_ids[self.selection[env_ids]],
+            obs=self.observations[env_ids].copy(),
+            mask=np.ones((len(env_ids), self.num_actions), dtype=bool),
+        )
+
+    def reset(
+        self, id: Optional[Union[int, List[int], np.ndarray]] = None, **kwargs: Any
+    ) -> Batch:
+        env_ids = self._env_ids(id)
+        self.selection[env_ids] = 0
+        self.actions[env_ids] = self._none
+        self.observations[env_ids] = self._none
+        self.num_moves[env_ids] = 0
+        return self._obs(env_ids)
+
+    def step(
+        self,
+        action: np.ndarray,
+        id: Optional[Union[int, List[int], np.ndarray]] = None,
+    ) -> Tuple[Batch, np.ndarray, np.ndarray, np.ndarray, Batch]:
+        """Let the agent to act in each of the given games take its action.
+
+        :param np.ndarray action: one action per game
+        :param id: the global ids of the games, defaults to all games
+        :return: (obs, rew, terminated, truncated, info) with the obs of the
+            next agent to act, the rewards of all agents with shape [len(id),
+            agent_num], the games never terminating but being truncated after
+            max_cycles, and the global id of the next agent to act in
+            info["env_id"]
+        """
+        env_ids = self._env_ids(id)
+        action = np.asarray(action, dtype=np.int64).reshape(-1)
+        assert len(action) == len(env_ids)
+        acting = self.selection[env_ids]
+        self.actions[env_ids, acting] = action
+
+        rew = np.zeros((len(env_ids), self.agent_num))
+        last = acting == self.agent_num - 1
+        ended = env_ids[last]
+        # collect rewards for the games whose round is complete
+        rew[last] = self.payoff_tensor[tuple(self.actions[ended].T)]
+        self.num_moves[ended] += 1
+        self.observations[ended] = self.actions[ended]
+        # the others have not acted yet in the new round
+        started = env_ids[acting == 0]
+        self.actions[started, 1:] = self._none
+        self.selection[env_ids] = (acting + 1) % self.agent_num
+
+        terminated = np.zeros(len(env_ids), dtype=bool)
+        truncated = self.num_moves[env_ids] >= self.max_cycles
+        info = Batch(env_id=self.selection[env_ids] * self.env_num + env_ids)
+        if self.render_mode == "human":
+            self.render()
+        return self._obs(env_ids), rew, terminated, truncated, info
+
+    def snapshot(
+        self, id: Optional[Union[int, List[int], np.ndarray]] = None
+    ) -> np.ndarray:
+        """Copy the state of the given games, to be restored with restore.
+
+        :param id: the global ids of the games, defaults to all games
+        :return: the states with shape [len(id), 2 * agent_num + 2], one row of
+            (selection, num_moves, *actions, *observations) per game
+        """
+        env_ids = self._env_ids(id)
+        return np.concatenate(
+            [
+                self.selection[env_ids, None],
+                self.num_moves[env_ids, None],
+                self.actions[env_ids],
+                self.observations[env_ids],
+            ],
+            axis=1,
+        )
+
+    def restore(
+        self,
+        snapshot: np.ndarray,
+        id: Optional[Union[int, List[int], np.ndarray]] = None,
+    ) -> None:
+        """Restore the states taken with snapshot.
+
+        :param np.ndarray snapshot: one row per game in the order of id, or a
+            single row restored in all of them, e.g. to branch a game
+        :param id: the global ids of the games, defaults to all games
+        """
+        env_ids = self._env_ids(id)
+        snapshot = np.broadcast_to(snapshot, (len(env_ids), 2 * self.agent_num + 2))
+        self.selection[env_ids] = snapshot[:, 0]
+        self.num_moves[env_ids] = snapshot[:, 1]
+        self.actions[env_ids] = snapshot[:, 2 : 2 + self.agent_num]
+        self.observations[env_ids] = snapshot[:, 2 + self.agent_num :]
+
+    def seed(self, seed: Optional[Union[int, List[int]]] = None) -> List[Any]:
+        # the games are deterministic
+        return [seed] * self.env_num
+
+    def render(self, **kwargs: Any) -> List[Any]:
+        strings = [
+            "Current state: "
+            + " , ".join(
+                "Agent{}: {}".format(i + 1, self._moves[a])
+                for i, a in enumerate(actions)
+            )
+            for actions in self.actions
+        ]
+        if self.render_mode == "human":
+            print("\n".join(strings))
+        return strings
+
+    def close(self) -> None:
+        self.is_closed = True
@@ -0,0 +1,179 @@
+import time
+from typing import Any, Dict, Optional, Union
+
+import numpy as np
+from tianshou.data import Batch
+
+from .simple_dilemma_games import MatrixGame, get_game_class
+
+
+def joint_action_probs(probs: np.ndarray) -> np.ndarray:
+    """The probabilities of the joint actions of independent agents.
+
+    :param np.ndarray probs: the action probabilities of each agent with the
+        shape [..., N, K]
+    :return np.ndarray: the probabilities with the shape [..., K, ..., K]
+    """
+    n = probs.shape[-2]
+    operands = []
+    for i in range(n):
+        operands += [probs[..., i, :], [Ellipsis, i]]
+    return np.einsum(*operands, [Ellipsis, *range(n)])
+
+
+def expected_payoff(payoff_tensor: np.ndarray, probs: np.ndarray) -> np.ndarray:
+    """The exact expected payoff of each agent of a matrix game.
+
+    :param np.ndarray payoff_tensor: the payoffs with the shape [K] * N + [N]
+    :param np.ndarray probs: the action probabilities of each agent with the
+        shape [..., N, K]
+    :return np.ndarray: the expected payoffs with the shape [..., N]
+    """
+    n = probs.shape[-2]
+    return np.einsum(
+        joint_action_probs(probs),
+        [Ellipsis, *range(n)],
+        payoff_tensor,
+        [*range(n), n],
+        [Ellipsis, n],
+    )
+
+
+class MatrixGameEvaluator:
+    """Evaluate a MAPolicyManager on a repeated matrix game without rollouts.
+
+    In ``dilemma_pettingzoo.raw_env`` all agents observe the joint action of
+    the last round (``NONE`` in the first round), so the game is a Markov chain
+    over the K^N joint actions and the initial state. The policies are queried
+    once per state for their action distributions with
+    :meth:`~marl_comm.ma_policy.MAPolicyManager.action_probs`, and the exact
+    expected return of each agent over ``max_cycles`` rounds follows from
+    the payoff tensor.
+
+    It also stands in for the test collector of a trainer: ``collect`` returns
+    the statistics of :class:`~marl_comm.data.MACollector`, in which every
+    episode has the expected return.
+
+    :param MAPolicyManager policy: the policies of the agents
+    :param Union[str, MatrixGame] game: the game, as in raw_env, defaults to
+        "pd"
+    :param int max_cycles: the number of rounds per episode, defaults to 10000
+    :param bool exploration_noise: whether to include the exploration noise of
+        the policies, as Collector does with exploration_noise, defaults to
+        False
+    :param Optional[int] num_players: the number of players, as in raw_env,
+        defaults to None
+    """
+
+    def __init__(
+        self,
+        policy: Any,
+        game: Union[str, MatrixGame] = "pd",
+        max_cycles: int = 10000,
+        exploration_noise: bool = False,
+        num_players: Optional[int] = None,
+    ) -> None:
+        if isinstance(game, MatrixGame):
+            self.game = game
+        else:
+            game_cls = get_game_class(game)
+            self.game = game_cls() if num_players is None else game_cls(num_players)
+        self.policy = policy
+        self.max_cycles = max_cycles
+        self.exploration_noise = exploration_noise
+        self.payoff_tensor = self.game.payoff_tensor
+        self.agent_num = self.game.num_players
+        self.num_actions = self.game.num_actions
+        assert len(policy.agents) == self.agent_num
+        # the joint actions in the order of np.ravel_multi_index, then NONE
+        shape = (self.num_actions,) * self.agent_num
+        self.num_states = self.num_actions**self.agent_num + 1
+        self.states = np.concatenate(
+            [
+                np.stack(np.unravel_index(np.arange(self.num_states - 1), shape), 1),
+                np.full((1, self.agent_num), self.game.NONE),
+            ]
+        )
+        self.reset_stat()
+
+    def reset_stat(self) -> None:
+        self.collect_step, self.collect_episode, self.collect_time = 0, 0, 0.0
+
+    def reset_env(self, gym_reset_kwargs: Optional[Dict[str, Any]] = None) -> None:
+        pass
+
+    def reset_buffer(self, keep_statistics: bool = False) -> None:
+        pass
+
+    def state_probs(self) -> np.ndarray:
+        """The action probabilities of every agent in every state.
+
+        :return np.ndarray: the probabilities with the shape [num_states,
+            agent_num, num_actions], the last state being the first round
+        """
+        agent_ids = np.repeat(
+            np.array(self.policy.agents, dtype=object), self.num_states
+        )
+        batch = Batch(
+            obs=Batch(
+                agent_id=agent_ids,
+                obs=np.tile(self.states, (self.agent_num, 1)),
+                mask=np.ones((len(agent_ids), self.num_actions), dtype=bool),
+            ),
+            info=Batch(),
+        )
+        probs = self.policy.action_probs(batch, self.exploration_noise)
+        return probs.reshape(self.agent_num, self.num_states, -1).transpose(1, 0, 2)
+
+    def evaluate(self) -> np.ndarray:
+        """The exact expected return of each agent over an episode.
+
+        :return np.ndarray: the expected returns with the shape [agent_num]
+        """
+        probs = self.state_probs()
+        # the expected payoffs of a round and the transitions between states,
+        # no state leads back to the first round
+        rew = expected_payoff(self.payoff_tensor, probs)
+        transition = np.zeros((self.num_states, self.num_states))
+        transition[:, :-1] = joint_action_probs(probs).reshape(self.num_states, -1)
+        state_dist = np.zeros(self.num_states)
+        state_dist[-1] = 1.0
+        returns = np.zeros(self.agent_num)
+        for _ in range(self.max_cycles):
+            returns += state_dist @ rew
+            state_dist = state_dist @ transition
+        return returns
+
+    def collect(
+        self,
+        n_step: Optional[int] = None,
+        n_episode: Optional[int] = None,
+        **kwargs: Any,
+    ) -> Dict[str, Any]:
+        """Evaluate the policies in place of collecting n_episode episodes.
+
+        :return: the statistics of MACollector.collect, with the expected
+            returns with the shape [n_episode, agent_num] in "rews"
+        """
+        if n_episode is None:
+            assert n_step is not None and n_step > 0
+            n_episode = max(n_step // (self.max_cycles * self.agent_num), 1)
+        assert n_episode > 0
+        start_time = time.time()
+        returns = self.evaluate()
+        rews = np.tile(returns, (n_episode, 1))
+        lens = np.full(n_episode, self.max_cycles)
+        self.collect_step += n_episode * self.max_cycles * self.agent_num
+        self.collect_episode += n_episode
+        self.collect_time += max(time.time() - start_time, 1e-9)
+        return {
+            "n/ep": n_episode,
+            "n/st": n_episode * self.max_cycles * self.agent_num,
+            "rews": rews,
+            "lens": lens,
+            "idxs": np.zeros(n_episode, int),
+            "rew": rews.mean(),
+            "len": float(self.max_cycles),
+            "rew_std": 0.0,
+            "len_std": 0.0,
+        }
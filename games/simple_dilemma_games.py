@@ -29,7 +29,81 @@ class Game:
         return self.num_iters
 
 
-class Prisoners_Dilemma(Game):
+def payoff_tensor_from_dict(payoff, num_actions=2):
+    """
+    Converts a payoff dict {(a_0, ..., a_{N-1}): (r_0, ..., r_{N-1})} to a
+    payoff tensor of shape [num_actions] * N + [N].
+    """
+    num_players = len(next(iter(payoff)))
+    tensor = np.zeros([num_actions] * num_players + [num_players])
+    assert len(payoff) == tensor[..., 0].size, "the payoff dict is incomplete"
+    for actions, rewards in payoff.items():
+        tensor[actions] = rewards
+    return tensor
+
+
+class MatrixGame(Game):
+    """
+    Base class for N-player, K-action normal form games.
+
+    The payoffs are stored in a tensor of shape [K] * N + [N], where
+    payoff_tensor[a_0, ..., a_{N-1}] are the rewards of all players for the
+    joint action (a_0, ..., a_{N-1}).
+    """
+
+    def __init__(self, payoff_tensor, moves=None, num_iters=1000):
+        """
+        Initializes a new game from its payoff tensor.
+
+        Parameters:
+        payoff_tensor (array_like): The payoffs, of shape [K] * N + [N].
+        moves (list): The names of the K actions. Default is ACTION_0, ACTION_1, ...
+        num_iters (int): The number of iterations for the game. Default is 1000.
+        """
+        super().__init__(num_iters)
+        payoff_tensor = np.asarray(payoff_tensor, dtype=float)
+        self.num_players = payoff_tensor.ndim - 1
+        self.num_actions = payoff_tensor.shape[0]
+        assert payoff_tensor.shape == (self.num_actions,) * self.num_players + (
+            self.num_players,
+        ), "the payoff tensor should be of shape [K] * N + [N]"
+        self.payoff_tensor = payoff_tensor
+
+        if moves is None:
+            moves = ["ACTION_" + str(i) for i in range(self.num_actions)]
+        assert len(moves) == self.num_actions
+        # none is last possible action, to satisfy discrete action space
+        self.NONE = self.num_actions
+        self.moves = list(moves) + ["None"]
+
+    @property
+    def payoff(self):
+        """
+        The payoffs as a dict {(a_0, ..., a_{N-1}): (r_0, ..., r_{N-1})}.
+        """
+        return {
+            actions: tuple(self.payoff_tensor[actions].tolist())
+            for actions in np.ndindex(self.payoff_tensor.shape[:-1])
+        }
+
+    def get_payoff(self):
+        """
+        Returns the payoff matrix for the game.
+        """
+        return self.payoff
+
+    def get_rewards(self, actions):
+        """
+        Returns the rewards of all players for a joint action.
+
+        Parameters:
+        actions (array_like): The actions of the N players, or a batch of
+            joint actions of shape [N, ...].
+        """
+        return self.payoff_tensor[tuple(actions)]
+
+
+class Prisoners_Dilemma(MatrixGame):
     """
     Class for the Prisoner's Dilemma game.
     """
@@ -38,32 +112,24 @@ class Prisoners_Dilemma(Game):
         """
         Initializes a new Prisoner's Dilemma game.
         """
-        super().__init__()
         self.COOPERATE = 0
         self.DEFECT = 1
-        self.NONE = 2
-        self.moves = ["COOPERATE", "DEFECT", "None"]
 
         self.coop = 3.5  # cooperate-cooperate payoff
         self.defect = 1  # defect-defect payoff
         self.temptation = 5  # cooperate-defect (or vice-versa) tempation payoff
         self.sucker = 0  # cooperate-defect (or vice-versa) sucker payoff
 
-        self.payoff = {
+        payoff = {
             (self.COOPERATE, self.COOPERATE): (self.coop, self.coop),
             (self.COOPERATE, self.DEFECT): (self.sucker, self.temptation),
             (self.DEFECT, self.COOPERATE): (self.temptation, self.sucker),
             (self.DEFECT, self.DEFECT): (self.defect, self.defect),
         }
-
-    def get_payoff(self):
-        """
-        Returns the payoff matrix for the Prisoner's Dilemma game.
-        """
-        return self.payoff
+        super().__init__(payoff_tensor_from_dict(payoff), moves=["COOPERATE", "DEFECT"])
 
 
-class Samaritans_Dilemma(Game):
+class Samaritans_Dilemma(MatrixGame):
     """
     Class for the Samaritan's Dilemma game.
     """
@@ -72,28 +138,21 @@ class Samaritans_Dilemma(Game):
         """
         Initializes a new Samaritan's Dilemma game.
         """
-        super().__init__()
-
         self.SOCIAL = 0
         self.ANTI_SOCIAL = 1
-        self.NONE = 2
-        self.moves = ["SOCIAL", "ANTI_SOCIAL", "None"]
 
-        self.payoff = {
+        payoff = {
             (self.ANTI_SOCIAL, self.SOCIAL): (2, 2),  # no help, work
             (self.ANTI_SOCIAL, self.ANTI_SOCIAL): (1, 1),  # no help, no work
             (self.SOCIAL, self.SOCIAL): (4, 3),  # help, work
             (self.SOCIAL, self.ANTI_SOCIAL): (3, 4),  # help, no work
         }
-
-    def get_payoff(self):
-        """
-        Returns the payoff matrix for the Samaritan's Dilemma game.
-        """
-        return self.payoff
+        super().__init__(
+            payoff_tensor_from_dict(payoff), moves=["SOCIAL", "ANTI_SOCIAL"]
+        )
 
 
-class Stag_Hunt(Game):
+class Stag_Hunt(MatrixGame):
     """
     Class for the Stag Hunt game.
     """
@@ -102,28 +161,19 @@ class Stag_Hunt(Game):
         """
         Initializes a new Stag Hunt game.
         """
-        super().__init__()
-
         self.STAG = 0
         self.HARE = 1
-        self.NONE = 2
-        self.moves = ["STAG", "HARE", "None"]
 
-        self.payoff = {
+        payoff = {
             (self.STAG, self.STAG): (4, 4),
             (self.STAG, self.HARE): (1, 3),
             (self.HARE, self.STAG): (3, 1),
             (self.HARE, self.HARE): (2, 2),
         }
-
-    def get_payoff(self):
-        """
-        Returns the payoff matrix for the Stag Hunt game.
-        """
-        return self.payoff
+        super().__init__(payoff_tensor_from_dict(payoff), moves=["STAG", "HARE"])
 
 
-class Chicken(Game):
+class Chicken(MatrixGame):
     """
     Class for the Chicken game.
     """
@@ -132,25 +182,46 @@ class Chicken(Game):
         """
         Initializes a new Chicken game.
         """
-        super().__init__()
-
         self.SWERVE = 0
         self.STRAIGHT = 1
-        self.NONE = 2
-        self.moves = ["SWERVE", "STRAIGHT", "None"]
 
-        self.payoff = {
+        payoff = {
             (self.SWERVE, self.SWERVE): (0, 0),
             (self.STRAIGHT, self.SWERVE): (1, -1),
             (self.SWERVE, self.STRAIGHT): (-1, 1),
             (self.STRAIGHT, self.STRAIGHT): (-1000, -1000),
         }
+        super().__init__(payoff_tensor_from_dict(payoff), moves=["SWERVE", "STRAIGHT"])
 
-    def get_payoff(self):
+
+class Public_Goods(MatrixGame):
+    """
+    Class for the N-player Public Goods game, an N-player Prisoner's Dilemma.
+    """
+
+    def __init__(self, num_players=2, multiplier=1.5):
         """
-        Returns the payoff matrix for the Chicken game.
+        Initializes a new Public Goods game.
+
+        Every player either contributes its endowment of 1 to the pot or keeps
+        it, the pot is multiplied and shared equally among all players.
+
+        Parameters:
+        num_players (int): The number of players. Default is 2.
+        multiplier (float): The multiplier of the pot, a dilemma if it is in
+            (1, num_players). Default is 1.5.
         """
-        return self.payoff
+        self.CONTRIBUTE = 0
+        self.FREE_RIDE = 1
+        self.multiplier = multiplier
+
+        # actions[..., i] is the action of player i
+        actions = np.stack(np.indices([2] * num_players), axis=-1)
+        num_contributions = (actions == self.CONTRIBUTE).sum(-1, keepdims=True)
+        payoff_tensor = multiplier * num_contributions / num_players + (
+            actions == self.FREE_RIDE
+        )
+        super().__init__(payoff_tensor, moves=["CONTRIBUTE", "FREE_RIDE"])
 
 
 def get_game_class(name="prisoners_dilemma"):
@@ -165,5 +236,7 @@ def get_game_class(name="prisoners_dilemma"):
         return Stag_Hunt
     elif name.lower() == "chicken" or name.lower() == "ch":
         return Chicken
+    elif name.lower() == "public_goods" or name.lower() == "pg":
+        return Public_Goods
     else:
         raise ValueError("Invalid game name: %s" % name)
@@ -1,12 +1,18 @@
-from typing import Any, List
+from typing import Any, Dict, List, Optional, Union
 
 import numpy as np
-from tianshou.data import Batch
+import torch
+import torch.nn as nn
+from tianshou.data import Batch, to_torch_as
 from tianshou.env import PettingZooEnv
 from tianshou.policy import PPOPolicy
 
 from marl_comm.data import MAReplayBuffer
 from marl_comm.ma_policy import MAPolicyManager
+from marl_comm.ma_policy.MAPPO.policy import MINIBATCH_KEYS, ValuePlan
+from marl_comm.utils.advantage import compute_ma_episodic_return
+from marl_comm.utils.distributed import broadcast_parameters
+from marl_comm.utils.precision import autocast
 
 
 class MAPPOPolicy(MAPolicyManager):
@@ -15,35 +21,277 @@ class MAPPOPolicy(MAPolicyManager):
                  policies: List[PPOPolicy],
                  env: PettingZooEnv,
                  joint_critic: bool = False,
+                 state_encoder: Optional[nn.Module] = None,
+                 state_encoder_optim: Optional[torch.optim.Optimizer] = None,
                  **kwargs: Any) -> None:
+        """
+        :param bool joint_critic: whether the critics take [obs, state] as input
+        :param Optional[nn.Module] state_encoder: a state encoder shared by all
+            agents' joint critics, which then take [obs, state_encoder(state)]
+            as input. The agents are then updated together in one minibatch
+            loop whatever learn_threads is, see `_learn_with_state_encoder`,
+            defaults to None
+        :param Optional[torch.optim.Optimizer] state_encoder_optim: the
+            optimizer of state_encoder, required if state_encoder is given
+        """
         train_scheme = "FD" if not joint_critic else "CTDE"
         parameter_mode = "Indvd"
         critic_mode = "IC" if not joint_critic else "JC"
         comm = False
+        assert state_encoder is None or joint_critic, \
+            "state_encoder requires joint_critic"
+        assert state_encoder is None or state_encoder_optim is not None, \
+            "state_encoder_optim is required for state_encoder"
+        data_parallel = [
+            getattr(policy, "_data_parallel", False) for policy in policies
+        ]
+        assert all(data_parallel) or not any(data_parallel), \
+            "data_parallel must be set for all or none of the policies"
+        # the ranks must run their collectives in the same order
+        assert not any(data_parallel) or kwargs.get("learn_threads", 1) == 1, \
+            "data_parallel requires learn_threads=1"
         super().__init__(policies, env, train_scheme, parameter_mode,
                          critic_mode, comm, **kwargs)
+        self.state_encoder = state_encoder
+        self.state_encoder_optim = state_encoder_optim
+        self._data_parallel = any(data_parallel)
+        if state_encoder is not None and self._data_parallel:
+            broadcast_parameters(state_encoder)
 
     def process_fn(self, batch: Batch, buffer: MAReplayBuffer,
                    indice: np.ndarray) -> Batch:
-        for agent in self.agents:
+        if self.critic_mode == "JC":
+            critic_obs = self._joint_critic_input(
+                [[batch[agent][key].obs for agent in self.agents]
+                 for key in ["obs", "obs_next"]],
+                [[batch[agent][key].state for agent in self.agents]
+                 for key in ["obs", "obs_next"]])
+        for agent_i, agent in enumerate(self.agents):
             if self.critic_mode == "JC":
-                bsz = batch[agent].obs.obs.shape[0]
-                batch[agent].critic_obs = np.concatenate([
-                    batch[agent].obs.obs.reshape(bsz, -1),
-                    batch[agent].obs.state.reshape(bsz, -1)
-                ],
-                                                         axis=-1)
-
-                batch[agent].critic_obs_next = np.concatenate([
-                    batch[agent].obs_next.obs.reshape(bsz, -1),
-                    batch[agent].obs_next.state.reshape(bsz, -1)
-                ],
-                                                              axis=-1)
+                batch[agent].critic_obs = critic_obs[0, agent_i]
+                batch[agent].critic_obs_next = critic_obs[1, agent_i]
             else:
                 batch[agent].critic_obs = batch[agent].obs.obs
                 batch[agent].critic_obs_next = batch[agent].obs_next.obs
+            if self.state_encoder is not None:
+                # keep the raw states to encode them again with gradient in learn
+                batch[agent].critic_state = batch[agent].obs.state
+                batch[agent].critic_state_next = batch[agent].obs_next.state
             batch[agent].obs = batch[agent].obs.obs
             batch[agent].obs_next = batch[agent].obs_next.obs
 
-        results = super().process_fn(batch, buffer, indice)
+        policies = [self.policies[agent] for agent in self.agents]
+        if len(set((p._gamma, p._lambda) for p in policies)) > 1:
+            # the agents discount differently, fall back to per-agent GAE
+            return super().process_fn(batch, buffer, indice)
+        return self._process_agents_jointly(batch, buffer, indice)
+
+    def _process_agents_jointly(self, batch: Batch, buffer: MAReplayBuffer,
+                                indice: np.ndarray) -> Batch:
+        """PPOPolicy.process_fn for all agents, with the GAE of all agents
+        computed at once by :func:`compute_ma_episodic_return`."""
+        batch = self._process_critic_input(batch, buffer=buffer, indice=indice)
+        policies = [self.policies[agent] for agent in self.agents]
+        buffers = [
+            buffer.get_agent_buffer(agent_i)
+            for agent_i in range(self.agent_num)
+        ]
+        v_s, v_s_, logp_old = zip(*[
+            policy._precompute(batch[agent])
+            for agent, policy in zip(self.agents, policies)
+        ])
+        returns, advantages = compute_ma_episodic_return(
+            [batch[agent] for agent in self.agents],
+            buffers,
+            indice,
+            np.stack([
+                policy._unnormalize_value(v.cpu().numpy())
+                for policy, v in zip(policies, v_s_)
+            ]),
+            np.stack([
+                policy._unnormalize_value(v.cpu().numpy())
+                for policy, v in zip(policies, v_s)
+            ]),
+            gamma=policies[0]._gamma,
+            gae_lambda=policies[0]._lambda)
+
+        results = {}
+        for agent_i, (agent, policy) in enumerate(zip(self.agents, policies)):
+            data = batch[agent]
+            if policy._recompute_adv:
+                # buffer input `buffer` and `indices` to be used in `learn()`.
+                policy._buffer, policy._indices = buffers[agent_i], indice
+            data.v_s = v_s[agent_i]
+            data = policy._set_returns(data, returns[agent_i],
+                                       advantages[agent_i])
+            data.act = to_torch_as(data.act, data.v_s)
+            data.logp_old = logp_old[agent_i]
+            results[agent] = data
+        return Batch(results)
+
+    def _joint_critic_input(self, obs: List[List[np.ndarray]],
+                            state: List[List[np.ndarray]]) -> np.ndarray:
+        """Build the joint critic inputs of all agents at once.
+
+        :param obs: obs[i][agent_i] is the obs (i = 0) or obs_next (i = 1) of
+            agent_i, with shape [bsz, ...]
+        :param state: the states, laid out as obs. They are replaced by their
+            encodings if a state encoder is used.
+        :return np.ndarray: [2, agent_num, bsz, obs_dim + state_dim], where
+            index 0 of the first axis holds [obs, state] and index 1 holds
+            [obs_next, state_next]. Each agent's critic_obs is a view into it.
+        """
+        bsz = obs[0][0].shape[0]
+        obs_dim = int(np.prod(obs[0][0].shape[1:]))
+        if self.state_encoder is not None:
+            with torch.no_grad():
+                state = [
+                    self._encode_state(np.stack(s)).cpu().numpy()
+                    for s in state
+                ]
+        state_dim = int(np.prod(state[0][0].shape[1:]))
+        dtype = np.result_type(obs[0][0], state[0][0])
+        critic_obs = np.empty((2, self.agent_num, bsz, obs_dim + state_dim),
+                              dtype=dtype)
+        for i in range(2):
+            for agent_i in range(self.agent_num):
+                critic_obs[i, agent_i, :, :obs_dim] = obs[i][agent_i].reshape(
+                    bsz, -1)
+                critic_obs[i, agent_i, :,
+                           obs_dim:] = state[i][agent_i].reshape(bsz, -1)
+        return critic_obs
+
+    def _encode_state(self, state: Union[np.ndarray,
+                                         torch.Tensor]) -> torch.Tensor:
+        """Encode the states of all agents in a single forward pass.
+
+        The agents observe the same state at the same step of an env, so the
+        state of an agent is only encoded if it differs from the first
+        agent's at the same row, and the encodings are broadcast to the agents.
+
+        :param state: [agent_num, bsz, ...]
+        :return torch.Tensor: [agent_num, bsz, encoding_dim]
+        """
+        precision = self.policies[self.agents[0]]._precision
+        device = next(self.state_encoder.parameters()).device
+        state = torch.as_tensor(state, dtype=torch.float32, device=device)
+        agent_num, bsz = state.shape[:2]
+        flat = state.reshape(agent_num, bsz, -1)
+        own = (flat != flat[:1]).any(dim=-1)
+        # the row of the encoder input of each state
+        index = torch.arange(bsz, device=device).repeat(agent_num, 1)
+        index[own] = bsz + torch.arange(int(own.sum()), device=device)
+        with autocast(precision):
+            z = self.state_encoder(torch.cat([state[0], state[own]])).float()
+        return z[index]
+
+    def learn(self, batch: Batch,
+              **kwargs: Any) -> Dict[str, Union[float, List[float]]]:
+        if self.state_encoder is None:
+            return super().learn(batch, **kwargs)
+        return self._learn_with_state_encoder(batch, **kwargs)
+
+    def _learn_with_state_encoder(
+            self, batch: Batch, batch_size: int, repeat: int,
+            **kwargs: Any) -> Dict[str, Union[float, List[float]]]:
+        """PPOPolicy.learn for all agents in one minibatch loop, so that the
+        shared state encoder runs and is stepped once per minibatch.
+
+        The agents learn from the same rows of their batches. The stacked
+        critic_state of a minibatch is encoded once, each agent's critic takes
+        [obs, its slice of the encodings], and one backward pass over the sum
+        of the agents' losses trains the actor-critics and the encoder. The
+        remaining epochs are skipped once any agent exceeds its target_kl.
+        """
+        policies = [self.policies[agent] for agent in self.agents]
+        keys = tuple(k for k in MINIBATCH_KEYS
+                     if k != "critic_obs") + ("critic_state", )
+        batch_size = policies[0]._local_batch_size(batch_size)
+        stats: List[List[torch.Tensor]] = [[] for _ in policies]
+        plans: Dict[str, Optional[ValuePlan]] = {}
+        epochs = 0
+        for step in range(repeat):
+            if step == 0 or self._recompute_returns(batch, policies, plans):
+                data = []
+                for agent, policy in zip(self.agents, policies):
+                    data.append(
+                        policy._to_tensors(policy._shard(batch[agent]), keys))
+                    assert data[-1] is not None, \
+                        "state_encoder requires array obs and states"
+            epoch_start = len(stats[0])
+            v_s = data[0]["v_s"]
+            for index in policies[0]._minibatch_indices(
+                    len(v_s), batch_size, v_s.device):
+                minibatches = [
+                    policy._gather(d, index)
+                    for policy, d in zip(policies, data)
+                ]
+                z = self._encode_state(
+                    torch.stack([m.critic_state for m in minibatches]))
+                losses = []
+                with autocast(policies[0]._precision):
+                    for agent_i, (policy, minibatch) in enumerate(
+                            zip(policies, minibatches)):
+                        obs = minibatch.obs.reshape(len(index), -1).to(z)
+                        losses.append(
+                            policy._loss(minibatch,
+                                         torch.cat([obs, z[agent_i]], dim=-1)))
+                self.state_encoder_optim.zero_grad()
+                for policy in policies:
+                    policy.optim.zero_grad()
+                sum(loss[0] for loss in losses).backward()
+                for policy in policies:
+                    policy._sync_and_clip_gradients(
+                        policy._actor_critic.parameters())
+                policies[0]._sync_and_clip_gradients(
+                    self.state_encoder.parameters())
+                self.state_encoder_optim.step()
+                for policy in policies:
+                    policy.optim.step()
+                for agent_stats, loss in zip(stats, losses):
+                    agent_stats.append(torch.stack(loss).detach())
+            epochs += 1
+            kl_exceeded = [
+                policy._kl_exceeded(agent_stats[epoch_start:])
+                for policy, agent_stats in zip(policies, stats)
+            ]
+            if step < repeat - 1 and any(kl_exceeded):
+                break
+
+        results = {}
+        for agent, policy, agent_stats in zip(self.agents, policies, stats):
+            result = policy._loss_stats(agent_stats)
+            result.update(policy._step_stats(len(agent_stats), epochs, repeat))
+            for k, v in result.items():
+                results[agent + "/" + k] = v
         return results
+
+    def _recompute_returns(self, batch: Batch, policies: List[PPOPolicy],
+                           plans: Dict[str, Optional[ValuePlan]]) -> bool:
+        """Recompute the returns and advantages of the agents with
+        recompute_advantage, from their critic inputs encoded by the trained
+        state encoder.
+
+        :param plans: the agents' value plans, planned on the first call
+        :return bool: whether any agent recomputed them
+        """
+        if not any(policy._recompute_adv for policy in policies):
+            return False
+        critic_obs = self._joint_critic_input(
+            [[batch[agent][key] for agent in self.agents]
+             for key in ["obs", "obs_next"]],
+            [[batch[agent][key] for agent in self.agents]
+             for key in ["critic_state", "critic_state_next"]])
+        for agent_i, (agent, policy) in enumerate(zip(self.agents, policies)):
+            if not policy._recompute_adv:
+                continue
+            data = batch[agent]
+            data.critic_obs = critic_obs[0, agent_i]
+            data.critic_obs_next = critic_obs[1, agent_i]
+            if agent not in plans:
+                plans[agent] = policy._value_plan(data, policy._buffer,
+                                                  policy._indices)
+            v_s, v_s_ = policy._planned_values(data, plans[agent])
+            batch[agent] = policy._compute_returns(data, policy._buffer,
+                                                   policy._indices, v_s, v_s_)
+        return True
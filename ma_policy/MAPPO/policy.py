@@ -1,11 +1,25 @@
-from typing import Any, Dict, List, Optional, Type
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type, Union
 
 import numpy as np
 import torch
+import torch.distributed as dist
 from tianshou.data import Batch, ReplayBuffer, to_torch_as
 from tianshou.policy import PPOPolicy as BasePPO
 from tianshou.utils.net.common import ActorCritic
+from tianshou.utils.net.discrete import Actor, Critic
 from torch import nn
+from torch.nn import functional as F
+
+from marl_comm.utils.distributed import (all_reduce_gradients, all_reduce_mean,
+                                         broadcast_parameters, is_distributed,
+                                         shard_indices)
+from marl_comm.utils.precision import PRECISIONS, autocast
+
+# the keys of a processed batch read by `PPOPolicy._loss`
+MINIBATCH_KEYS = ("obs", "act", "critic_obs", "v_s", "returns", "adv",
+                  "logp_old")
+# (rows, successors, rest), see `PPOPolicy._value_plan`
+ValuePlan = Tuple[np.ndarray, np.ndarray, np.ndarray]
 
 
 class PPOPolicy(BasePPO):
@@ -21,48 +35,117 @@ class PPOPolicy(BasePPO):
                  value_clip: bool = False,
                  advantage_normalization: bool = True,
                  recompute_advantage: bool = False,
+                 precision: str = "fp32",
+                 loss_detail: bool = False,
+                 data_parallel: bool = False,
+                 target_kl: Optional[float] = None,
                  **kwargs: Any) -> None:
+        """
+        :param str precision: precision of the forward and loss computation,
+            choices include {"fp32", "bf16"}. With "bf16" they run under CPU
+            autocast while the weights and the optimizer state stay in fp32,
+            defaults to "fp32"
+        :param bool loss_detail: whether `learn` reports the losses of every
+            minibatch instead of their means, for debugging, defaults to False
+        :param bool data_parallel: whether to learn data-parallel over the
+            processes of the initialized torch.distributed process group. Every
+            rank processes the same rollout and learns from its shard of it
+            with a minibatch size of batch_size / world_size, the gradients are
+            averaged over the ranks before each step and the parameters are
+            broadcast from rank 0 on construction, so that they stay identical
+            on all ranks, defaults to False
+        :param Optional[float] target_kl: stop the remaining epochs of `learn`
+            once the mean approximate KL divergence between the old and the
+            current policy over an epoch exceeds target_kl. None to always run
+            all epochs, defaults to None
+        """
+        assert precision in PRECISIONS, f"precision must be in {set(PRECISIONS)}"
+        assert target_kl is None or target_kl > 0, "target_kl must be positive"
+        assert not data_parallel or dist.is_initialized(
+        ), "data_parallel requires an initialized torch.distributed process group"
         super().__init__(actor, critic, optim, dist_fn, eps_clip, dual_clip,
                          value_clip, advantage_normalization,
                          recompute_advantage, **kwargs)
         self.joint_critic = joint_critic
+        self._precision = precision
+        self._loss_detail = loss_detail
+        self._data_parallel = data_parallel
+        self._target_kl = target_kl
+        if data_parallel:
+            broadcast_parameters(self)
 
     def process_fn(self, batch: Batch, buffer: ReplayBuffer,
                    indices: np.ndarray) -> Batch:
         if self._recompute_adv:
             # buffer input `buffer` and `indices` to be used in `learn()`.
             self._buffer, self._indices = buffer, indices
-        batch = self._compute_returns(batch, buffer, indices)
+        v_s, v_s_, logp_old = self._precompute(batch)
+        batch = self._compute_returns(batch, buffer, indices, v_s, v_s_)
         batch.act = to_torch_as(batch.act, batch.v_s)
-        old_log_prob = []
-        with torch.no_grad():
-            for minibatch in batch.split(self._batch,
-                                         shuffle=False,
-                                         merge_last=True):
-                old_log_prob.append(
-                    self(minibatch).dist.log_prob(minibatch.act))
-        batch.logp_old = torch.cat(old_log_prob, dim=0)
+        batch.logp_old = logp_old
         return batch
 
-    def _compute_returns(self, batch: Batch, buffer: ReplayBuffer,
-                         indices: np.ndarray) -> Batch:
-        v_s, v_s_ = [], []
-        with torch.no_grad():
+    def _shared_trunk(self) -> bool:
+        """Whether the actor and the critic are heads on the same preprocess net
+        and read the same input, so that the trunk can be computed once."""
+        return (not self.joint_critic and isinstance(self.actor, Actor)
+                and isinstance(self.critic, Critic)
+                and self.actor.preprocess is self.critic.preprocess)
+
+    def _precompute(
+            self,
+            batch: Batch) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Compute v_s, v_s_ and logp_old in a single pass over the batch.
+
+        The batch is split into inference-only minibatches of size
+        ``max_batchsize``. With a shared trunk, the trunk runs once on obs for
+        both the actor and the critic.
+
+        :return: the flattened v_s, v_s_ and logp_old
+        """
+        shared_trunk = self._shared_trunk()
+        v_s, v_s_, logp_old = [], [], []
+        with torch.no_grad(), autocast(self._precision):
             for minibatch in batch.split(self._batch,
                                          shuffle=False,
                                          merge_last=True):
-                v_s.append(self.critic(minibatch.critic_obs))
-                v_s_.append(self.critic(minibatch.critic_obs_next))
-        batch.v_s = torch.cat(v_s, dim=0).flatten()  # old value
-        v_s = batch.v_s.cpu().numpy()
-        v_s_ = torch.cat(v_s_, dim=0).flatten().cpu().numpy()
-        # when normalizing values, we do not minus self.ret_rms.mean to be numerically
-        # consistent with OPENAI baselines' value normalization pipeline. Emperical
-        # study also shows that "minus mean" will harm performances a tiny little bit
-        # due to unknown reasons (on Mujoco envs, not confident, though).
-        if self._rew_norm:  # unnormalize v_s & v_s_
-            v_s = v_s * np.sqrt(self.ret_rms.var + self._eps)
-            v_s_ = v_s_ * np.sqrt(self.ret_rms.var + self._eps)
+                if shared_trunk:
+                    feature, _ = self.actor.preprocess(minibatch.obs)
+                    logits = self.actor.last(feature)
+                    if self.actor.softmax_output:
+                        logits = F.softmax(logits, dim=-1)
+                    dist = self.dist_fn(logits)
+                    v_s.append(self.critic.last(feature).float())
+                else:
+                    dist = self(minibatch).dist
+                    v_s.append(self.critic(minibatch.critic_obs).float())
+                v_s_.append(self.critic(minibatch.critic_obs_next).float())
+                logp_old.append(
+                    dist.log_prob(to_torch_as(minibatch.act, v_s[-1])).float())
+        return (torch.cat(v_s, dim=0).flatten(), torch.cat(v_s_,
+                                                           dim=0).flatten(),
+                torch.cat(logp_old, dim=0))
+
+    def _compute_returns(self,
+                         batch: Batch,
+                         buffer: ReplayBuffer,
+                         indices: np.ndarray,
+                         v_s: Optional[torch.Tensor] = None,
+                         v_s_: Optional[torch.Tensor] = None) -> Batch:
+        """Compute returns and advantages, from the given values if any."""
+        if v_s is None or v_s_ is None:
+            v_s, v_s_ = [], []
+            with torch.no_grad(), autocast(self._precision):
+                for minibatch in batch.split(self._batch,
+                                             shuffle=False,
+                                             merge_last=True):
+                    v_s.append(self.critic(minibatch.critic_obs).float())
+                    v_s_.append(self.critic(minibatch.critic_obs_next).float())
+            v_s = torch.cat(v_s, dim=0).flatten()
+            v_s_ = torch.cat(v_s_, dim=0).flatten()
+        batch.v_s = v_s  # old value
+        v_s = self._unnormalize_value(batch.v_s.cpu().numpy())
+        v_s_ = self._unnormalize_value(v_s_.cpu().numpy())
         unnormalized_returns, advantages = self.compute_episodic_return(
             batch,
             buffer,
@@ -71,6 +154,75 @@ class PPOPolicy(BasePPO):
             v_s,
             gamma=self._gamma,
             gae_lambda=self._lambda)
+        return self._set_returns(batch, unnormalized_returns, advantages)
+
+    def _value_plan(self, batch: Batch, buffer: ReplayBuffer,
+                    indices: np.ndarray) -> Optional[ValuePlan]:
+        """Plan which values a recomputation of the advantages needs.
+
+        v_s_[i] is the value of critic_obs_next[i], which is the value of
+        critic_obs[j] if the transition j following i in the buffer is in the
+        batch and critic_obs[j] == critic_obs_next[i]. Such v_s_ are read off
+        the fresh v_s. The v_s_ of terminated transitions are masked out by
+        GAE and not computed at all.
+
+        :return: (rows, successors, rest), where v_s_[rows] is
+            v_s[successors] and v_s_[rest] are computed by the critic, or None
+            if the critic inputs cannot be compared, e.g. dict obs
+        """
+        if isinstance(batch.critic_obs, Batch) or isinstance(
+                batch.critic_obs_next, Batch):
+            return None
+        indices = np.asarray(indices)
+        bsz = len(indices)
+        position = np.full(buffer.maxsize, -1)
+        position[indices] = np.arange(bsz)
+        next_indices = buffer.next(indices)
+        successors = position[next_indices]
+        mask = self.value_mask(buffer, indices)
+        rows = np.nonzero((next_indices != indices) & (successors >= 0)
+                          & mask)[0]
+        obs = np.asarray(batch.critic_obs).reshape(bsz, -1)
+        obs_next = np.asarray(batch.critic_obs_next).reshape(bsz, -1)
+        rows = rows[np.all(obs_next[rows] == obs[successors[rows]], axis=1)]
+        rest = np.setdiff1d(np.nonzero(mask)[0], rows)
+        return rows, successors[rows], rest
+
+    def _planned_values(
+        self, batch: Batch, plan: Optional[ValuePlan]
+    ) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """Compute v_s and the v_s_ needed by GAE as planned by `_value_plan`,
+        (None, None) without a plan."""
+        if plan is None:
+            return None, None
+        rows, successors, rest = plan
+        v_s = []
+        with torch.no_grad(), autocast(self._precision):
+            for minibatch in batch.split(self._batch,
+                                         shuffle=False,
+                                         merge_last=True):
+                v_s.append(self.critic(minibatch.critic_obs).float())
+            v_s = torch.cat(v_s, dim=0).flatten()
+            v_s_ = torch.zeros_like(v_s)
+            v_s_[rows] = v_s[successors]
+            for start in range(0, len(rest), self._batch):
+                chunk = rest[start:start + self._batch]
+                v_s_[chunk] = self.critic(
+                    batch.critic_obs_next[chunk]).float().flatten()
+        return v_s, v_s_
+
+    def _unnormalize_value(self, v: np.ndarray) -> np.ndarray:
+        # when normalizing values, we do not minus self.ret_rms.mean to be numerically
+        # consistent with OPENAI baselines' value normalization pipeline. Emperical
+        # study also shows that "minus mean" will harm performances a tiny little bit
+        # due to unknown reasons (on Mujoco envs, not confident, though).
+        if self._rew_norm:  # unnormalize v_s & v_s_
+            v = v * np.sqrt(self.ret_rms.var + self._eps)
+        return v
+
+    def _set_returns(self, batch: Batch, unnormalized_returns: np.ndarray,
+                     advantages: np.ndarray) -> Batch:
+        """Store the (normalized) returns and the advantages into batch."""
         if self._rew_norm:
             batch.returns = unnormalized_returns / \
                 np.sqrt(self.ret_rms.var + self._eps)
@@ -83,60 +235,215 @@ class PPOPolicy(BasePPO):
 
     def learn(  # type: ignore
             self, batch: Batch, batch_size: int, repeat: int,
-            **kwargs: Any) -> Dict[str, List[float]]:
-        losses, clip_losses, vf_losses, ent_losses = [], [], [], []
+            **kwargs: Any) -> Dict[str, Union[float, List[float]]]:
+        stats = []
+        epochs = 0
+        batch_size = self._local_batch_size(batch_size)
+        shard = self._shard(batch)
+        data = self._to_tensors(shard)
         for step in range(repeat):
             if self._recompute_adv and step > 0:
+                if step == 1:
+                    plan = self._value_plan(batch, self._buffer, self._indices)
+                v_s, v_s_ = self._planned_values(batch, plan)
                 batch = self._compute_returns(batch, self._buffer,
-                                              self._indices)
-            for minibatch in batch.split(batch_size, merge_last=True):
-                # calculate loss for actor
-                dist = self(minibatch).dist
-                if self._norm_adv:
-                    mean, std = minibatch.adv.mean(), minibatch.adv.std()
-                    minibatch.adv = (minibatch.adv -
-                                     mean) / std  # per-batch norm
-                ratio = (dist.log_prob(minibatch.act) -
-                         minibatch.logp_old).exp().float()
-                ratio = ratio.reshape(ratio.size(0), -1).transpose(0, 1)
-                surr1 = ratio * minibatch.adv
-                surr2 = ratio.clamp(1.0 - self._eps_clip,
-                                    1.0 + self._eps_clip) * minibatch.adv
-                if self._dual_clip:
-                    clip1 = torch.min(surr1, surr2)
-                    clip2 = torch.max(clip1, self._dual_clip * minibatch.adv)
-                    clip_loss = -torch.where(minibatch.adv < 0, clip2,
-                                             clip1).mean()
-                else:
-                    clip_loss = -torch.min(surr1, surr2).mean()
-                # calculate loss for critic
-                value = self.critic(minibatch.critic_obs).flatten()
-                if self._value_clip:
-                    v_clip = minibatch.v_s + \
-                        (value - minibatch.v_s).clamp(-self._eps_clip, self._eps_clip)
-                    vf1 = (minibatch.returns - value).pow(2)
-                    vf2 = (minibatch.returns - v_clip).pow(2)
-                    vf_loss = torch.max(vf1, vf2).mean()
-                else:
-                    vf_loss = (minibatch.returns - value).pow(2).mean()
-                # calculate regularization and overall loss
-                ent_loss = dist.entropy().mean()
-                loss = clip_loss + self._weight_vf * vf_loss \
-                    - self._weight_ent * ent_loss
+                                              self._indices, v_s, v_s_)
+                shard = self._shard(batch)
+                data = self._to_tensors(shard)
+            if data is None:
+                minibatches = shard.split(batch_size, merge_last=True)
+            else:
+                minibatches = self._minibatches(data, batch_size)
+            epoch_start = len(stats)
+            for minibatch in minibatches:
+                with autocast(self._precision):
+                    losses = self._loss(minibatch)
+                loss = losses[0]
                 self.optim.zero_grad()
                 loss.backward()
-                if self._grad_norm:  # clip large gradient
-                    nn.utils.clip_grad_norm_(self._actor_critic.parameters(),
-                                             max_norm=self._grad_norm)
+                self._sync_and_clip_gradients(self._actor_critic.parameters())
                 self.optim.step()
-                clip_losses.append(clip_loss.item())
-                vf_losses.append(vf_loss.item())
-                ent_losses.append(ent_loss.item())
-                losses.append(loss.item())
+                stats.append(torch.stack(losses).detach())
+            epochs += 1
+            if step < repeat - 1 and self._kl_exceeded(stats[epoch_start:]):
+                break
+
+        result = self._loss_stats(stats)
+        result.update(self._step_stats(len(stats), epochs, repeat))
+        return result
 
+    def _kl_exceeded(self, epoch_stats: List[torch.Tensor]) -> bool:
+        """Whether the mean approximate KL of an epoch exceeds target_kl.
+
+        This is the only host sync of `learn`, once per epoch, and the KL is
+        averaged over the ranks first so that they all stop together.
+        """
+        if self._target_kl is None or len(epoch_stats) == 0:
+            return False
+        approx_kl = torch.stack(epoch_stats)[:, -1].mean()
+        if self._data_parallel:
+            approx_kl = all_reduce_mean(approx_kl)
+        return approx_kl.item() > self._target_kl
+
+    @staticmethod
+    def _step_stats(steps: int, epochs: int, repeat: int) -> Dict[str, int]:
+        """The gradient steps run and those skipped by early stopping."""
+        steps_per_epoch = steps // max(epochs, 1)
         return {
-            "loss": losses,
-            "loss/clip": clip_losses,
-            "loss/vf": vf_losses,
-            "loss/ent": ent_losses,
+            "steps": steps,
+            "skipped_steps": (repeat - epochs) * steps_per_epoch,
         }
+
+    def _shard(self, batch: Batch) -> Batch:
+        """The rows of the batch this rank learns from."""
+        if not self._data_parallel or not is_distributed():
+            return batch
+        return batch[shard_indices(len(batch))]
+
+    def _local_batch_size(self, batch_size: int) -> int:
+        """The minibatch size of this rank, batch_size is the global one."""
+        if not self._data_parallel or not is_distributed():
+            return batch_size
+        return max(1, batch_size // dist.get_world_size())
+
+    def _to_tensors(
+        self,
+        batch: Batch,
+        keys: Tuple[str, ...] = MINIBATCH_KEYS
+    ) -> Optional[Dict[str, torch.Tensor]]:
+        """Convert the keys read by the loss once to contiguous tensors, so
+        that minibatches are gathered with `index_select` instead of slicing
+        every key of the Batch.
+
+        :return: the tensors on the device of v_s, or None if some key is not
+            array-like (e.g. a dict obs), in which case Batch.split is used
+        """
+        data = {}
+        for key in keys:
+            if isinstance(batch[key], Batch):
+                return None
+            data[key] = torch.as_tensor(batch[key],
+                                        device=batch.v_s.device).contiguous()
+        return data
+
+    def _minibatches(self, data: Dict[str, torch.Tensor],
+                     batch_size: int) -> Iterator[Batch]:
+        """Gather shuffled minibatches of data, merging the last one if it is
+        smaller than batch_size as Batch.split(merge_last=True) does."""
+        for index in self._minibatch_indices(len(data["v_s"]), batch_size,
+                                             data["v_s"].device):
+            yield self._gather(data, index)
+
+    @staticmethod
+    def _gather(data: Dict[str, torch.Tensor], index: torch.Tensor) -> Batch:
+        minibatch = Batch({
+            k: v.index_select(0, index)
+            for k, v in data.items()
+        })
+        minibatch.info = Batch()
+        return minibatch
+
+    @staticmethod
+    def _minibatch_indices(
+            size: int,
+            batch_size: int,
+            device: Union[str, torch.device] = "cpu") -> List[torch.Tensor]:
+        """Split a random permutation of range(size) into minibatch indices."""
+        indices = torch.randperm(size, device=device)
+        if batch_size <= 0 or batch_size >= size:
+            return [indices]
+        split_sizes = [batch_size] * (size // batch_size)
+        if size % batch_size:
+            split_sizes[-1] += size % batch_size  # merge the last minibatch
+        return list(torch.split(indices, split_sizes))
+
+    def _loss_stats(
+            self,
+            stats: List[torch.Tensor]) -> Dict[str, Union[float, List[float]]]:
+        """Reduce the per-minibatch losses kept on device in a single transfer.
+
+        :param List[torch.Tensor] stats: one [loss, clip, vf, ent, approx_kl]
+            tensor per minibatch
+        :return: the mean of each loss, or every minibatch's losses if
+            loss_detail is set
+        """
+        keys = ["loss", "loss/clip", "loss/vf", "loss/ent", "approx_kl"]
+        if len(stats) == 0:
+            return {k: [] for k in keys}
+        stats = torch.stack(stats)
+        if self._data_parallel:
+            stats = all_reduce_mean(stats)
+        if self._loss_detail:
+            return dict(zip(keys, stats.T.tolist()))
+        return dict(zip(keys, stats.mean(dim=0).tolist()))
+
+    def _sync_and_clip_gradients(self, parameters: Iterator[nn.Parameter]) -> None:
+        """Average the gradients over the ranks with data_parallel, then clip
+        them to max_grad_norm if set."""
+        parameters = list(parameters)
+        if self._data_parallel:
+            all_reduce_gradients(parameters)
+        if self._grad_norm:  # clip large gradient
+            nn.utils.clip_grad_norm_(parameters, max_norm=self._grad_norm)
+
+    def _normalize_adv(self, adv: torch.Tensor) -> torch.Tensor:
+        """Normalize the advantages of a minibatch, with data_parallel by the
+        mean and std of the minibatch over all ranks, i.e. of the global one.
+
+        The ranks' minibatches have the same size, so the global mean and
+        mean square are the averages of theirs, in a single all-reduce.
+        """
+        if not self._data_parallel or not is_distributed():
+            return (adv - adv.mean()) / adv.std()  # per-batch norm
+        size = adv.numel() * dist.get_world_size()
+        mean, sq_mean = all_reduce_mean(
+            torch.stack([adv.mean(), adv.pow(2).mean()]))
+        # the unbiased std as Tensor.std
+        std = ((sq_mean - mean**2).clamp(min=0) * size / (size - 1)).sqrt()
+        return (adv - mean) / std
+
+    def _loss(self,
+              minibatch: Batch,
+              critic_input: Optional[torch.Tensor] = None
+              ) -> Tuple[torch.Tensor, ...]:
+        """Compute the overall, clip, value and entropy losses of a minibatch,
+        and the approximate KL divergence from the old policy.
+
+        :param critic_input: the input of the critic, defaults to
+            minibatch.critic_obs
+        """
+        # calculate loss for actor
+        dist = self(minibatch).dist
+        if self._norm_adv:
+            minibatch.adv = self._normalize_adv(minibatch.adv)
+        log_ratio = dist.log_prob(minibatch.act).float() - minibatch.logp_old
+        ratio = log_ratio.exp()
+        # the low-variance, non-negative estimator of KL(old || new)
+        approx_kl = ((ratio - 1) - log_ratio).mean().detach()
+        ratio = ratio.reshape(ratio.size(0), -1).transpose(0, 1)
+        surr1 = ratio * minibatch.adv
+        surr2 = ratio.clamp(1.0 - self._eps_clip,
+                            1.0 + self._eps_clip) * minibatch.adv
+        if self._dual_clip:
+            clip1 = torch.min(surr1, surr2)
+            clip2 = torch.max(clip1, self._dual_clip * minibatch.adv)
+            clip_loss = -torch.where(minibatch.adv < 0, clip2, clip1).mean()
+        else:
+            clip_loss = -torch.min(surr1, surr2).mean()
+        # calculate loss for critic
+        if critic_input is None:
+            critic_input = minibatch.critic_obs
+        value = self.critic(critic_input).flatten().float()
+        if self._value_clip:
+            v_clip = minibatch.v_s + \
+                (value - minibatch.v_s).clamp(-self._eps_clip, self._eps_clip)
+            vf1 = (minibatch.returns - value).pow(2)
+            vf2 = (minibatch.returns - v_clip).pow(2)
+            vf_loss = torch.max(vf1, vf2).mean()
+        else:
+            vf_loss = (minibatch.returns - value).pow(2).mean()
+        # calculate regularization and overall loss
+        ent_loss = dist.entropy().float().mean()
+        loss = clip_loss + self._weight_vf * vf_loss \
+            - self._weight_ent * ent_loss
+        return loss, clip_loss, vf_loss, ent_loss, approx_kl
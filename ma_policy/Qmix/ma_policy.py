@@ -1,4 +1,5 @@
 import copy
+from contextlib import ExitStack
 from typing import Any, Dict, List, Optional, Type, Union
 
 import numpy as np
@@ -10,6 +11,7 @@ from tianshou.policy import DQNPolicy
 
 from marl_comm.data import MAReplayBuffer
 from marl_comm.ma_policy import MAPolicyManager
+from marl_comm.utils.precision import PRECISIONS, autocast, autocast_forward
 
 
 class QMIXPolicy(MAPolicyManager):
@@ -26,13 +28,21 @@ class QMIXPolicy(MAPolicyManager):
                  mixer_optim_cls: Type[
                      torch.optim.Optimizer] = torch.optim.Adam,
                  mixer_optim_kwargs: Optional[Dict[str, Any]] = {},
+                 precision: str = "fp32",
                  **kwargs: Any) -> None:
+        """
+        :param str precision: precision of the forward and loss computation,
+            choices include {"fp32", "bf16"}. With "bf16" they run under CPU
+            autocast while the weights and the optimizer state stay in fp32,
+            defaults to "fp32"
+        """
         train_scheme = "FD" if not mixer else "CTDE"
         parameter_mode = "Indvd"
         critic_mode = "IC"
         comm = False
 
-        assert env.state_space is not None
+        assert not mixer or getattr(env, "state_space", None) is not None
+        assert precision in PRECISIONS, f"precision must be in {set(PRECISIONS)}"
 
         super().__init__(policies, env, train_scheme, parameter_mode,
                          critic_mode, comm, **kwargs)
@@ -44,6 +54,7 @@ class QMIXPolicy(MAPolicyManager):
         self._freq = target_update_freq
         self._iter = 0
         self._rew_norm = reward_normalization
+        self._precision = precision
 
         self.mixer = mixer
         if self.mixer:
@@ -70,23 +81,25 @@ class QMIXPolicy(MAPolicyManager):
                  indices: np.ndarray,
                  target: bool = False) -> torch.Tensor:
         if target:
-            target_qs = [
-                self._policies[agent_i]._target_q(
-                    buffer.get_agent_buffer(agent_i), indices)
-                for agent_i in range(self.agent_num)
-            ]
-            target_qs = torch.stack(target_qs, dim=1)
-            target_state = buffer.get_agent_buffer(
-                0)[indices]["obs_next"]["state"]
-            return self.target_mixer(target_qs, target_state)
+            with autocast(self._precision):
+                target_qs = [
+                    self._policies[agent_i]._target_q(
+                        buffer.get_agent_buffer(agent_i), indices)
+                    for agent_i in range(self.agent_num)
+                ]
+                target_qs = torch.stack(target_qs, dim=1)
+                target_state = buffer.get_agent_buffer(
+                    0)[indices]["obs_next"]["state"]
+                return self.target_mixer(target_qs, target_state).float()
         else:
-            qs = [
-                self._get_agent_q(buffer, indices, agent_i)
-                for agent_i in range(self.agent_num)
-            ]
-            qs = torch.stack(qs, dim=1)
-            state = buffer.get_agent_buffer(0)[indices]["obs"]["state"]
-            return self.mixer(qs, state)
+            with autocast(self._precision):
+                qs = [
+                    self._get_agent_q(buffer, indices, agent_i)
+                    for agent_i in range(self.agent_num)
+                ]
+                qs = torch.stack(qs, dim=1)
+                state = buffer.get_agent_buffer(0)[indices]["obs"]["state"]
+                return self.mixer(qs, state).float()
 
     def process_fn(self, batch: Batch, buffer: MAReplayBuffer,
                    indices: np.ndarray) -> Batch:
@@ -109,7 +122,14 @@ class QMIXPolicy(MAPolicyManager):
     def learn(self, batch: Batch,
               **kwargs: Any) -> Dict[str, Union[float, List[float]]]:
         if not self.mixer:
-            return super().learn(batch, **kwargs)
+            # tianshou's DQNPolicy.learn runs the forward pass, the backward
+            # pass and the optimizer step in one call, so only the forward of
+            # the models is autocast and the loss is computed from fp32 q
+            with ExitStack() as stack:
+                for policy in self._policies:
+                    stack.enter_context(
+                        autocast_forward(policy.model, self._precision))
+                return super().learn(batch, **kwargs)
         else:
             if self._iter % self._freq == 0:
                 self.sync_weight()
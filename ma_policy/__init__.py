@@ -1,6 +1,19 @@
-from marl_comm.ma_policy.base import MAPolicyManager
-from marl_comm.ma_policy.MAPPO.ma_policy import MAPPOPolicy
-from marl_comm.ma_policy.MAPPO.policy import PPOPolicy
-from marl_comm.ma_policy.Qmix.ma_policy import QMIXPolicy
+from typing import TYPE_CHECKING
 
-__all__ = ["MAPolicyManager", "QMIXPolicy", "PPOPolicy"]
+from marl_comm.utils.lazy import lazy_attributes
+
+if TYPE_CHECKING:
+    from marl_comm.ma_policy.base import MAPolicyManager
+    from marl_comm.ma_policy.MAPPO.ma_policy import MAPPOPolicy
+    from marl_comm.ma_policy.MAPPO.policy import PPOPolicy
+    from marl_comm.ma_policy.Qmix.ma_policy import QMIXPolicy
+
+__all__ = ["MAPolicyManager", "MAPPOPolicy", "QMIXPolicy", "PPOPolicy"]
+
+__getattr__, __dir__ = lazy_attributes(
+    __name__, {
+        "MAPolicyManager": "marl_comm.ma_policy.base",
+        "MAPPOPolicy": "marl_comm.ma_policy.MAPPO.ma_policy",
+        "PPOPolicy": "marl_comm.ma_policy.MAPPO.policy",
+        "QMIXPolicy": "marl_comm.ma_policy.Qmix.ma_policy",
+    })
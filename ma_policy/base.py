@@ -1,10 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
+import torch
 import torch.nn as nn
-from tianshou.data import Batch
+from tianshou.data import Batch, to_numpy
 from tianshou.env.pettingzoo_env import PettingZooEnv
-from tianshou.policy import BasePolicy
+from tianshou.policy import BasePolicy, RandomPolicy
 
 from marl_comm.data import MAReplayBuffer
 
@@ -37,6 +39,8 @@ class MAPolicyManager(BasePolicy):
         parameter_mode: str = "Indvd",
         critic_mode: str = "IC",
         comm: bool = False,
+        learn_threads: int = 1,
+        agent_id_onehot: bool = False,
         **kwargs: Any,
     ) -> None:
         """
@@ -46,6 +50,8 @@ class MAPolicyManager(BasePolicy):
         :param str parameter_mode: parameter mode in CTDE, choices include {"Indvd", "shared", "IndvdGI"}, defaults to "Indvd"
         :param str critic_mode: choices include {"IC", "JC"}, defaults to "IC"
         :param bool comm: whether to use communication
+        :param int learn_threads: number of threads running the per-agent `policy.learn` calls concurrently when the parameters are not shared, the intra-op threads of torch are split evenly between them, defaults to 1
+        :param bool agent_id_onehot: whether to append the one-hot agent id to the obs with shared parameters, so that the shared policy can tell the agents apart, defaults to False
         """
         assert train_scheme in ["CTDE",
                                 "FD"], "train_scheme must be in {'CTDE', 'FD'}"
@@ -56,11 +62,16 @@ class MAPolicyManager(BasePolicy):
         ], 'parameter_mode must be in {"Indvd", "shared", "IndvdGI"}'
         assert critic_mode in ["IC",
                                "JC"], "critic_mode must be in {'IC', 'JC'}"
+        assert learn_threads > 0, "learn_threads must be positive"
+        assert (not agent_id_onehot or parameter_mode
+                == "shared"), "agent_id_onehot requires shared parameters"
         super().__init__(action_space=env.action_space, **kwargs)
         self.train_scheme = train_scheme
         self.parameter_mode = parameter_mode
         self.critic_mode = critic_mode
         self.comm = comm
+        self.learn_threads = learn_threads
+        self.agent_id_onehot = agent_id_onehot
 
         self.agent_idx = env.agent_idx
         self.agents = env.agents
@@ -80,11 +91,18 @@ class MAPolicyManager(BasePolicy):
             assert (len(policies) == 1
                     ), "Only one policy can be assigned for parameter sharing."
             # The agent id is 0 for the parameter sharing policy
+            assert not getattr(
+                policies[0], "_recompute_adv", False
+            ), "recompute_advantage is not supported with shared parameters"
             policies = policies * len(env.agents)
 
         self.policies = dict(zip(env.agents, policies))
         self._policies = nn.ModuleList(policies)
 
+    def _shares_parameters(self) -> bool:
+        """Whether all agents are trained as one policy on agent-stacked data."""
+        return self.train_scheme == "CTDE" and self.parameter_mode == "shared"
+
     def replace_policy(self, policy: BasePolicy, agent_id: int) -> None:
         """Replace the "agent_id"th policy in this manager."""
         policy.set_agent_id(agent_id)
@@ -116,6 +134,23 @@ class MAPolicyManager(BasePolicy):
         # TODO: We can only access the last layer of the actor and critic, while it is hard to check whether the input dim of the preprocessing net is right.
         return True
 
+    def update(self, sample_size: int, buffer: Optional[MAReplayBuffer],
+               **kwargs: Any) -> Dict[str, Any]:
+        """With shared parameters, sample the same indices of all agents as one
+        agent-stacked batch and update the shared policy on it at once."""
+        if buffer is None or not self._shares_parameters():
+            return super().update(sample_size, buffer, **kwargs)
+        indices = buffer.stacked_indices(buffer.sample_indices(sample_size))
+        batch = buffer[indices]
+        self.updating = True
+        batch = self.process_fn(batch, buffer, indices)
+        result = self.learn(batch, **kwargs)
+        self.post_process_fn(batch, buffer, indices)
+        if self.lr_scheduler is not None:
+            self.lr_scheduler.step()
+        self.updating = False
+        return result
+
     def process_fn(self, batch: Batch, buffer: MAReplayBuffer,
                    indice: np.ndarray) -> Batch:
         """The batch from buffer has the structure
@@ -126,7 +161,16 @@ class MAPolicyManager(BasePolicy):
             ...
             "agent_n/xxx": xxx
         }
+        With shared parameters, the batch is instead agent-stacked, i.e.
+        buffer[indice] with indice from `buffer.stacked_indices`, and the shared
+        policy processes it against the whole buffer at once.
         """
+        if self._shares_parameters():
+            if self.agent_id_onehot:
+                batch = self._add_agent_id(batch, buffer.agent_of(indice))
+                buffer = _AgentIdBuffer(self, buffer)
+            return self._policies[0].process_fn(batch, buffer, indice)
+
         batch = self._process_critic_input(batch, buffer=buffer, indice=indice)
 
         results = {}
@@ -136,6 +180,20 @@ class MAPolicyManager(BasePolicy):
 
         return Batch(results)
 
+    def _add_agent_id(self, batch: Batch, agent_ids: np.ndarray) -> Batch:
+        """Append the one-hot agent ids to the (flattened) obs and obs_next."""
+        for key in ["obs", "obs_next"]:
+            if key not in batch.keys() or (isinstance(batch[key], Batch)
+                                           and batch[key].is_empty()):
+                continue
+            holder = batch[key] if hasattr(batch[key], "obs") else batch
+            field = "obs" if hasattr(batch[key], "obs") else key
+            obs = np.asarray(holder[field])
+            onehot = np.eye(self.agent_num, dtype=obs.dtype)[agent_ids]
+            holder[field] = np.concatenate([obs.reshape(len(obs), -1), onehot],
+                                           axis=-1)
+        return batch
+
     def exploration_noise(self, act: Union[np.ndarray, Batch],
                           batch: Batch) -> Union[np.ndarray, Batch]:
         """Add exploration noise from sub-policy onto act."""
@@ -190,6 +248,10 @@ class MAPolicyManager(BasePolicy):
                 tmp_batch.obs = tmp_batch.obs.obs
             if hasattr(tmp_batch.obs_next, "obs"):
                 tmp_batch.obs_next = tmp_batch.obs_next.obs
+            if self.agent_id_onehot:
+                tmp_batch = self._add_agent_id(
+                    tmp_batch,
+                    np.full(len(agent_index), self.agent_idx[agent_id]))
             # print(tmp_batch.obs)
             out = policy(
                 batch=tmp_batch,
@@ -223,6 +285,45 @@ class MAPolicyManager(BasePolicy):
             holder["state"] = state_dict
         return holder
 
+    def action_probs(self,
+                     batch: Batch,
+                     exploration_noise: bool = False) -> np.ndarray:
+        """Compute the distribution of the actions that forward would take,
+        dispatched from obs.agent_id to every policy like forward.
+
+        The distribution is read from the "dist" output of the policy when it
+        samples its actions (e.g. PPO), otherwise the action of forward is
+        taken as deterministic (e.g. greedy DQN, or PPO with deterministic
+        evaluation). RandomPolicy picks uniformly among the available actions.
+
+        :param Batch batch: the batch with obs.agent_id, obs.obs and obs.mask
+        :param bool exploration_noise: whether to add the epsilon-greedy noise
+            of the policies which have an "eps", as Collector does with
+            exploration_noise, defaults to False
+        :return np.ndarray: the probabilities with the shape [len(batch),
+            action_num]
+        """
+        probs = np.zeros((len(batch), self.action_space.n))
+        for agent_id, policy in self.policies.items():
+            agent_index = np.nonzero(batch.obs.agent_id == agent_id)[0]
+            if len(agent_index) == 0:
+                continue
+            tmp_batch = batch[agent_index]
+            if hasattr(tmp_batch.obs, "mask"):
+                mask = np.asarray(tmp_batch.obs.mask, dtype=float)
+            else:
+                mask = np.ones((len(agent_index), self.action_space.n))
+            tmp_batch.obs = tmp_batch.obs.obs
+            if self.agent_id_onehot:
+                tmp_batch = self._add_agent_id(
+                    tmp_batch,
+                    np.full(len(agent_index), self.agent_idx[agent_id]))
+            with torch.no_grad():
+                out = policy(batch=tmp_batch)
+            probs[agent_index] = _policy_action_probs(policy, out, mask,
+                                                      exploration_noise)
+        return probs
+
     def learn(self, batch: Batch,
               **kwargs: Any) -> Dict[str, Union[float, List[float]]]:
         """Dispatch the data to all policies for learning.
@@ -239,21 +340,88 @@ class MAPolicyManager(BasePolicy):
                 "agent_n/xxx": xxx
             }
         """
-        if not (self.train_scheme == "CTDE"
-                and self.parameter_mode == "shared"):
+        if not self._shares_parameters():
+            jobs = [(agent_id, policy, batch[agent_id])
+                    for agent_id, policy in self.policies.items()
+                    if not batch[agent_id].is_empty()]
+            if self.learn_threads > 1 and len(jobs) > 1:
+                outs = self._learn_concurrently(jobs, **kwargs)
+            else:
+                outs = [
+                    policy.learn(batch=data, **kwargs)
+                    for _, policy, data in jobs
+                ]
             results = {}
-            for agent_id, policy in self.policies.items():
-                data = batch[agent_id]
-                if not data.is_empty():
-                    out = policy.learn(batch=data, **kwargs)
-                    for k, v in out.items():
-                        results[agent_id + "/" + k] = v
+            for (agent_id, _, _), out in zip(jobs, outs):
+                for k, v in out.items():
+                    results[agent_id + "/" + k] = v
         else:
-            # CTDE with shared parameters
-            data = Batch.cat(
-                [data[agent_id] for agent_id in self.policies.keys()])
-            if not data.is_empty():
-                policy = self.policies[0]
-                results = policy.learn(batch=data, **kwargs)
+            # CTDE with shared parameters, the batch is already agent-stacked
+            results = {}
+            if not batch.is_empty():
+                results = self._policies[0].learn(batch=batch, **kwargs)
 
         return results
+
+    def _learn_concurrently(self, jobs: List[Tuple[str, BasePolicy, Batch]],
+                            **kwargs: Any) -> List[Dict[str, Any]]:
+        """Run independent `policy.learn` calls on a thread pool.
+
+        torch releases the GIL inside its ops, so the agents' updates overlap.
+        The intra-op thread count of torch is global to the process, so it is
+        lowered once for the whole pool, to the share of the cores of one
+        worker thread, and restored afterwards.
+        """
+        num_threads = torch.get_num_threads()
+        num_workers = min(self.learn_threads, len(jobs))
+        torch.set_num_threads(max(1, num_threads // num_workers))
+        try:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [
+                    executor.submit(policy.learn, batch=data, **kwargs)
+                    for _, policy, data in jobs
+                ]
+                return [future.result() for future in futures]
+        finally:
+            torch.set_num_threads(num_threads)
+
+
+def _policy_action_probs(policy: BasePolicy, out: Batch, mask: np.ndarray,
+                         exploration_noise: bool) -> np.ndarray:
+    """The action distribution of a single policy, see action_probs."""
+    uniform = mask / mask.sum(axis=-1, keepdims=True)
+    if isinstance(policy, RandomPolicy):
+        return uniform
+    dist = getattr(out, "dist", None)
+    deterministic = getattr(policy, "_deterministic_eval",
+                            False) and not policy.training
+    if dist is not None and hasattr(dist, "probs") and not deterministic:
+        probs = to_numpy(dist.probs).astype(float)
+    else:
+        probs = np.eye(mask.shape[-1])[to_numpy(out.act).astype(int)]
+    eps = getattr(policy, "eps", 0.0)
+    if exploration_noise and not np.isclose(eps, 0.0):
+        # a uniformly random available action with probability eps
+        probs = (1 - eps) * probs + eps * uniform
+    return probs
+
+
+class _AgentIdBuffer:
+    """A read-only view of an MAReplayBuffer which appends the one-hot agent id
+    to the obs it returns, for the policies reading obs from the buffer in
+    process_fn, e.g. the target q of DQN."""
+
+    def __init__(self, manager: MAPolicyManager,
+                 buffer: MAReplayBuffer) -> None:
+        self._manager = manager
+        self._buffer = buffer
+
+    def __getattr__(self, key: str) -> Any:
+        return getattr(self._buffer, key)
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def __getitem__(self, index: np.ndarray) -> Batch:
+        return self._manager._add_agent_id(self._buffer[index],
+                                           self._buffer.agent_of(index))
@@ -0,0 +1,317 @@
+import time
+
+import numpy as np
+from tianshou.data import Batch, VectorReplayBuffer
+from tianshou.env import DummyVectorEnv, SubprocVectorEnv
+from tianshou.policy import RandomPolicy
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(root)
+from marl_comm.data import MACollector, MAReplayBuffer
+from marl_comm.env import BatchedSubprocVectorEnv, MAEnvWrapper, get_MA_VectorEnv
+from marl_comm.games import dilemma_pettingzoo
+from marl_comm.ma_policy import MAPolicyManager
+
+
+def get_env():
+    return MAEnvWrapper(dilemma_pettingzoo.env(max_cycles=3))
+
+
+def rollout(venv, steps, seed=0):
+    """Step random actions, resetting the finished envs like MACollector."""
+    rng = np.random.RandomState(seed)
+    results = [venv.reset()]
+    ready_env_ids = np.arange(venv.env_num)
+    for _ in range(steps):
+        action = rng.randint(2, size=len(ready_env_ids))
+        obs, rew, *done, info = venv.step(action, ready_env_ids)
+        done = np.logical_or.reduce(done)
+        ready_env_ids = np.array([i["env_id"] for i in info])
+        results.append((obs, rew, done, ready_env_ids))
+        if done.any():
+            if venv.autoreset:
+                reset_obs = [info[i].pop("reset_obs") for i in np.where(done)[0]]
+                results.append(np.array(reset_obs, dtype=object))
+            else:
+                results.append(venv.reset(ready_env_ids[done]))
+        assert all("reset_obs" not in i for i in info)
+    return results
+
+
+def test_batched_venv(env_num=5, steps=10):
+    ref_venv = get_MA_VectorEnv(DummyVectorEnv, [get_env] * env_num)
+    # the last worker hosts a partial slice
+    venv = get_MA_VectorEnv(
+        BatchedSubprocVectorEnv, [get_env] * env_num, envs_per_worker=2
+    )
+    assert venv.worker_num == 3
+    assert len(venv) == len(ref_venv)
+    assert venv.agents == ref_venv.agents
+    assert venv.get_env_attr("num_agents", [4, 1]) == [2, 2]
+    venv.set_env_attr("tag", 4, [0, 3])
+    ref_venv.set_env_attr("tag", 4, [0, 3])
+    assert venv.get_env_attr("tag", [0, 3]) == ref_venv.get_env_attr("tag", [0, 3])
+    assert str(rollout(venv, steps)) == str(rollout(ref_venv, steps))
+    venv.close()
+
+
+def test_autoreset(env_num=5, steps=10):
+    ref_venv = get_MA_VectorEnv(DummyVectorEnv, [get_env] * env_num)
+    for venv_cls, kwargs in [
+        (DummyVectorEnv, {}),
+        (BatchedSubprocVectorEnv, {"envs_per_worker": 2}),
+    ]:
+        venv = get_MA_VectorEnv(venv_cls, [get_env] * env_num, autoreset=True, **kwargs)
+        assert venv.autoreset and all(venv.get_env_attr("autoreset"))
+        # the same transitions, without the calls to reset
+        assert str(rollout(venv, steps)) == str(rollout(ref_venv, steps))
+        venv.close()
+
+
+def test_obs_preprocess(env_num=3, steps=10):
+    scale = 10
+    ref_venv = get_MA_VectorEnv(DummyVectorEnv, [get_env] * env_num)
+    ref = rollout(ref_venv, steps)
+    for venv_cls, kwargs in [
+        (DummyVectorEnv, {}),
+        (SubprocVectorEnv, {}),
+        (BatchedSubprocVectorEnv, {"envs_per_worker": 2}),
+    ]:
+        # a closure, which is shipped to the workers with cloudpickle
+        venv = get_MA_VectorEnv(
+            venv_cls,
+            [get_env] * env_num,
+            autoreset=True,
+            obs_preprocess_fn=lambda obs: obs * scale,
+            **kwargs,
+        )
+        results = rollout(venv, steps)
+        assert len(results) == len(ref)
+        for result, ref_result in zip(results, ref):
+            obs, ref_obs = result, ref_result
+            if isinstance(result, tuple):
+                obs, ref_obs = result[0], ref_result[0]
+                assert str(result[1:]) == str(ref_result[1:])
+            for o, ref_o in zip(obs, ref_obs):
+                assert o["agent_id"] == ref_o["agent_id"]
+                assert np.array_equal(o["obs"], ref_o["obs"] * scale)
+        venv.close()
+
+
+def get_long_env():
+    return MAEnvWrapper(dilemma_pettingzoo.env(max_cycles=100))
+
+
+def test_joint_step(env_num=3, rounds=4):
+    ref_venv = get_MA_VectorEnv(DummyVectorEnv, [get_long_env] * env_num)
+    for venv_cls, kwargs in [
+        (DummyVectorEnv, {}),
+        (BatchedSubprocVectorEnv, {"envs_per_worker": 2}),
+    ]:
+        rng = np.random.RandomState(0)
+        venv = get_MA_VectorEnv(venv_cls, [get_long_env] * env_num, **kwargs)
+        venv.reset()
+        ref_venv.reset()
+        for _ in range(rounds):
+            actions = rng.randint(2, size=(env_num, venv.agent_num))
+            obs, rew, *flags, info = venv.joint_step(actions)
+            # the same as stepping the turns one by one
+            ready_env_ids = np.arange(env_num)
+            for turn in range(venv.agent_num):
+                ref_obs, ref_rew, *ref_flags, ref_info = ref_venv.step(
+                    actions[:, turn], ready_env_ids
+                )
+                ready_env_ids = np.array([i["env_id"] for i in ref_info])
+                assert str(list(obs[:, turn])) == str(list(ref_obs))
+                assert np.array_equal(rew[:, turn], ref_rew)
+                for flag, ref_flag in zip(flags, ref_flags):
+                    assert np.array_equal(flag[:, turn], ref_flag)
+            assert [i["turns"] for i in info] == [venv.agent_num] * env_num
+            assert np.array_equal([i["env_id"] for i in info], ready_env_ids)
+            joint_obs = [i["joint_obs"] for i in info]
+            assert [o["agent_id"] for o in joint_obs[0]] == venv.agents
+        venv.close()
+
+
+class options_env(dilemma_pettingzoo.raw_env):
+    def reset(self, seed=None, return_info=False, options=None):
+        super().reset(seed, return_info, options)
+        self.reset_options.append(options)
+
+
+def test_autoreset_kwargs(env_num=2, max_cycles=3):
+    def get_env():
+        env = options_env(max_cycles=max_cycles)
+        env.reset_options = []
+        return MAEnvWrapper(env)
+
+    env = get_env()
+    policy = MAPolicyManager([RandomPolicy()] * 2, env, train_scheme="FD")
+    venv = get_MA_VectorEnv(DummyVectorEnv, [get_env] * env_num, autoreset=True)
+    buffer = MAReplayBuffer(100, env.agents, VectorReplayBuffer, env_num)
+    collector = MACollector(policy, venv, buffer)
+    for options in [{"level": 1}, None]:
+        for raw_env in venv.get_env_attr("env"):
+            raw_env.reset_options.clear()
+        kwargs = None if options is None else {"options": options}
+        collector.collect(
+            n_step=env_num * 2 * max_cycles, random=True, gym_reset_kwargs=kwargs
+        )
+        # the resets in the workers get the kwargs of collect
+        for raw_env in venv.get_env_attr("env"):
+            assert raw_env.reset_options == [options] * 2
+
+
+class obs_policy(RandomPolicy):
+    """Acts on the last joint action, to tell apart the obs acted on."""
+
+    def forward(self, batch, state=None, **kwargs):
+        return Batch(act=np.asarray(batch.obs).sum(-1) % 2)
+
+
+def count_sends(venv):
+    """Count the messages sent to the workers of a BatchedSubprocVectorEnv."""
+    sends = [0]
+    for remote in venv.parent_remotes:
+
+        def send(obj, _send=remote.send):
+            sends[0] += 1
+            _send(obj)
+
+        remote.send = send
+    return sends
+
+
+def test_joint_step_collector(env_num=4, max_cycles=3):
+    def get_env():
+        return MAEnvWrapper(dilemma_pettingzoo.env(max_cycles=max_cycles))
+
+    env = get_env()
+    n_step = env_num * 4 * max_cycles
+    for autoreset in [False, True]:
+        for policies, random in [
+            ([obs_policy()] * 2, False),
+            ([RandomPolicy()] * 2, True),
+        ]:
+            policy = MAPolicyManager(policies, env, train_scheme="FD")
+            buffers = []
+            for joint_step in [False, True]:
+                venv = get_MA_VectorEnv(
+                    DummyVectorEnv, [get_env] * env_num, autoreset=autoreset
+                )
+                buffer = MAReplayBuffer(1000, env.agents, VectorReplayBuffer, env_num)
+                collector = MACollector(policy, venv, buffer, joint_step=joint_step)
+                for i, space in enumerate(collector._action_space):
+                    space.seed(i)
+                result = collector.collect(n_step=n_step, random=random)
+                assert result["n/ep"] == env_num * 4
+                buffers.append(buffer)
+            # the obs do not change within a round of the dilemma games
+            for buf, joint_buf in zip(*[b.buffers for b in buffers]):
+                indices = buf.sample_indices(0)
+                assert np.array_equal(indices, joint_buf.sample_indices(0))
+                for key in ["act", "rew", "terminated", "truncated"]:
+                    assert np.array_equal(
+                        getattr(buf, key)[indices], getattr(joint_buf, key)[indices]
+                    )
+                assert np.array_equal(buf.obs.obs[indices], joint_buf.obs.obs[indices])
+                assert np.array_equal(
+                    buf.obs_next.obs[indices], joint_buf.obs_next.obs[indices]
+                )
+
+    # one message per worker per round instead of one per agent turn
+    policy = MAPolicyManager([obs_policy()] * 2, env, train_scheme="FD")
+    rounds = 2 * max_cycles
+    for joint_step in [False, True]:
+        venv = get_MA_VectorEnv(
+            BatchedSubprocVectorEnv,
+            [get_env] * env_num,
+            autoreset=True,
+            envs_per_worker=2,
+        )
+        buffer = MAReplayBuffer(1000, env.agents, VectorReplayBuffer, env_num)
+        collector = MACollector(policy, venv, buffer, joint_step=joint_step)
+        collector.collect(n_step=env_num * rounds)
+        sends = count_sends(venv)
+        collector.collect(n_step=env_num * rounds)
+        turns = 1 if joint_step else venv.agent_num
+        assert sends[0] == rounds * turns * venv.worker_num
+        venv.close()
+
+
+class sequential_env(dilemma_pettingzoo.raw_env):
+    """The agents observe the moves already made in the round."""
+
+    def step(self, action):
+        super().step(action)
+        for agent in self.agents:
+            self.observations[agent] = list(self.state.values())
+
+
+class mid_round_end_env(sequential_env):
+    """The second round ends after the first turn."""
+
+    def step(self, action):
+        super().step(action)
+        if self.num_moves == 1 and self.agent_selection == self.agents[1]:
+            self.truncations = {agent: True for agent in self.agents}
+
+
+def test_joint_step_obs(env_num=2, max_cycles=3):
+    env = MAEnvWrapper(sequential_env(max_cycles=max_cycles))
+    policy = MAPolicyManager([obs_policy()] * 2, env, train_scheme="FD")
+    venv = get_MA_VectorEnv(
+        DummyVectorEnv,
+        [lambda: MAEnvWrapper(sequential_env(max_cycles=max_cycles))] * env_num,
+    )
+    buffer = MAReplayBuffer(100, env.agents, VectorReplayBuffer, env_num)
+    collector = MACollector(policy, venv, buffer, joint_step=True)
+    collector.collect(n_step=env_num * 2 * max_cycles, random=True)
+    # the second agent is stored with the obs of the start of the round its
+    # actions were chosen on, all moves or none, not with the first move made
+    none = env.env.game.NONE
+    buf = buffer.buffers[1]
+    obs = buf.obs.obs[buf.sample_indices(0)]
+    assert len(obs) > 0
+    assert np.all((obs == none).all(-1) | (obs != none).all(-1))
+
+    venv = get_MA_VectorEnv(
+        DummyVectorEnv, [lambda: MAEnvWrapper(mid_round_end_env())] * env_num
+    )
+    collector = MACollector(policy, venv, buffer, joint_step=True)
+    try:
+        collector.collect(n_step=env_num * 2 * max_cycles)
+    except ValueError as e:
+        assert "after 1 of the 2 turns" in str(e)
+    else:
+        raise AssertionError("an episode ending in a round is not supported")
+
+
+def benchmark(env_num=256, steps=200):
+    for venv_cls, kwargs in [
+        (DummyVectorEnv, {}),
+        (SubprocVectorEnv, {}),
+        (BatchedSubprocVectorEnv, {"envs_per_worker": env_num // os.cpu_count()}),
+    ]:
+        venv = get_MA_VectorEnv(venv_cls, [get_env] * env_num, **kwargs)
+        venv.reset()
+        action = np.zeros(env_num, dtype=int)
+        start = time.time()
+        for _ in range(steps):
+            venv.step(action, np.arange(env_num))
+        fps = steps * env_num / (time.time() - start)
+        print(f"{venv_cls.__name__}: {fps:.0f} env steps/s")
+        venv.close()
+
+
+if __name__ == "__main__":
+    test_batched_venv()
+    test_autoreset()
+    test_obs_preprocess()
+    test_joint_step()
+    test_autoreset_kwargs()
+    test_joint_step_collector()
+    test_joint_step_obs()
+    benchmark()
@@ -0,0 +1,169 @@
+import time
+
+import numpy as np
+from tianshou.data import VectorReplayBuffer
+from tianshou.env import DummyVectorEnv
+from tianshou.policy import RandomPolicy
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(root)
+from marl_comm.data import MACollector, MAReplayBuffer
+from marl_comm.env import MAEnvWrapper, get_MA_VectorEnv
+from marl_comm.games import dilemma_pettingzoo
+from marl_comm.ma_policy import MAPolicyManager
+from marl_comm.games.dilemma_vector import DilemmaVectorEnv
+from marl_comm.games.simple_dilemma_games import get_game_class
+
+
+def raw_step(env, action):
+    """Step a raw_env the way MAEnvWrapper does, once per agent turn."""
+    env.step(action)
+    agent = env.agent_selection
+    terminated = any(env.terminations.values())
+    truncated = any(env.truncations.values())
+    rew = [env.rewards[a] for a in env.agents]
+    return agent, env.observe(agent), rew, terminated, truncated
+
+
+def test_payoff_tensor():
+    game = get_game_class("pd")()
+    assert game.payoff_tensor.shape == (2, 2, 2)
+    assert game.get_payoff()[(game.COOPERATE, game.DEFECT)] == (0, 5)
+    assert np.array_equal(game.get_rewards([game.DEFECT, game.COOPERATE]), [5, 0])
+    # the rewards of a batch of joint actions
+    actions = np.array([[0, 1], [1, 1], [0, 0]]).T
+    assert np.array_equal(game.get_rewards(actions), [[0, 5], [1, 1], [3.5, 3.5]])
+
+    # the payoff dicts are read from the payoff tensors
+    for name in ["pd", "sd", "sh", "chicken"]:
+        game = get_game_class(name)()
+        for actions, rewards in game.get_payoff().items():
+            assert rewards == tuple(game.get_rewards(actions))
+
+    game = get_game_class("pg")(num_players=4)
+    assert game.payoff_tensor.shape == (2,) * 4 + (4,)
+    # a free rider gets more than the contributors, all gain if all contribute
+    rew = game.get_rewards([0, 0, 0, 1])
+    assert rew[3] > rew[0] and rew[0] == rew[1] == rew[2]
+    assert np.all(game.get_rewards([0] * 4) > game.get_rewards([1] * 4))
+
+
+def test_parity(env_num=4, max_cycles=5, steps=40, game="pd", num_players=None):
+    rng = np.random.RandomState(0)
+    raw_envs = [
+        dilemma_pettingzoo.raw_env(game, max_cycles=max_cycles, num_players=num_players)
+        for _ in range(env_num)
+    ]
+    for env in raw_envs:
+        env.reset()
+    venv = DilemmaVectorEnv(
+        env_num, game, max_cycles=max_cycles, num_players=num_players
+    )
+    assert len(venv) == len(raw_envs[0].agents) * env_num
+    assert venv.action_space[0].n == 2
+
+    obs = venv.reset()
+    for i, env in enumerate(raw_envs):
+        assert obs[i]["agent_id"] == env.agent_selection
+        assert np.array_equal(obs[i]["obs"], env.observe(env.agent_selection))
+    # the global ids of the MA layout, agent_index * env_num + env_index
+    ready_env_ids = np.arange(env_num)
+    for _ in range(steps):
+        # step a random subset of the games
+        ready_env_ids = ready_env_ids[rng.rand(env_num) < 0.7]
+        action = rng.randint(2, size=len(ready_env_ids))
+        obs, rew, terminated, truncated, info = venv.step(action, ready_env_ids)
+        done = terminated | truncated
+        for j, env_id in enumerate(ready_env_ids):
+            env = raw_envs[env_id % env_num]
+            agent, raw_obs, raw_rew, raw_term, raw_trunc = raw_step(env, action[j])
+            assert obs[j]["agent_id"] == agent
+            assert np.array_equal(obs[j]["obs"], raw_obs)
+            assert np.array_equal(rew[j], raw_rew)
+            assert terminated[j] == raw_term and truncated[j] == raw_trunc
+            assert info["env_id"][j] == env.agent_name_mapping[agent] * env_num + (
+                env_id % env_num
+            )
+            if raw_term or raw_trunc:
+                env.reset()
+        if done.any():
+            obs_reset = venv.reset(info["env_id"][done])
+            assert np.all(obs_reset.obs == venv.game.NONE)
+        ready_env_ids = np.concatenate(
+            [
+                info["env_id"],
+                np.setdiff1d(np.arange(env_num), info["env_id"] % env_num),
+            ]
+        )
+
+
+def test_collector(env_num=4, max_cycles=3):
+    def get_env():
+        return MAEnvWrapper(dilemma_pettingzoo.env(max_cycles=max_cycles))
+
+    env = get_env()
+    policy = MAPolicyManager([RandomPolicy(), RandomPolicy()], env, train_scheme="FD")
+    episodes, buffers = [], []
+    for venv in [
+        DilemmaVectorEnv(env_num, max_cycles=max_cycles),
+        get_MA_VectorEnv(DummyVectorEnv, [get_env] * env_num),
+        get_MA_VectorEnv(DummyVectorEnv, [get_env] * env_num, autoreset=True),
+    ]:
+        buffer = MAReplayBuffer(1000, env.agents, VectorReplayBuffer, env_num)
+        collector = MACollector(policy, venv, buffer)
+        for i, space in enumerate(collector._action_space):
+            space.seed(i)
+        result = collector.collect(n_step=env_num * 4 * max_cycles, random=True)
+        episodes.append(result["n/ep"])
+        buffers.append(buffer)
+        for buf in buffer.buffers:
+            # max_cycles truncates the games, which are then bootstrapped
+            assert not buf.terminated[: len(buf)].any()
+            assert buf.truncated[: len(buf)].any()
+            assert np.array_equal(buf.done[: len(buf)], buf.truncated[: len(buf)])
+    # one agent turn per env step, with or without autoreset
+    assert episodes[0] > 0 and episodes[0] == episodes[1] == episodes[2]
+    # the reset obs returned by the workers continue the episodes the same way
+    for buf, auto_buf in zip(buffers[1].buffers, buffers[2].buffers):
+        indices = buf.sample_indices(0)
+        assert np.array_equal(indices, auto_buf.sample_indices(0))
+        for key in ["act", "rew", "done"]:
+            assert np.array_equal(
+                getattr(buf, key)[indices], getattr(auto_buf, key)[indices]
+            )
+        assert np.array_equal(buf.obs.obs[indices], auto_buf.obs.obs[indices])
+
+
+def benchmark(env_num=100000, steps=20, ref_env_num=1000):
+    rng = np.random.RandomState(0)
+    for venv in [
+        DilemmaVectorEnv(env_num),
+        get_MA_VectorEnv(
+            DummyVectorEnv,
+            [lambda: MAEnvWrapper(dilemma_pettingzoo.env())] * ref_env_num,
+        ),
+    ]:
+        venv.reset()
+        actions = rng.randint(2, size=(steps, venv.env_num))
+        ready_env_ids = np.arange(venv.env_num)
+        start = time.time()
+        for action in actions:
+            *_, info = venv.step(action, ready_env_ids)
+            try:  # a Batch for DilemmaVectorEnv
+                ready_env_ids = info["env_id"]
+            except IndexError:
+                ready_env_ids = np.array([i["env_id"] for i in info])
+        fps = steps * venv.env_num / (time.time() - start)
+        print(f"{type(venv).__name__}: {fps:.0f} agent steps/s")
+
+
+if __name__ == "__main__":
+    test_payoff_tensor()
+    test_parity()
+    for game in ["sd", "sh", "chicken"]:
+        test_parity(game=game)
+    test_parity(game="pg", num_players=5)
+    test_collector()
+    benchmark()
@@ -0,0 +1,100 @@
+import socket
+
+import gym
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from tianshou.data import Batch
+from tianshou.utils.net.common import Net
+from tianshou.utils.net.discrete import Actor, Critic
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(root)
+from marl_comm.ma_policy import PPOPolicy
+from marl_comm.utils.distributed import init_local_process_group
+
+obs_dim = 8
+action_num = 3
+world_size = 2
+
+
+def get_policy(seed, data_parallel=False):
+    torch.manual_seed(seed)
+    actor = Actor(Net(obs_dim, hidden_sizes=[32]), action_num, softmax_output=False)
+    critic = Critic(Net(obs_dim, hidden_sizes=[32]))
+    optim = torch.optim.Adam(
+        set(actor.parameters()).union(critic.parameters()), lr=1e-2
+    )
+    return PPOPolicy(
+        actor,
+        critic,
+        optim,
+        lambda logits: torch.distributions.Categorical(logits=logits),
+        max_grad_norm=0.5,
+        action_scaling=False,
+        action_space=gym.spaces.Discrete(action_num),
+        data_parallel=data_parallel,
+    )
+
+
+def get_batch(size=64):
+    rng = np.random.RandomState(0)
+    obs = rng.randn(size, obs_dim).astype(np.float32)
+    return Batch(
+        obs=obs,
+        critic_obs=obs,
+        act=torch.as_tensor(rng.randint(action_num, size=size)),
+        v_s=torch.as_tensor(rng.randn(size), dtype=torch.float32),
+        returns=torch.as_tensor(rng.randn(size), dtype=torch.float32),
+        adv=torch.as_tensor(rng.randn(size), dtype=torch.float32),
+        logp_old=torch.full((size,), -np.log(action_num)),
+    )
+
+
+def flat_params(policy):
+    return torch.cat([p.data.reshape(-1) for p in policy.parameters()])
+
+
+def run_rank(rank, port, queue):
+    torch.set_num_threads(1)
+    init_local_process_group(rank, world_size, port)
+    # different seeds, the parameters of rank 0 are broadcast on construction
+    policy = get_policy(seed=rank, data_parallel=True)
+    batch = get_batch()
+    # a single minibatch per step, so that shuffling does not matter
+    result = policy.learn(batch, batch_size=len(batch), repeat=3)
+    params = flat_params(policy)
+    gathered = [torch.empty_like(params) for _ in range(world_size)]
+    dist.all_gather(gathered, params)
+    if rank == 0:
+        queue.put((gathered[0].numpy(), gathered[1].numpy(), result["loss"]))
+    dist.destroy_process_group()
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_data_parallel_learn():
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    mp.spawn(run_rank, args=(get_free_port(), queue), nprocs=world_size)
+    params_0, params_1, loss = queue.get()
+    # the weights stay identical across ranks
+    assert np.array_equal(params_0, params_1)
+
+    # and match a single process learning from the whole batch
+    policy = get_policy(seed=0)
+    batch = get_batch()
+    ref_loss = policy.learn(batch, batch_size=len(batch), repeat=3)["loss"]
+    assert np.allclose(params_0, flat_params(policy).numpy(), atol=1e-5)
+    assert np.isclose(loss, ref_loss, atol=1e-5)
+
+
+if __name__ == "__main__":
+    test_data_parallel_learn()
@@ -0,0 +1,75 @@
+import numpy as np
+from tianshou.data import Batch, VectorReplayBuffer
+from tianshou.policy import BasePolicy
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(root)
+from marl_comm.utils.advantage import compute_ma_episodic_return
+
+agent_num = 3
+env_num = 4
+
+
+def get_buffers(size, n_step, seed=0):
+    rng = np.random.RandomState(seed)
+    buffers = [VectorReplayBuffer(size * env_num, env_num) for _ in range(agent_num)]
+    for _ in range(n_step):
+        for buf in buffers:
+            terminated = rng.rand(env_num) < 0.1
+            buf.add(
+                Batch(
+                    obs=rng.randn(env_num, 2),
+                    act=rng.randint(2, size=env_num),
+                    rew=rng.randn(env_num),
+                    terminated=terminated,
+                    truncated=~terminated & (rng.rand(env_num) < 0.05),
+                    obs_next=rng.randn(env_num, 2),
+                )
+            )
+    return buffers
+
+
+def check_parity(buffers, gamma=0.9, gae_lambda=0.95):
+    rng = np.random.RandomState(1)
+    _, indices = buffers[0].sample(0)
+    batches = [buf[indices] for buf in buffers]
+    v_s = rng.randn(agent_num, len(indices))
+    v_s_ = rng.randn(agent_num, len(indices))
+
+    returns, advantages = compute_ma_episodic_return(
+        batches, buffers, indices, v_s_, v_s, gamma, gae_lambda
+    )
+    for agent_i, (batch, buf) in enumerate(zip(batches, buffers)):
+        ref_returns, ref_advantages = BasePolicy.compute_episodic_return(
+            batch, buf, indices, v_s_[agent_i], v_s[agent_i], gamma, gae_lambda
+        )
+        assert np.allclose(returns[agent_i], ref_returns)
+        assert np.allclose(advantages[agent_i], ref_advantages)
+
+
+def test_ma_gae_parity():
+    # dense [T, env, agent] layout
+    check_parity(get_buffers(size=20, n_step=20))
+    # wrapped around buffers, still dense
+    check_parity(get_buffers(size=20, n_step=33))
+    # unequal env lengths fall back to a single row
+    buffers = get_buffers(size=20, n_step=10)
+    for buf in buffers:
+        buf.add(
+            Batch(
+                obs=np.zeros((1, 2)),
+                act=[0],
+                rew=[1.0],
+                terminated=[False],
+                truncated=[False],
+                obs_next=np.zeros((1, 2)),
+            ),
+            buffer_ids=[0],
+        )
+    check_parity(buffers)
+
+
+if __name__ == "__main__":
+    test_ma_gae_parity()
@@ -0,0 +1,53 @@
+import subprocess
+import time
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+
+heavy_modules = ["torch", "tianshou", "gym"]
+
+
+def run_import(module):
+    """Import a module in a fresh interpreter, as a subprocess env worker does.
+
+    :return: (the modules among heavy_modules that got imported, stdout, seconds)
+    """
+    code = (
+        f"import sys; sys.path.insert(0, {root!r}); import {module}; "
+        f"print(sorted(set({heavy_modules!r}) & set(sys.modules)))"
+    )
+    start = time.time()
+    stdout = subprocess.check_output([sys.executable, "-c", code], text=True)
+    seconds = time.time() - start
+    *printed, loaded = stdout.splitlines()
+    return eval(loaded), printed, seconds
+
+
+def test_lazy_import():
+    for module in [
+        "marl_comm",
+        "marl_comm.data",
+        "marl_comm.env",
+        "marl_comm.ma_policy",
+        "marl_comm.games.dilemma_pettingzoo",
+        "marl_comm.games.simple_dilemma_games",
+    ]:
+        loaded, printed, _ = run_import(module)
+        # no heavy dependency and no output at import time
+        assert loaded == [], (module, loaded)
+        assert printed == [], (module, printed)
+    # attributes are still available on first access
+    loaded, _, _ = run_import("marl_comm; marl_comm.ma_policy.PPOPolicy")
+    assert "torch" in loaded
+
+
+if __name__ == "__main__":
+    test_lazy_import()
+    for module in [
+        "marl_comm",
+        "marl_comm.games.dilemma_pettingzoo",
+        "marl_comm.env; marl_comm.env.MAEnvWrapper",
+        "marl_comm.data; marl_comm.data.MACollector",
+    ]:
+        print(f"{module}: {run_import(module)[2]:.3f}s")
@@ -0,0 +1,90 @@
+import json
+import tempfile
+import time
+
+import numpy as np
+from tianshou.env import DummyVectorEnv
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(root)
+from marl_comm.env import BatchedSubprocVectorEnv, MAEnvWrapper, get_MA_VectorEnv
+from marl_comm.games import dilemma_pettingzoo
+from marl_comm.utils.latency import LatencyHistogram
+
+
+class slow_env(dilemma_pettingzoo.raw_env):
+    def step(self, action):
+        time.sleep(0.002)
+        super().step(action)
+
+
+def get_env():
+    return MAEnvWrapper(dilemma_pettingzoo.raw_env(max_cycles=3))
+
+
+def get_slow_env():
+    return MAEnvWrapper(slow_env(max_cycles=3))
+
+
+def test_histogram():
+    hist = LatencyHistogram()
+    for seconds in [2e-6] * 98 + [1e-3, 20.0]:
+        hist.record(seconds)
+    assert hist.count == 100 and sum(hist.counts) == 100
+    assert np.isclose(hist.mean, (98 * 2e-6 + 1e-3 + 20.0) / 100)
+    # upper bounds within a bucket
+    assert 2e-6 <= hist.quantile(0.5) <= 2e-6 * 10**0.25
+    assert 1e-3 <= hist.quantile(0.99) <= 1e-3 * 10**0.25
+    # above all edges
+    assert hist.quantile(1.0) == hist.max == 20.0
+    merged = LatencyHistogram().merge(hist).merge(hist)
+    assert merged.count == 200 and merged.counts == [2 * c for c in hist.counts]
+
+
+def test_venv_latency(steps=12):
+    env_fns = [get_env, get_slow_env, get_env]
+    for venv_cls, kwargs in [
+        (DummyVectorEnv, {}),
+        (BatchedSubprocVectorEnv, {"envs_per_worker": 2}),
+    ]:
+        venv = get_MA_VectorEnv(venv_cls, env_fns, record_latency=True, **kwargs)
+        venv.reset()
+        ready_env_ids = np.arange(venv.env_num)
+        for _ in range(steps):
+            *_, info = venv.step(np.zeros(venv.env_num, dtype=int), ready_env_ids)
+            ready_env_ids = np.array([i["env_id"] for i in info])
+        stats = venv.latency_stats()
+        steps_per_env = [
+            sum(h.count for k, h in s.items() if k.startswith("step/")) for s in stats
+        ]
+        assert steps_per_env == [steps] * venv.env_num
+        assert all(s["reset"].count >= 1 for s in stats)
+        # the straggler stands out
+        means = [s["step/player_0"].mean for s in stats]
+        assert np.argmax(means) == 1 and means[1] > 2e-3
+        # one round trip per call on each worker, which covers the env steps
+        envs_per_worker = kwargs.get("envs_per_worker", 1)
+        worker_num = -(-venv.env_num // envs_per_worker)
+        worker_stats = venv.worker_latency_stats()
+        assert [w["step"].count for w in worker_stats] == [steps] * worker_num
+        assert all(w["reset"].count == 1 for w in worker_stats)
+        slow_worker = 1 // envs_per_worker
+        assert worker_stats[slow_worker]["step"].mean > 2e-3
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "latency.json")
+            venv.dump_latency(path)
+            with open(path) as f:
+                dumped = json.load(f)
+        assert (
+            dumped["envs"][1]["step/player_0"]["count"]
+            == stats[1]["step/player_0"].count
+        )
+        assert dumped["workers"][slow_worker]["step"]["count"] == steps
+        venv.close()
+
+
+if __name__ == "__main__":
+    test_histogram()
+    test_venv_latency()
@@ -1,12 +1,21 @@
 # pass test with newest version of pettingzoo and tianshou
+import copy
+
 import numpy as np
+import torch
 from tianshou.data import Batch, ReplayBuffer, VectorReplayBuffer
+from tianshou.policy import DQNPolicy
+from tianshou.utils.net.common import Net
 import sys, os
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 root = os.path.dirname(os.path.dirname(current_dir))
 sys.path.append(root)
 from marl_comm.data import MAReplayBuffer
+from marl_comm.data.ma_buffer import base
+from marl_comm.env import MAEnvWrapper
+from marl_comm.games import dilemma_pettingzoo
+from marl_comm.ma_policy import MAPolicyManager
 
 
 def test_replaybuffer_old():
@@ -75,5 +84,97 @@ def test_replaybuffer_new():
     print(vbuffer.sample(2))
 
 
+def test_stacked_indices():
+    agents = ["agent_0", "agent_1", "agent_2"]
+    rng = np.random.RandomState(0)
+    buffer = MAReplayBuffer(40, agents, VectorReplayBuffer, 2)
+    bind_children, binds = buffer._bind_children, []
+    buffer._bind_children = lambda: binds.append(bind_children())
+    keys, walks = base._keys, []
+    # the walks of the added batches, not of their sub-batches
+    base._keys = lambda batch: walks.append("rew" in batch.keys()) or keys(batch)
+    for i in range(30):
+        for agent_i in range(len(agents)):
+            info = {"env_id": np.arange(2)}
+            if i >= 10:  # a key showing up later is moved to the shared storage
+                info["extra"] = np.ones(2)
+            batch = Batch(
+                {
+                    "obs": {"obs": rng.randn(2, 3), "agent_id": [agents[agent_i]] * 2},
+                    "obs_next": {
+                        "obs": rng.randn(2, 3),
+                        "agent_id": [agents[agent_i]] * 2,
+                    },
+                    "act": rng.randint(2, size=2),
+                    "rew": rng.randn(2),
+                    "terminated": rng.rand(2) < 0.2,
+                    "truncated": [False] * 2,
+                    "info": info,
+                }
+            )
+            buffer.add(batch, [agent_i * 2, agent_i * 2 + 1])
+    base._keys = keys
+    # on the first add and when the new key shows up, not on every add
+    assert len(binds) == 2
+    assert sum(walks) == 2
+    indices = buffer.sample_indices(0)
+    stacked_indices = buffer.stacked_indices(indices)
+    stacked = buffer[stacked_indices]
+    bsz = len(indices)
+    for agent_i in range(len(agents)):
+        agent_buffer = buffer.get_agent_buffer(agent_i)
+        data = agent_buffer[indices]
+        part = stacked[agent_i * bsz : (agent_i + 1) * bsz]
+        assert np.allclose(part.obs.obs, data.obs.obs)
+        assert np.allclose(part.info.extra, data.info.extra)
+        assert np.all(part.act == data.act) and np.all(part.done == data.done)
+        # episodes never cross the agents' or the envs' boundaries
+        offset = stacked_indices[agent_i * bsz] - indices[0]
+        part_indices = stacked_indices[agent_i * bsz : (agent_i + 1) * bsz]
+        assert np.all(buffer.next(part_indices) == agent_buffer.next(indices) + offset)
+        assert np.all(buffer.prev(part_indices) == agent_buffer.prev(indices) + offset)
+
+
+def test_shared_parameter_update(size=32):
+    env = MAEnvWrapper(dilemma_pettingzoo.env())
+    rng = np.random.RandomState(0)
+    buffer = MAReplayBuffer(size, env.agents, ReplayBuffer)
+    for i in range(size):
+        for agent_i, agent in enumerate(env.agents):
+            obs, obs_next = [
+                {"agent_id": [agent], "obs": rng.randint(3, size=(1, 2))}
+                for _ in range(2)
+            ]
+            batch = Batch(
+                obs=obs,
+                obs_next=obs_next,
+                act=[rng.randint(2)],
+                rew=[rng.randn()],
+                terminated=[i % 8 == 7],
+                truncated=[False],
+            )
+            buffer.add(batch, [agent_i])
+    torch.manual_seed(0)
+    net = Net(2, 2, hidden_sizes=[16])
+    policy = DQNPolicy(
+        net, torch.optim.Adam(net.parameters(), lr=1e-2), estimation_step=2
+    )
+    reference = copy.deepcopy(policy)
+    manager = MAPolicyManager([policy], env, parameter_mode="shared")
+    result = manager.update(0, buffer)
+
+    # each agent's batch processed against its own buffer, learned as one batch
+    indices = buffer.sample_indices(0)
+    data = []
+    for agent_i in range(len(env.agents)):
+        agent_buffer = buffer.get_agent_buffer(agent_i)
+        data.append(reference.process_fn(agent_buffer[indices], agent_buffer, indices))
+    assert np.isclose(result["loss"], reference.learn(Batch.cat(data))["loss"])
+    for p, q in zip(policy.parameters(), reference.parameters()):
+        assert torch.allclose(p, q)
+
+
 if __name__ == "__main__":
     test_replaybuffer_new()
+    test_stacked_indices()
+    test_shared_parameter_update()
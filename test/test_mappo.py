@@ -11,7 +11,7 @@ from tianshou.env import DummyVectorEnv, SubprocVectorEnv
 from tianshou.policy import BasePolicy
 from tianshou.trainer import onpolicy_trainer
 from tianshou.utils import TensorboardLogger
-from tianshou.utils.net.common import Net
+from tianshou.utils.net.common import MLP, Net
 from tianshou.utils.net.discrete import Actor, Critic
 from torch.utils.tensorboard import SummaryWriter
 import sys
@@ -56,8 +56,20 @@ def get_parser() -> argparse.ArgumentParser:
     parser.add_argument("--value-clip", type=int, default=0)
     parser.add_argument("--norm-adv", type=int, default=1)
     parser.add_argument("--recompute-adv", type=int, default=0)
+    parser.add_argument(
+        "--target-kl",
+        type=float,
+        default=None,
+        help="stop the epochs of an update once the approximate KL exceeds it",
+    )
     parser.add_argument("--logdir", type=str, default="log")
     parser.add_argument("--joint-critic", action="store_true")
+    parser.add_argument(
+        "--state-encoder-dim",
+        type=int,
+        default=0,
+        help="share a state encoder of this output dim across joint critics",
+    )
     parser.add_argument("--render", type=float, default=0.0)
 
     parser.add_argument(
@@ -93,6 +105,22 @@ def get_agents(
     args.state_shape = observation_space.shape or observation_space.n
     args.action_shape = env.action_space.shape or env.action_space.n
 
+    use_state_encoder = args.joint_critic and args.state_encoder_dim > 0
+    if use_state_encoder:
+        state_encoder = MLP(
+            int(np.prod(env.state_space.shape)),
+            args.state_encoder_dim,
+            args.hidden_sizes,
+            device=args.device,
+        ).to(args.device)
+        state_encoder_optim = torch.optim.Adam(state_encoder.parameters(), lr=args.lr)
+        critic_state_dim = args.state_encoder_dim
+    elif args.joint_critic:
+        state_encoder, state_encoder_optim = None, None
+        critic_state_dim = np.prod(env.state_space.shape)
+    else:
+        state_encoder, state_encoder_optim = None, None
+
     agents = []
     for _ in range(args.n_pistons):
         # model
@@ -106,7 +134,7 @@ def get_agents(
             net_a, args.action_shape, device=args.device, softmax_output=False
         )
         net_c = Net(
-            np.prod(args.state_shape) + np.prod(env.state_space.shape)
+            np.prod(args.state_shape) + critic_state_dim
             if args.joint_critic
             else np.prod(args.state_shape),
             hidden_sizes=args.hidden_sizes,
@@ -139,12 +167,15 @@ def get_agents(
             dual_clip=args.dual_clip,
             advantage_normalization=args.norm_adv,
             recompute_advantage=args.recompute_adv,
+            target_kl=args.target_kl,
         ).to(args.device)
         agents.append(agent)
     policy = MAPPOPolicy(
         agents,
         env,
         joint_critic=args.joint_critic,
+        state_encoder=state_encoder,
+        state_encoder_optim=state_encoder_optim,
     )
     return policy, env.agents
 
@@ -0,0 +1,129 @@
+import itertools
+import time
+
+import numpy as np
+import torch
+from tianshou.data import Batch
+from tianshou.policy import BasePolicy
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(root)
+from marl_comm.env import MAEnvWrapper
+from marl_comm.games import dilemma_pettingzoo
+from marl_comm.games.dilemma_vector import DilemmaVectorEnv
+from marl_comm.games.matrix_eval import MatrixGameEvaluator, expected_payoff
+from marl_comm.games.simple_dilemma_games import get_game_class
+from marl_comm.ma_policy import MAPolicyManager
+
+
+class fixed_policy(BasePolicy):
+    """Always take the same action, with an epsilon-greedy noise."""
+
+    def __init__(self, action, eps=0.0):
+        super().__init__()
+        self.action = action
+        self.eps = eps
+
+    def forward(self, batch, state=None, **kwargs):
+        return Batch(act=np.full(len(batch.obs), self.action))
+
+    def learn(self, batch, **kwargs):
+        return {}
+
+
+class noisy_tit_for_tat(BasePolicy):
+    """Copy the last action of the next player with probability 1 - noise,
+    cooperate in the first round, and sample the actions from a dist."""
+
+    def __init__(self, num_players, noise=0.2, num_actions=2):
+        super().__init__()
+        self.num_players = num_players
+        self.noise = noise
+        self.num_actions = num_actions
+
+    def forward(self, batch, state=None, **kwargs):
+        obs = np.asarray(batch.obs)
+        other = (int(self.agent_id.split("_")[-1]) + 1) % self.num_players
+        copy = np.where(obs[:, other] < self.num_actions, obs[:, other], 0)
+        probs = (1 - self.noise) * np.eye(self.num_actions)[copy] + self.noise / 2
+        dist = torch.distributions.Categorical(probs=torch.as_tensor(probs))
+        return Batch(act=dist.sample().numpy(), dist=dist)
+
+    def learn(self, batch, **kwargs):
+        return {}
+
+
+def get_policy(policies, game="pd", num_players=None):
+    kwargs = {} if num_players is None else {"num_players": num_players}
+    env = MAEnvWrapper(dilemma_pettingzoo.env(game=game, **kwargs))
+    return MAPolicyManager(policies, env, train_scheme="FD")
+
+
+def test_expected_payoff(num_players=3):
+    payoff_tensor = get_game_class("pg")(num_players).payoff_tensor
+    probs = np.random.RandomState(0).dirichlet(np.ones(2), size=(4, num_players))
+    ref = np.zeros((4, num_players))
+    for actions in itertools.product(range(2), repeat=num_players):
+        prob = np.prod([probs[:, i, a] for i, a in enumerate(actions)], axis=0)
+        ref += prob[:, None] * payoff_tensor[actions]
+    assert np.allclose(expected_payoff(payoff_tensor, probs), ref)
+
+
+def test_matrix_eval(max_cycles=5):
+    # tit for tat against always defect: (C, D) then (D, D)
+    policy = get_policy([noisy_tit_for_tat(2, noise=0.0), fixed_policy(1)])
+    evaluator = MatrixGameEvaluator(policy, max_cycles=max_cycles)
+    payoff = evaluator.payoff_tensor
+    ref = payoff[0, 1] + (max_cycles - 1) * payoff[1, 1]
+    assert np.allclose(evaluator.evaluate(), ref)
+    # with the exploration noise, the rounds are independent
+    policy = get_policy([fixed_policy(0, eps=0.2), fixed_policy(0, eps=0.4)])
+    probs = np.array([[0.9, 0.1], [0.8, 0.2]])
+    for exploration_noise, ref in [
+        (False, max_cycles * payoff[0, 0]),
+        (True, max_cycles * expected_payoff(payoff, probs)),
+    ]:
+        evaluator = MatrixGameEvaluator(
+            policy, max_cycles=max_cycles, exploration_noise=exploration_noise
+        )
+        assert np.allclose(evaluator.evaluate(), ref)
+    # as the test collector of a trainer
+    result = evaluator.collect(n_episode=3)
+    assert result["rews"].shape == (3, 2) and result["n/ep"] == 3
+    assert evaluator.collect_episode == 3
+
+
+def test_monte_carlo(game="pg", num_players=3, max_cycles=4, env_num=20000):
+    policy = get_policy(
+        [noisy_tit_for_tat(num_players) for _ in range(num_players)],
+        game=game,
+        num_players=num_players,
+    )
+    start = time.time()
+    evaluator = MatrixGameEvaluator(
+        policy, game=game, max_cycles=max_cycles, num_players=num_players
+    )
+    returns = evaluator.evaluate()
+    print(f"analytic: {time.time() - start:.4f}s")
+    # the same policies sampled in the envs
+    venv = DilemmaVectorEnv(
+        env_num, game=game, max_cycles=max_cycles, num_players=num_players
+    )
+    obs = venv.reset()
+    ids = np.arange(env_num)
+    total = np.zeros((env_num, num_players))
+    for _ in range(max_cycles * num_players):
+        act = policy(Batch(obs=obs, obs_next=Batch(), info=Batch())).act
+        obs, rew, *_, info = venv.step(act, ids)
+        ids = info["env_id"]
+        total += rew
+    stderr = total.std(0) / np.sqrt(env_num)
+    assert np.all(np.abs(total.mean(0) - returns) < 5 * stderr + 1e-6)
+
+
+if __name__ == "__main__":
+    test_expected_payoff()
+    test_matrix_eval()
+    test_monte_carlo()
@@ -0,0 +1,235 @@
+import time
+from pprint import pprint
+
+import gym
+import numpy as np
+import torch
+from tianshou.data import Batch, ReplayBuffer
+from tianshou.policy import DQNPolicy
+from tianshou.utils.net.common import Net
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(root)
+from marl_comm.data import MAReplayBuffer
+from marl_comm.env import MAEnvWrapper
+from marl_comm.games import dilemma_pettingzoo
+from marl_comm.ma_policy import QMIXPolicy
+from marl_comm.utils.net.mixer import QattenMixer, QMixer
+from marl_comm.utils.precision import autocast_forward
+
+state_dim = 128
+batch_size = 64
+
+
+def get_mixers(agent_num: int):
+    return {
+        "QMixer": QMixer(agent_num, state_dim, [64, 32]),
+        "QattenMixer": QattenMixer(agent_num, state_dim, [64]),
+    }
+
+
+def test_qatten_monotonic():
+    torch.manual_seed(0)
+    agent_num = 10
+    mixer = QattenMixer(agent_num, state_dim, [64])
+    qs = torch.randn(batch_size, agent_num, requires_grad=True)
+    state = torch.randn(batch_size, state_dim)
+    q_tot = mixer(qs, state)
+    assert q_tot.shape == (batch_size, 1, 1)
+    q_tot.sum().backward()
+    assert (qs.grad >= 0).all()
+
+
+def test_qatten_param_scaling():
+    n_params = {}
+    for agent_num in [10, 50, 200]:
+        n_params[agent_num] = {
+            name: sum(p.numel() for p in mixer.parameters())
+            for name, mixer in get_mixers(agent_num).items()
+        }
+    assert n_params[10]["QattenMixer"] == n_params[200]["QattenMixer"]
+    assert n_params[200]["QattenMixer"] < n_params[200]["QMixer"]
+
+
+def saved_numel(mixer, agent_num, batch_size):
+    """The number of elements autograd saves for the backward of the mixer."""
+    numel = []
+
+    def pack(tensor):
+        numel.append(tensor.numel())
+        return tensor
+
+    qs = torch.randn(batch_size, agent_num, requires_grad=True)
+    state = torch.randn(batch_size, state_dim)
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        mixer(qs, state)
+    return sum(numel)
+
+
+def test_qatten_activation_scaling(batch_size=1024):
+    growth = {}
+    for name in ["QMixer", "QattenMixer"]:
+        small, large = [
+            saved_numel(get_mixers(agent_num)[name], agent_num, batch_size)
+            for agent_num in [10, 200]
+        ]
+        growth[name] = (large - small) / (200 - 10) / batch_size
+    # only the agent Q-values grow with agent_num, plus batch-independent keys
+    assert growth["QattenMixer"] < 2
+    assert growth["QMixer"] > 32
+
+
+def get_qmix_buffer(env, size=64, seed=0):
+    """A buffer of random transitions with the state in obs and obs_next."""
+    rng = np.random.RandomState(seed)
+    buffer = MAReplayBuffer(size, env.agents, ReplayBuffer)
+
+    def obs(agent):
+        return {
+            "agent_id": [agent],
+            "obs": [rng.randint(3, size=2)],
+            "mask": [[True, True]],
+            "state": [rng.randn(state_dim)],
+        }
+
+    for i in range(size):
+        for agent_i, agent in enumerate(env.agents):
+            batch = Batch(
+                obs=obs(agent),
+                obs_next=obs(agent),
+                act=[rng.randint(2)],
+                rew=[rng.randn()],
+                terminated=[i % 8 == 7],
+                truncated=[False],
+            )
+            buffer.add(batch, [agent_i])
+    return buffer
+
+
+def record_autocast(optim, records):
+    """Record whether autocast is enabled in each step of the optimizer."""
+    step = optim.step
+
+    def _step(*args, **kwargs):
+        records.append(torch.is_autocast_cpu_enabled())
+        return step(*args, **kwargs)
+
+    optim.step = _step
+
+
+def test_qmix_bf16_parity(steps=5):
+    env = MAEnvWrapper(dilemma_pettingzoo.env())
+    env.state_space = gym.spaces.Box(-1, 1, (state_dim,))
+    buffer = get_qmix_buffer(env)
+    for mixer_cls in [None, QMixer]:
+        results = {}
+        for precision in ["fp32", "bf16"]:
+            torch.manual_seed(0)
+            agents = []
+            for _ in env.agents:
+                net = Net(2, 2, hidden_sizes=[64])
+                optim = torch.optim.Adam(net.parameters(), lr=1e-3)
+                agents.append(DQNPolicy(net, optim, 0.9, target_update_freq=10))
+            mixer = mixer_cls and mixer_cls(len(env.agents), state_dim, [64, 32])
+            policy = QMIXPolicy(
+                agents,
+                env,
+                discount_factor=0.9,
+                target_update_freq=10,
+                mixer=mixer,
+                mixer_lr=1e-3,
+                precision=precision,
+            )
+            optims = [agent.optim for agent in agents]
+            optims += [policy.mixer_optim] if mixer else []
+            autocast_steps = []
+            for optim in optims:
+                record_autocast(optim, autocast_steps)
+            losses = []
+            for _ in range(steps):
+                result = policy.update(0, buffer)
+                losses.append(result.get("loss", result.get("player_0/loss")))
+            # the backward pass and the optimizer step run outside of autocast
+            assert autocast_steps and not any(autocast_steps)
+            params = torch.cat([p.detach().flatten() for p in policy.parameters()])
+            assert params.dtype == torch.float32
+            results[precision] = np.array(losses), params
+        (fp32_losses, fp32_params), (bf16_losses, bf16_params) = results.values()
+        assert np.allclose(bf16_losses, fp32_losses, rtol=5e-2)
+        assert torch.allclose(bf16_params, fp32_params, atol=1e-2)
+
+
+class AutocastProbe(torch.nn.Module):
+    """Records whether autocast is enabled in its forward."""
+
+    def __init__(self, records):
+        super().__init__()
+        self.linear = torch.nn.Linear(4, 4)
+        self.records = records
+
+    def forward(self, x):
+        self.records.append(torch.is_autocast_cpu_enabled())
+        return self.linear(x)
+
+
+def test_autocast_forward():
+    records = []
+    shared = AutocastProbe(records)
+    model = torch.nn.Sequential(shared, AutocastProbe(records), shared)
+    x = torch.randn(2, 4)
+    # nested contexts with a module shared by two of them
+    with autocast_forward(model, "bf16"), autocast_forward(shared, "bf16"):
+        with autocast_forward(shared, "bf16"):
+            y = model(x)
+        assert not torch.is_autocast_cpu_enabled()
+        assert y.dtype == torch.float32 and shared(x).dtype == torch.float32
+    assert records == [True] * 4
+    assert not model._forward_pre_hooks and not shared._forward_hooks
+    assert model(x).dtype == torch.float32 and not records[-1]
+
+    # a forward set on the instance is kept
+    probe = AutocastProbe(records)
+    probe.forward = lambda x: probe.linear(x) * 2
+    with autocast_forward(probe, "bf16"):
+        assert probe(x).dtype == torch.float32
+    assert torch.equal(probe(x), probe.linear(x) * 2)
+
+    # a forward which raises does not leave autocast enabled
+    try:
+        with autocast_forward(probe, "bf16"):
+            probe(torch.randn(2, 3))
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("the forward should have raised")
+    assert not torch.is_autocast_cpu_enabled()
+    assert not probe._forward_pre_hooks and not probe._forward_hooks
+
+
+def benchmark_mixers(agent_nums=(10, 50, 200), n_iters=50):
+    """Time a forward and backward pass of each mixer at several agent counts."""
+    results = {}
+    for agent_num in agent_nums:
+        qs = torch.randn(batch_size, agent_num, requires_grad=True)
+        state = torch.randn(batch_size, state_dim)
+        for name, mixer in get_mixers(agent_num).items():
+            mixer(qs, state).sum().backward()  # warm up
+            start_time = time.time()
+            for _ in range(n_iters):
+                mixer(qs, state).sum().backward()
+            results[f"{name}/{agent_num}"] = {
+                "params": sum(p.numel() for p in mixer.parameters()),
+                "ms/iter": (time.time() - start_time) / n_iters * 1e3,
+            }
+    return results
+
+
+if __name__ == "__main__":
+    test_qatten_monotonic()
+    test_qatten_param_scaling()
+    test_qatten_activation_scaling()
+    test_qmix_bf16_parity()
+    test_autocast_forward()
+    pprint(benchmark_mixers())
@@ -0,0 +1,304 @@
+import copy
+
+import gym
+import numpy as np
+import torch
+from tianshou.data import Batch, ReplayBuffer, VectorReplayBuffer
+from tianshou.utils.net.common import MLP, Net
+from tianshou.utils.net.discrete import Actor, Critic
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(root)
+from marl_comm.data import MAReplayBuffer
+from marl_comm.env import MAEnvWrapper
+from marl_comm.games import dilemma_pettingzoo
+from marl_comm.ma_policy import MAPPOPolicy, PPOPolicy
+
+obs_dim = 8
+action_num = 3
+
+
+def get_policy(critic_dim=obs_dim, **kwargs):
+    torch.manual_seed(0)
+    actor = Actor(Net(obs_dim, hidden_sizes=[32]), action_num, softmax_output=False)
+    critic = Critic(Net(critic_dim, hidden_sizes=[32]))
+    optim = torch.optim.Adam(
+        set(actor.parameters()).union(critic.parameters()), lr=1e-2
+    )
+    return PPOPolicy(
+        actor,
+        critic,
+        optim,
+        lambda logits: torch.distributions.Categorical(logits=logits),
+        action_scaling=False,
+        action_space=gym.spaces.Discrete(action_num),
+        **kwargs,
+    )
+
+
+def get_batch(size=256):
+    rng = np.random.RandomState(0)
+    obs = rng.randn(size, obs_dim).astype(np.float32)
+    return Batch(
+        obs=obs,
+        critic_obs=obs,
+        act=torch.as_tensor(rng.randint(action_num, size=size)),
+        v_s=torch.as_tensor(rng.randn(size), dtype=torch.float32),
+        returns=torch.as_tensor(rng.randn(size), dtype=torch.float32),
+        adv=torch.as_tensor(rng.randn(size), dtype=torch.float32),
+        logp_old=torch.full((size,), -np.log(action_num)),
+    )
+
+
+def test_kl_early_stopping():
+    repeat, batch_size = 10, 64
+    minibatch_num = len(get_batch()) // batch_size
+
+    result = get_policy().learn(get_batch(), batch_size=batch_size, repeat=repeat)
+    assert result["steps"] == repeat * minibatch_num
+    assert result["skipped_steps"] == 0
+    assert result["approx_kl"] >= 0
+
+    # any update crosses a tiny threshold, only the first epoch runs
+    policy = get_policy(target_kl=1e-8)
+    result = policy.learn(get_batch(), batch_size=batch_size, repeat=repeat)
+    assert result["steps"] == minibatch_num
+    assert result["skipped_steps"] == (repeat - 1) * minibatch_num
+
+    # a loose threshold never stops
+    policy = get_policy(target_kl=1e3)
+    result = policy.learn(get_batch(), batch_size=batch_size, repeat=repeat)
+    assert result["skipped_steps"] == 0
+
+
+def get_buffer(step_num=100, env_num=4):
+    rng = np.random.RandomState(0)
+    buffer = VectorReplayBuffer(step_num * env_num, env_num)
+    obs = rng.randn(env_num, obs_dim).astype(np.float32)
+    for _ in range(step_num):
+        obs_next = rng.randn(env_num, obs_dim).astype(np.float32)
+        terminated = rng.rand(env_num) < 0.05
+        truncated = ~terminated & (rng.rand(env_num) < 0.05)
+        buffer.add(
+            Batch(
+                obs=obs,
+                act=rng.randint(action_num, size=env_num),
+                rew=rng.randn(env_num),
+                terminated=terminated,
+                truncated=truncated,
+                obs_next=obs_next,
+            )
+        )
+        # obs_next is the next obs unless the episode ends
+        done = terminated | truncated
+        obs = np.where(done[:, None], rng.randn(env_num, obs_dim), obs_next)
+        obs = obs.astype(np.float32)
+    return buffer
+
+
+def test_incremental_recompute_advantage():
+    policy = get_policy(recompute_advantage=True)
+    buffer = get_buffer()
+    batch, indices = buffer.sample(0)
+    batch.critic_obs, batch.critic_obs_next = batch.obs, batch.obs_next
+    batch = policy.process_fn(batch, buffer, indices)
+    policy.learn(batch, batch_size=64, repeat=1)  # move the critic
+
+    plan = policy._value_plan(batch, buffer, indices)
+    rows, successors, rest = plan
+    # only the v_s_ of truncated and unfinished episodes need the critic
+    assert len(rows) > 0.8 * len(batch)
+    assert len(rest) < 0.2 * len(batch)
+
+    full = policy._compute_returns(copy.deepcopy(batch), buffer, indices)
+    v_s, v_s_ = policy._planned_values(batch, plan)
+    incremental = policy._compute_returns(
+        copy.deepcopy(batch), buffer, indices, v_s, v_s_
+    )
+    assert torch.allclose(incremental.returns, full.returns, atol=1e-5)
+    assert torch.allclose(incremental.adv, full.adv, atol=1e-5)
+
+
+def get_ma_buffer(env, state_dim, size=64, seed=0):
+    """Random transitions of the agents, which share the state of each step."""
+    rng = np.random.RandomState(seed)
+    buffer = MAReplayBuffer(size, env.agents, ReplayBuffer)
+    state, state_next = rng.randn(2, size, state_dim).astype(np.float32)
+    for i in range(size):
+        for agent_i, agent in enumerate(env.agents):
+            obs, obs_next = [
+                {
+                    "agent_id": [agent],
+                    "obs": rng.randint(3, size=(1, 2)),
+                    "state": s[i : i + 1],
+                }
+                for s in [state, state_next]
+            ]
+            batch = Batch(
+                obs=obs,
+                obs_next=obs_next,
+                act=[rng.randint(2)],
+                rew=[rng.randn()],
+                terminated=[i % 8 == 7],
+                truncated=[False],
+            )
+            buffer.add(batch, [agent_i])
+    return buffer
+
+
+def test_mappo_state_encoder(state_dim=6, encoding_dim=4):
+    env = MAEnvWrapper(dilemma_pettingzoo.env())
+    torch.manual_seed(0)
+    policies = []
+    for _ in env.agents:
+        actor = Actor(Net(2, hidden_sizes=[16]), 2, softmax_output=False)
+        critic = Critic(Net(2 + encoding_dim, hidden_sizes=[16]))
+        optim = torch.optim.Adam(
+            set(actor.parameters()).union(critic.parameters()), lr=1e-2
+        )
+        policies.append(
+            PPOPolicy(
+                actor,
+                critic,
+                optim,
+                lambda logits: torch.distributions.Categorical(logits=logits),
+                joint_critic=True,
+                recompute_advantage=True,
+                action_space=gym.spaces.Discrete(2),
+            )
+        )
+    encoder = MLP(state_dim, encoding_dim)
+    encoder_params = copy.deepcopy(list(encoder.parameters()))
+    policy = MAPPOPolicy(
+        policies,
+        env,
+        joint_critic=True,
+        state_encoder=encoder,
+        state_encoder_optim=torch.optim.Adam(encoder.parameters(), lr=1e-2),
+    )
+    # the states shared by the agents are encoded once
+    rows = []
+    handle = encoder.register_forward_hook(lambda m, i, o: rows.append(len(i[0])))
+    state = torch.randn(2, 10, state_dim)
+    state[1, :7] = state[0, :7]
+    z = policy._encode_state(state)
+    assert rows == [13]
+    assert torch.allclose(z, encoder(state.reshape(20, -1)).reshape(2, 10, -1))
+    handle.remove()
+
+    # the encoder runs once and is stepped once per minibatch of all agents
+    rows.clear()
+    handle = encoder.register_forward_hook(lambda m, i, o: rows.append(len(i[0])))
+    step, steps = policy.state_encoder_optim.step, []
+    policy.state_encoder_optim.step = lambda: steps.append(step())
+    result = policy.update(0, get_ma_buffer(env, state_dim), batch_size=16, repeat=2)
+    handle.remove()
+    assert result["player_0/steps"] == result["player_1/steps"] == 8
+    assert len(steps) == 8
+    # obs and obs_next in process_fn and for the recomputed advantages, and
+    # the minibatches, whose states are shared by the agents
+    assert sorted(rows) == [16] * 8 + [64] * 4
+    for p, q in zip(encoder.parameters(), encoder_params):
+        assert not torch.equal(p, q)
+
+
+def test_learn_threads(size=64):
+    env = MAEnvWrapper(dilemma_pettingzoo.env())
+    num_threads = torch.get_num_threads()
+    params = []
+    for learn_threads in [1, 2]:
+        torch.manual_seed(0)
+        policies = []
+        for _ in env.agents:
+            actor = Actor(Net(2, hidden_sizes=[16]), 2, softmax_output=False)
+            critic = Critic(Net(2, hidden_sizes=[16]))
+            optim = torch.optim.Adam(
+                set(actor.parameters()).union(critic.parameters()), lr=1e-2
+            )
+            policies.append(
+                PPOPolicy(
+                    actor,
+                    critic,
+                    optim,
+                    lambda logits: torch.distributions.Categorical(logits=logits),
+                    action_space=gym.spaces.Discrete(2),
+                )
+            )
+        policy = MAPPOPolicy(policies, env, learn_threads=learn_threads)
+        # a single minibatch, whatever the order of the shuffles of the threads
+        policy.update(0, get_ma_buffer(env, 1, size), batch_size=size, repeat=3)
+        assert torch.get_num_threads() == num_threads
+        params.append([p.detach() for p in policy.parameters()])
+    # the agents learn concurrently the same as in turn
+    assert len(params[0]) > 0
+    for p, q in zip(*params):
+        assert torch.allclose(p, q, atol=1e-6)
+
+
+def record_autocast(optim, records):
+    """Record whether autocast is enabled in each step of the optimizer."""
+    step = optim.step
+
+    def _step(*args, **kwargs):
+        records.append(torch.is_autocast_cpu_enabled())
+        return step(*args, **kwargs)
+
+    optim.step = _step
+
+
+def test_bf16_parity(batch_size=64, repeat=2):
+    env = MAEnvWrapper(dilemma_pettingzoo.env())
+    results = {}
+    for precision in ["fp32", "bf16"]:
+        policy = get_policy(precision=precision)
+        torch.manual_seed(1)
+        result = policy.learn(get_batch(), batch_size=batch_size, repeat=repeat)
+        losses = [result["loss"]]
+        params = [p.detach().flatten() for p in policy.parameters()]
+
+        torch.manual_seed(0)
+        policies, autocast_steps = [], []
+        for _ in env.agents:
+            actor = Actor(Net(2, hidden_sizes=[16]), 2, softmax_output=False)
+            critic = Critic(Net(2, hidden_sizes=[16]))
+            optim = torch.optim.Adam(
+                set(actor.parameters()).union(critic.parameters()), lr=1e-2
+            )
+            record_autocast(optim, autocast_steps)
+            policies.append(
+                PPOPolicy(
+                    actor,
+                    critic,
+                    optim,
+                    lambda logits: torch.distributions.Categorical(logits=logits),
+                    action_space=gym.spaces.Discrete(2),
+                    precision=precision,
+                )
+            )
+        policy = MAPPOPolicy(policies, env)
+        result = policy.update(
+            0, get_ma_buffer(env, 1), batch_size=batch_size, repeat=repeat
+        )
+        losses += [result[f"{agent}/loss"] for agent in env.agents]
+        params += [p.detach().flatten() for p in policy.parameters()]
+        # the backward pass and the optimizer step run outside of autocast
+        assert autocast_steps and not any(autocast_steps)
+        params = torch.cat(params)
+        assert params.dtype == torch.float32
+        results[precision] = np.array(losses), params
+    (fp32_losses, fp32_params), (bf16_losses, bf16_params) = results.values()
+    assert np.allclose(bf16_losses, fp32_losses, rtol=5e-2, atol=1e-2)
+    # Adam moves a weight by up to lr a step whatever the size of its gradient
+    assert not torch.equal(bf16_params, fp32_params)
+    assert torch.allclose(bf16_params, fp32_params, atol=5e-2)
+    assert (bf16_params - fp32_params).abs().mean() < 1e-3
+
+
+if __name__ == "__main__":
+    test_kl_early_stopping()
+    test_incremental_recompute_advantage()
+    test_mappo_state_encoder()
+    test_learn_threads()
+    test_bf16_parity()
@@ -0,0 +1,100 @@
+import glob
+import tempfile
+import time
+import warnings
+
+import numpy as np
+from tianshou.data import VectorReplayBuffer
+from tianshou.env import DummyVectorEnv
+from tianshou.policy import RandomPolicy
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(root)
+from marl_comm.data import FrameRecorder, MACollector, MAReplayBuffer
+from marl_comm.env import MAEnvWrapper, get_MA_VectorEnv
+from marl_comm.games import dilemma_pettingzoo
+from marl_comm.ma_policy import MAPolicyManager
+
+
+class rgb_env(dilemma_pettingzoo.raw_env):
+    renders = 0
+
+    def render(self):
+        rgb_env.renders += 1
+        return np.full((8, 8, 3), self.num_moves, dtype=np.uint8)
+
+
+def get_env():
+    return MAEnvWrapper(rgb_env(max_cycles=3))
+
+
+def collect(recorder, env_num=3, n_step=30):
+    env = get_env()
+    policy = MAPolicyManager([RandomPolicy(), RandomPolicy()], env, train_scheme="FD")
+    venv = get_MA_VectorEnv(DummyVectorEnv, [get_env] * env_num)
+    buffer = MAReplayBuffer(100, env.agents, VectorReplayBuffer, env_num)
+    collector = MACollector(policy, venv, buffer)
+    start = time.time()
+    result = collector.collect(n_step=n_step, random=True, recorder=recorder)
+    return result, time.time() - start
+
+
+def test_recorder_npz(chunk_size=4):
+    with tempfile.TemporaryDirectory() as tmp:
+        with FrameRecorder(tmp, chunk_size=chunk_size, block=True) as recorder:
+            collect(recorder)
+        assert recorder.dropped == 0 and recorder.recorded > chunk_size
+        assert recorder.written == recorder.recorded
+        files = sorted(glob.glob(os.path.join(tmp, "frames_*.npz")))
+        frames = np.concatenate([np.load(f)["frames"] for f in files])
+        assert len(files) == -(-recorder.recorded // chunk_size)
+        assert frames.shape == (recorder.recorded, 3, 8, 8, 3)
+
+
+def test_recorder_png():
+    with tempfile.TemporaryDirectory() as tmp:
+        with FrameRecorder(tmp, fmt="png", block=True) as recorder:
+            collect(recorder, n_step=6)
+        files = glob.glob(os.path.join(tmp, "frame_*.png"))
+        assert len(files) == recorder.recorded * 3
+
+
+def test_recorder_every(every=3):
+    with tempfile.TemporaryDirectory() as tmp:
+        with FrameRecorder(tmp, block=True, every=every) as recorder:
+            renders = rgb_env.renders
+            collect(recorder)
+        # one render per agent turn, rendered only when recorded
+        assert recorder.steps == 20
+        assert recorder.recorded == -(-recorder.steps // every)
+        assert rgb_env.renders - renders == recorder.recorded * 3
+
+
+def test_recorder_slow_disk(delay=0.05):
+    with tempfile.TemporaryDirectory() as tmp:
+        recorder = FrameRecorder(tmp, max_queue=2)
+        write = recorder._write
+
+        def slow_write(frames):
+            time.sleep(delay)
+            write(frames)
+
+        recorder._write = slow_write
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            result, seconds = collect(recorder)
+        # the collection does not wait for the disk, the extra frames are dropped
+        assert seconds < result["n/st"] * delay
+        assert recorder.dropped > 0 and result["n/dropped"] == recorder.dropped
+        assert sum("frames are dropped" in str(w.message) for w in caught) == 1
+        recorder.close()
+        assert recorder.written == recorder.recorded
+
+
+if __name__ == "__main__":
+    test_recorder_npz()
+    test_recorder_png()
+    test_recorder_every()
+    test_recorder_slow_disk()
@@ -0,0 +1,135 @@
+import copy
+import time
+
+import numpy as np
+from pettingzoo.classic import rps_v2
+from tianshou.env import DummyVectorEnv
+import sys, os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(os.path.dirname(current_dir))
+sys.path.append(root)
+from marl_comm.env import BatchedSubprocVectorEnv, MAEnvWrapper, get_MA_VectorEnv
+from marl_comm.games import dilemma_pettingzoo
+from marl_comm.games.dilemma_vector import DilemmaVectorEnv
+
+
+def get_env():
+    return MAEnvWrapper(dilemma_pettingzoo.env(game="pg", num_players=3, max_cycles=4))
+
+
+def rollout(env, actions):
+    """Step the actions, resetting at the end of an episode."""
+    results = []
+    for action in actions:
+        obs, rew, *flags, info = env.step(action)
+        results.append(str((obs, rew, flags, info)))
+        if any(flags):
+            results.append(str(env.reset()))
+    return results
+
+
+def test_env_snapshot(steps=20):
+    rng = np.random.RandomState(0)
+    for env in [get_env(), MAEnvWrapper(rps_v2.env(num_actions=3, max_cycles=4))]:
+        # in the middle of a round
+        rollout(env, rng.randint(2, size=4))
+        snapshot = env.snapshot()
+        actions = rng.randint(2, size=steps)
+        ref = rollout(env, actions)
+        for _ in range(3):
+            env.restore(snapshot)
+            assert rollout(env, actions) == ref
+
+
+def venv_rollout(venv, actions):
+    """Step all envs, resetting the finished ones."""
+    results = []
+    for action in actions:
+        obs, rew, *flags, info = venv.step(action)
+        done = np.logical_or.reduce(flags)
+        results.append(str((obs, rew, done)))
+        if done.any():
+            results.append(str(venv.reset(np.where(done)[0])))
+    return results
+
+
+def test_venv_snapshot(env_num=5, steps=10):
+    for venv_cls, kwargs in [
+        (DummyVectorEnv, {}),
+        (BatchedSubprocVectorEnv, {"envs_per_worker": 2}),
+    ]:
+        rng = np.random.RandomState(0)
+        venv = get_MA_VectorEnv(venv_cls, [get_env] * env_num, **kwargs)
+        venv.reset()
+        for i in range(1, env_num):
+            # a different number of turns in each env
+            venv.step(np.zeros(i, dtype=int), np.arange(i))
+        snapshots = venv.snapshot()
+        actions = rng.randint(2, size=(steps, env_num))
+        ref = venv_rollout(venv, actions)
+        venv.restore(snapshots)
+        assert venv_rollout(venv, actions) == ref
+        # branch the last env in all envs
+        venv.restore(venv.snapshot(env_num - 1) * env_num)
+        obs, *_ = venv.step(np.zeros(env_num, dtype=int))
+        assert all(str(o) == str(obs[0]) for o in obs)
+        if venv_cls is BatchedSubprocVectorEnv:
+            # a single message per worker for all of its envs
+            sends = []
+            for remote in venv.parent_remotes:
+
+                def send(obj, _send=remote.send):
+                    sends.append(obj[0])
+                    _send(obj)
+
+                remote.send = send
+            venv.restore(venv.snapshot())
+            assert (
+                sends == ["getattr"] * venv.worker_num + ["setattr"] * venv.worker_num
+            )
+        venv.close()
+
+
+def test_dilemma_vector_snapshot(env_num=6, steps=10):
+    rng = np.random.RandomState(0)
+    venv = DilemmaVectorEnv(env_num, game="pg", num_players=3, max_cycles=4)
+    venv.reset()
+    venv.step(rng.randint(2, size=env_num // 2), np.arange(env_num // 2))
+    snapshot = venv.snapshot()
+    assert snapshot.shape == (env_num, 2 * venv.agent_num + 2)
+    actions = rng.randint(2, size=(steps, env_num))
+    ref = [str(venv.step(a)) for a in actions]
+    venv.restore(snapshot)
+    assert [str(venv.step(a)) for a in actions] == ref
+    # branch the first game in all games
+    venv.restore(snapshot[0])
+    assert (venv.snapshot() == snapshot[0]).all()
+
+
+def benchmark(branches=2000):
+    env = get_env()
+    env.step(0)
+    for name, snapshot, restore in [
+        ("snapshot", env.snapshot, env.restore),
+        ("deepcopy", lambda: copy.deepcopy(env.env), lambda s: copy.deepcopy(s)),
+    ]:
+        start = time.time()
+        state = snapshot()
+        for _ in range(branches):
+            restore(state)
+            env.step(1)
+        print(f"{name}: {branches / (time.time() - start):.0f} branches/s")
+    venv = DilemmaVectorEnv(branches)
+    venv.reset()
+    start = time.time()
+    venv.restore(venv.snapshot(0))
+    venv.step(np.ones(branches, dtype=int))
+    print(f"DilemmaVectorEnv: {branches / (time.time() - start):.0f} branches/s")
+
+
+if __name__ == "__main__":
+    test_env_snapshot()
+    test_venv_snapshot()
+    test_dilemma_vector_snapshot()
+    benchmark()
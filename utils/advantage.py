@@ -0,0 +1,134 @@
+from typing import List, Tuple, Union
+
+import numpy as np
+from numba import njit
+from tianshou.data import Batch, ReplayBuffer, ReplayBufferManager
+from tianshou.policy import BasePolicy
+
+
+def compute_ma_episodic_return(
+    batches: List[Batch],
+    buffers: List[ReplayBuffer],
+    indices: np.ndarray,
+    v_s_: np.ndarray,
+    v_s: np.ndarray,
+    gamma: float = 0.99,
+    gae_lambda: float = 0.95,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute GAE returns of all agents at once.
+
+    The multi-agent counterpart of ``BasePolicy.compute_episodic_return``:
+    each agent's data is sampled from its own buffer with the same indices.
+    The rollout is laid out as a dense [T, env, agent] tensor and the GAE
+    recursion runs once over T for all envs and agents.
+
+    :param List[Batch] batches: batches[agent_i] is equal to buffers[agent_i][indices]
+    :param List[ReplayBuffer] buffers: the agents' buffers
+    :param np.ndarray indices: the indices shared by all agents
+    :param np.ndarray v_s_: [agent_num, bsz], the values of the next states
+    :param np.ndarray v_s: [agent_num, bsz], the values of the states
+    :param float gamma: the discount factor, defaults to 0.99
+    :param float gae_lambda: the parameter for GAE, defaults to 0.95
+    :return: (returns, advantage) with each shape [agent_num, bsz]
+    """
+    rew = np.stack([batch.rew for batch in batches], axis=-1)
+    v_s = np.asarray(v_s).T
+    v_s_ = np.stack(
+        [
+            v * BasePolicy.value_mask(buf, indices)
+            for v, buf in zip(np.asarray(v_s_), buffers)
+        ],
+        axis=-1,
+    )
+    end_flag = np.stack(
+        [
+            buf.done[indices] | np.isin(indices, buf.unfinished_index())
+            for buf in buffers
+        ],
+        axis=-1,
+    )
+
+    bsz, agent_num = rew.shape
+    env_num = _dense_env_num(buffers[0], end_flag)
+    step_num = bsz // env_num
+
+    def to_dense(x: np.ndarray) -> np.ndarray:
+        # [env * T, agent] -> [T, env, agent]
+        return x.reshape(env_num, step_num, agent_num).transpose(1, 0, 2)
+
+    advantage = compute_ma_gae(
+        to_dense(v_s),
+        to_dense(v_s_),
+        to_dense(rew),
+        to_dense(end_flag),
+        gamma,
+        gae_lambda,
+    )
+    advantage = advantage.transpose(1, 0, 2).reshape(bsz, agent_num)
+    returns = advantage + v_s
+    return returns.T, advantage.T
+
+
+def _dense_env_num(buffer: Union[ReplayBuffer, ReplayBufferManager],
+                   end_flag: np.ndarray) -> int:
+    """Number of env rows the flat batch can be split into.
+
+    Splitting the flat batch into equal rows is exact as long as every row
+    ends with an end flag, because the flat recursion never crosses an end
+    flag. Otherwise the whole batch is kept as a single row.
+    """
+    env_num = getattr(buffer, "buffer_num", 1)
+    bsz = len(end_flag)
+    if env_num > 1 and bsz % env_num == 0:
+        step_num = bsz // env_num
+        if end_flag[step_num - 1::step_num].all():
+            return env_num
+    return 1
+
+
+def compute_ma_gae(
+    v_s: np.ndarray,
+    v_s_: np.ndarray,
+    rew: np.ndarray,
+    end_flag: np.ndarray,
+    gamma: float = 0.99,
+    gae_lambda: float = 0.95,
+) -> np.ndarray:
+    """GAE over a dense rollout.
+
+    :param v_s: [T, ...], e.g. [T, env, agent]
+    :param v_s_: [T, ...], already masked on terminal transitions
+    :param rew: [T, ...]
+    :param end_flag: [T, ...], True where the recursion must not look ahead
+    :return: the advantages, [T, ...]
+    """
+    shape = rew.shape
+    step_num = shape[0]
+    advantage = _gae_return(
+        v_s.reshape(step_num, -1).astype(np.float64),
+        v_s_.reshape(step_num, -1).astype(np.float64),
+        rew.reshape(step_num, -1).astype(np.float64),
+        end_flag.reshape(step_num, -1).astype(bool),
+        gamma,
+        gae_lambda,
+    )
+    return advantage.reshape(shape)
+
+
+@njit
+def _gae_return(
+    v_s: np.ndarray,
+    v_s_: np.ndarray,
+    rew: np.ndarray,
+    end_flag: np.ndarray,
+    gamma: float,
+    gae_lambda: float,
+) -> np.ndarray:
+    advantage = np.zeros(rew.shape)
+    delta = rew + v_s_ * gamma - v_s
+    discount = (1.0 - end_flag) * (gamma * gae_lambda)
+    gae = np.zeros(rew.shape[1])
+    for t in range(rew.shape[0] - 1, -1, -1):
+        gae = delta[t] + discount[t] * gae
+        advantage[t] = gae
+    return advantage
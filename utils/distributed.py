@@ -0,0 +1,84 @@
+from typing import Iterable
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+def is_distributed() -> bool:
+    """Whether a process group with more than one process is running."""
+    return dist.is_available() and dist.is_initialized() \
+        and dist.get_world_size() > 1
+
+
+def init_local_process_group(rank: int,
+                             world_size: int,
+                             port: int = 29500,
+                             backend: str = "gloo") -> None:
+    """Join a process group of local processes, e.g. started with
+    `torch.multiprocessing.spawn`, gloo works on CPU-only machines.
+
+    :param int rank: the rank of this process
+    :param int world_size: the number of processes
+    :param int port: a free local port shared by all processes, defaults to 29500
+    :param str backend: defaults to "gloo"
+    """
+    dist.init_process_group(backend,
+                            init_method=f"tcp://127.0.0.1:{port}",
+                            rank=rank,
+                            world_size=world_size)
+
+
+def shard_indices(size: int) -> np.ndarray:
+    """The rows of a batch of the given size that this rank learns from.
+
+    All ranks get the same number of rows, so that they run the same number of
+    minibatches and their collectives match, the at most world_size - 1 rows
+    left over are dropped.
+    """
+    if not is_distributed():
+        return np.arange(size)
+    shard_size = size // dist.get_world_size()
+    start = dist.get_rank() * shard_size
+    return np.arange(start, start + shard_size)
+
+
+def broadcast_parameters(module: torch.nn.Module, src: int = 0) -> None:
+    """Copy the parameters and buffers of rank src to all ranks."""
+    if not is_distributed():
+        return
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src=src)
+
+
+def all_reduce_gradients(parameters: Iterable[torch.nn.Parameter]) -> None:
+    """Average the gradients over all ranks with a single all-reduce.
+
+    A missing gradient counts as zero, so that all ranks reduce the same
+    flattened buffer.
+    """
+    if not is_distributed():
+        return
+    params = [p for p in parameters if p.requires_grad]
+    if len(params) == 0:
+        return
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+    flat = torch.cat([p.grad.reshape(-1) for p in params])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for p in params:
+        numel = p.grad.numel()
+        p.grad.copy_(flat[offset:offset + numel].view_as(p.grad))
+        offset += numel
+
+
+def all_reduce_mean(tensor: torch.Tensor) -> torch.Tensor:
+    """Average a tensor over all ranks, e.g. the losses to report."""
+    if not is_distributed():
+        return tensor
+    tensor = tensor.clone()
+    dist.all_reduce(tensor)
+    return tensor / dist.get_world_size()
@@ -0,0 +1,62 @@
+import bisect
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# log-spaced bucket edges in seconds, 4 buckets per decade from 1us to 10s
+BUCKET_EDGES: List[float] = (10**np.arange(-6, 1.01, 0.25)).tolist()
+
+
+class LatencyHistogram:
+    """Histogram of latencies in fixed buckets, cheap enough to record every
+    env step, and mergeable across envs or workers since all histograms share
+    the same buckets.
+
+    Bucket i counts the latencies in [edges[i - 1], edges[i]), the first and
+    the last bucket count the latencies below and above all edges.
+    """
+
+    def __init__(self, edges: Optional[List[float]] = None) -> None:
+        self.edges = BUCKET_EDGES if edges is None else list(edges)
+        self.counts = [0] * (len(self.edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.counts[bisect.bisect_right(self.edges, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: "LatencyHistogram") -> "LatencyHistogram":
+        assert self.edges == other.edges
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def mean(self) -> float:
+        return self.total / max(self.count, 1)
+
+    def quantile(self, q: float) -> float:
+        """The upper edge of the bucket holding the q-quantile, an upper bound
+        of the q-quantile within a factor of the bucket width."""
+        assert 0 <= q <= 1
+        if self.count == 0:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        return self.edges[i] if i < len(self.edges) else self.max
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            "edges": self.edges,
+            "counts": self.counts,
+        }
@@ -0,0 +1,35 @@
+import importlib
+from typing import Any, Callable, Dict, List, Tuple
+
+
+def lazy_attributes(
+    module_name: str, attributes: Dict[str, str]
+) -> Tuple[Callable[[str], Any], Callable[[], List[str]]]:
+    """Module level `__getattr__` and `__dir__` (PEP 562) which import the
+    submodule defining an attribute on first access, so that importing a
+    package does not pull in torch, tianshou or gym until they are needed.
+
+    :param str module_name: the `__name__` of the package
+    :param Dict[str, str] attributes: maps the attribute names to the modules
+        defining them, e.g. {"MACollector": "marl_comm.data.ma_collector"},
+        or a subpackage to its own name, e.g. {"data": "marl_comm.data"}
+    :return: (__getattr__, __dir__) of the package
+    """
+    module = importlib.import_module(module_name)
+
+    def __getattr__(name: str) -> Any:
+        if name not in attributes:
+            raise AttributeError(
+                f"module {module_name!r} has no attribute {name!r}")
+        submodule = importlib.import_module(attributes[name])
+        if attributes[name] == f"{module_name}.{name}":
+            # a subpackage, set as an attribute of the package on import
+            return submodule
+        value = getattr(submodule, name)
+        setattr(module, name, value)
+        return value
+
+    def __dir__() -> List[str]:
+        return sorted(set(vars(module)) | set(attributes))
+
+    return __getattr__, __dir__
@@ -72,4 +72,101 @@ class QMixer(nn.Module):
 
         q_tot = y.view(bsz, -1, 1)
 
-        return q_tot
\ No newline at end of file
+        return q_tot
+
+
+class QattenMixer(nn.Module):
+    """Multi-head attention mixer (Qatten, https://arxiv.org/abs/2002.03939).
+
+    ``q_tot = sum_h w_h(s) * sum_i lambda_{i,h}(s) * Q_i + c(s)``, where the
+    attention weights ``lambda_{i,h}`` of head ``h`` are normalized over agents
+    between a state query and a key of each agent's index encoding. Both
+    ``lambda`` and ``w`` are non-negative and independent of the agent
+    Q-values, so ``q_tot`` stays monotonic in every ``Q_i``.
+
+    Unlike :class:`QMixer`, no layer outputs ``agent_num`` weights: the agent
+    encodings are fixed sinusoids and the key projection is shared, so the
+    number of parameters does not depend on ``agent_num``. The attention is
+    linear (https://arxiv.org/abs/2006.16236), ``lambda_{i,h}`` is
+    proportional to ``phi(query_h) . phi(key_{i,h})`` with the positive feature
+    map ``phi(x) = elu(x) + 1``, so the sum over agents is folded into the keys
+    before the query is applied. Apart from the Q-values themselves, the
+    activations are ``[batch_size, n_heads, embed_dim]`` for any ``agent_num``,
+    instead of ``[batch_size, agent_num, hidden_sizes[-1]]``.
+    """
+
+    def __init__(
+        self,
+        agent_num: int,
+        state_space: Union[int, Sequence[int]],
+        hidden_sizes: Sequence[int] = (64, ),
+        n_heads: int = 4,
+        embed_dim: int = 32,
+        device: Union[str, int, torch.device] = "cpu",
+    ) -> None:
+        super().__init__()
+        self.agent_num = agent_num
+        self.state_dim = int(np.prod(state_space))
+        self.hidden_sizes = hidden_sizes
+        self.n_heads = n_heads
+        self.embed_dim = embed_dim
+
+        self.query = MLP(self.state_dim,
+                         self.n_heads * self.embed_dim,
+                         hidden_sizes,
+                         device=device)
+        self.key = nn.Linear(self.embed_dim,
+                             self.n_heads * self.embed_dim,
+                             bias=False,
+                             device=device)
+        self.hyper_w_head = MLP(self.state_dim,
+                                self.n_heads,
+                                hidden_sizes,
+                                device=device)
+        self.V = MLP(self.state_dim, 1, hidden_sizes, device=device)
+
+        self.register_buffer(
+            "agent_encoding",
+            self._sinusoid_encoding(agent_num, embed_dim).to(device))
+
+    @staticmethod
+    def _sinusoid_encoding(agent_num: int, embed_dim: int) -> torch.Tensor:
+        """Fixed sinusoidal encoding of the agent index, [agent_num, embed_dim]."""
+        position = torch.arange(agent_num, dtype=torch.float32).unsqueeze(1)
+        freq = torch.exp(
+            torch.arange(0, embed_dim, 2, dtype=torch.float32) *
+            (-np.log(10000.0) / embed_dim))
+        encoding = torch.zeros(agent_num, embed_dim)
+        encoding[:, 0::2] = torch.sin(position * freq)
+        encoding[:, 1::2] = torch.cos(position * freq)[:, :embed_dim // 2]
+        return encoding
+
+    def forward(self, agent_qs: torch.Tensor,
+                state: torch.Tensor) -> torch.Tensor:
+        """
+        :param agent_qs: [batch_size, agent_num, 1]
+        :param state: [batch_size, state_dim]
+        :return: [batch_size, 1, 1], i.e. one q_tot per sample in the shape
+            of the QMixer output
+        """
+        bsz = agent_qs.shape[0]
+        state = state.reshape(-1, self.state_dim)
+        agent_qs = agent_qs.reshape(-1, self.agent_num)
+
+        query = F.elu(
+            self.query(state).view(-1, self.n_heads, self.embed_dim)) + 1
+        key = F.elu(
+            self.key(self.agent_encoding).view(self.agent_num, self.n_heads,
+                                               self.embed_dim)) + 1
+        # sum_i phi(key_i) * Q_i and sum_i phi(key_i), [B, H, E] and [H, E]
+        key_qs = torch.einsum("bn,nhe->bhe", agent_qs, key)
+        key_sum = key.sum(dim=0)
+
+        head_qs = (query * key_qs).sum(dim=-1) / (query * key_sum).sum(dim=-1)
+        w_head = torch.abs(self.hyper_w_head(state))
+
+        y = (w_head * head_qs).sum(dim=-1, keepdim=True) + self.V(state)
+
+        q_tot = y.view(bsz, -1, 1)
+
+        return q_tot
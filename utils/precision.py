@@ -0,0 +1,85 @@
+import threading
+from contextlib import contextmanager
+from typing import Any, ContextManager, Iterator, List
+
+import torch
+import torch.nn as nn
+
+PRECISIONS = ("fp32", "bf16")
+
+
+def autocast(precision: str = "fp32") -> ContextManager:
+    """CPU autocast context for the given precision.
+
+    Only the ops run inside the context are cast, the parameters and the
+    optimizer state stay in fp32. For "fp32" the context is a no-op.
+
+    :param str precision: choices include {"fp32", "bf16"}, defaults to "fp32"
+    """
+    assert precision in PRECISIONS, f"precision must be in {set(PRECISIONS)}"
+    # CPU autocast only accepts bfloat16 as its dtype, even when disabled
+    return torch.autocast("cpu",
+                          dtype=torch.bfloat16,
+                          enabled=precision == "bf16")
+
+
+@contextmanager
+def autocast_forward(module: nn.Module,
+                     precision: str = "fp32") -> Iterator[None]:
+    """Run the forward of the module under autocast within the context, with
+    its floating point outputs cast back to fp32.
+
+    For learn methods that cannot be split, e.g. tianshou's, so that their
+    backward pass and optimizer step still run outside of autocast. Autocast
+    is entered by forward hooks of the module, so it also applies in other
+    threads, and the contexts may be nested or share modules.
+
+    :param nn.Module module:
+    :param str precision: choices include {"fp32", "bf16"}, defaults to "fp32"
+    """
+    if precision == "fp32":
+        yield
+        return
+
+    def _enter(module: nn.Module, args: Any) -> None:
+        context = autocast(precision)
+        context.__enter__()
+        _autocast_stack().append(context)
+
+    def _exit(module: nn.Module, args: Any, output: Any) -> Any:
+        _autocast_stack().pop().__exit__(None, None, None)
+        return _to_float(output)
+
+    depth = len(_autocast_stack())
+    handles = [
+        module.register_forward_pre_hook(_enter),
+        module.register_forward_hook(_exit)
+    ]
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+        # a forward which raised skipped its exit hook
+        stack = _autocast_stack()
+        while len(stack) > depth:
+            stack.pop().__exit__(None, None, None)
+
+
+# the autocast contexts entered by the forward hooks of `autocast_forward` in
+# each thread, exited last in first out as the modules' forwards return
+_local = threading.local()
+
+
+def _autocast_stack() -> List[ContextManager]:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _to_float(x: Any) -> Any:
+    if isinstance(x, torch.Tensor) and x.is_floating_point():
+        return x.float()
+    if isinstance(x, (tuple, list)):
+        return type(x)(_to_float(i) for i in x)
+    return x